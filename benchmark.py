@@ -0,0 +1,462 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from lib import export_files, output_helper, synthetic
+from lib.mock_open_search import MockOpenSearch
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = ["directory", "neofinder"]
+
+parser = argparse.ArgumentParser(
+    description="Measure the export and import scripts on synthetic inputs."
+)
+parser.add_argument(
+    "--benchmarks",
+    nargs="+",
+    choices=BENCHMARKS,
+    default=BENCHMARKS,
+    help="Benchmarks to run, default: all.",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=1,
+    help="Number of runs of each stage, the median is reported, default: 1.",
+)
+parser.add_argument(
+    "--work-dir",
+    type=str,
+    help="Directory for the generated inputs and the outputs of the scripts. It is kept "
+    "and inputs generated with the same parameters are reused, default: a temporary directory.",
+)
+parser.add_argument(
+    "--output",
+    type=str,
+    help="Path of the JSON results, default: output/benchmark/benchmark_<date>.json.",
+)
+parser.add_argument(
+    "--compare",
+    type=str,
+    help="JSON results of an earlier run, the change of each stage is logged.",
+)
+parser.add_argument(
+    "--seed", type=int, default=1, help="Seed of the generators, default: 1."
+)
+parser.add_argument(
+    "--depth",
+    type=int,
+    default=3,
+    help="Depth of the directory tree, default: 3.",
+)
+parser.add_argument(
+    "--fan-out",
+    type=int,
+    default=4,
+    help="Number of subdirectories of each directory, default: 4.",
+)
+parser.add_argument(
+    "--files-per-directory",
+    type=int,
+    default=50,
+    help="Number of files in each directory, default: 50.",
+)
+parser.add_argument(
+    "--file-size",
+    type=int,
+    default=1024,
+    help="Maximum size of the generated files in bytes, default: 1024.",
+)
+parser.add_argument(
+    "--empty-ratio",
+    type=float,
+    default=0.05,
+    help="Share of empty files, default: 0.05.",
+)
+parser.add_argument(
+    "--symlink-ratio",
+    type=float,
+    default=0.01,
+    help="Share of symlinks among the files, default: 0.01.",
+)
+parser.add_argument(
+    "--neofinder-files",
+    type=int,
+    default=2,
+    help="Number of generated NeoFinder exports, default: 2.",
+)
+parser.add_argument(
+    "--neofinder-rows",
+    type=int,
+    default=50000,
+    help="Number of rows of each NeoFinder export, default: 50000.",
+)
+parser.add_argument(
+    "--broken-ratio",
+    type=float,
+    default=0.01,
+    help="Share of NeoFinder rows broken into several lines, default: 0.01.",
+)
+parser.add_argument(
+    "--export-args",
+    type=str,
+    default="",
+    help="Additional options for the export scripts, e.g. '--format ndjson'.",
+)
+parser.add_argument(
+    "--import-args",
+    type=str,
+    default="",
+    help="Additional options for import.py, e.g. '--threads 8'.",
+)
+parser.add_argument(
+    "--skip-import",
+    action="store_true",
+    help="Only measure the export scripts.",
+)
+parser.add_argument(
+    "--mock-latency",
+    type=float,
+    default=0,
+    help="Milliseconds the mock OpenSearch endpoint waits before answering a bulk request, default: 0.",
+)
+
+
+def prepare_input(work_directory, name, parameters, generate):
+    """Generates an input below the work directory, unless it exists with the same parameters.
+
+    Returns the path of the input and the description returned by `generate`.
+    """
+
+    input_path = f"{work_directory}/input/{name}"
+    description_path = f"{input_path}.json"
+
+    if os.path.exists(description_path):
+        with open(description_path, "r") as f:
+            description = json.load(f)
+        if description["parameters"] == parameters:
+            logging.info(f"Reusing the generated input '{input_path}'.")
+            return (input_path, description)
+
+    shutil.rmtree(input_path, ignore_errors=True)
+    os.makedirs(input_path)
+
+    logging.info(f"Generating input '{input_path}'.")
+    start = time.perf_counter()
+    counts = generate(input_path)
+    description = {
+        "parameters": parameters,
+        "counts": counts,
+        "generate_seconds": round(time.perf_counter() - start, 3),
+    }
+    with open(description_path, "w") as f:
+        json.dump(description, f, indent=2)
+
+    return (input_path, description)
+
+
+def generate_neofinder_exports(input_path, options):
+    counts = {"files": options["neofinder_files"], "rows": 0, "lines": 0, "bytes": 0}
+    for index in range(options["neofinder_files"]):
+        path = f"{input_path}/export_{index}.txt"
+        counts["lines"] += synthetic.generate_neofinder_export(
+            path,
+            options["neofinder_rows"],
+            options["broken_ratio"],
+            options["seed"] + index,
+        )
+        counts["rows"] += options["neofinder_rows"]
+        counts["bytes"] += os.path.getsize(path)
+    return counts
+
+
+def run_script(arguments, work_directory, log_name):
+    """Runs one of the scripts in the work directory and measures it.
+
+    The output of the script is written to `<log_name>.log` in the work directory.
+    Returns the wall clock and CPU time and the peak resident set size, which
+    includes worker processes.
+    """
+
+    command = [sys.executable, *arguments]
+    log_path = f"{work_directory}/{log_name}.log"
+    with open(log_path, "w") as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, cwd=work_directory, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise Exception(
+            f"'{shlex.join(arguments)}' failed with exit code {process.returncode}, see '{log_path}'."
+        )
+
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere.
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {
+        "seconds": round(seconds, 3),
+        "user_seconds": round(usage.ru_utime, 3),
+        "system_seconds": round(usage.ru_stime, 3),
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+    }
+
+
+def find_export_directory(work_directory):
+    """Returns the directory with the export files written to the (cleaned) output directory."""
+
+    for current, _, names in os.walk(f"{work_directory}/output"):
+        if any(export_files.is_export_file(name) for name in names):
+            return current
+    return None
+
+
+def count_documents(export_directory):
+    if export_directory is None:
+        return None
+    return sum(
+        1
+        for name in os.listdir(export_directory)
+        if export_files.is_export_file(name)
+        for _ in export_files.read_documents(f"{export_directory}/{name}")
+    )
+
+
+def run_benchmark(name, script, input_path, work_directory, mock, options):
+    """Runs the export and import stages of one benchmark `--repeat` times."""
+
+    stages = {"export": [], "import": []}
+    for run in range(options["repeat"]):
+        # Every run starts without the outputs, checkpoints and scan state of the previous one.
+        for directory in ["output", "state"]:
+            shutil.rmtree(f"{work_directory}/{directory}", ignore_errors=True)
+
+        logging.info(f"Running the {name} export ({run + 1}/{options['repeat']}).")
+        result = run_script(
+            [
+                f"{SCRIPT_DIRECTORY}/{script}",
+                input_path,
+                *shlex.split(options["export_args"]),
+            ],
+            work_directory,
+            f"{name}_export_{run}",
+        )
+        export_directory = find_export_directory(work_directory)
+        result["documents"] = count_documents(export_directory)
+        stages["export"].append(result)
+
+        if options["skip_import"] or export_directory is None:
+            continue
+
+        logging.info(f"Running the {name} import ({run + 1}/{options['repeat']}).")
+        mock.reset()
+        result = run_script(
+            [
+                f"{SCRIPT_DIRECTORY}/import.py",
+                f"benchmark_{name}",
+                export_directory,
+                *shlex.split(options["import_args"]),
+            ],
+            work_directory,
+            f"{name}_import_{run}",
+        )
+        result["documents"] = mock.stats["indexed"]
+        result["bulk_requests"] = mock.stats["bulk_requests"]
+        result["bulk_megabytes"] = round(mock.stats["bulk_bytes"] / 1024 / 1024, 1)
+        stages["import"].append(result)
+
+    return {stage: runs for (stage, runs) in stages.items() if runs}
+
+
+def summarize(runs, unit, count):
+    """Returns the median of each measurement and the throughput in `unit` per second."""
+
+    summary = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        summary[key] = round(statistics.median(values), 3) if values else None
+
+    summary[f"{unit}_per_second"] = (
+        round(count / summary["seconds"], 1) if summary["seconds"] else None
+    )
+    summary["runs"] = runs
+    return summary
+
+
+def summarize_stages(stages, unit, count):
+    """Summarizes the export runs in `unit` per second and the import runs in documents per second."""
+
+    summary = {"export": summarize(stages["export"], unit, count)}
+    if "import" in stages:
+        summary["import"] = summarize(stages["import"], "documents", count)
+    return summary
+
+
+def log_comparison(results, previous):
+    for name, benchmark in results["benchmarks"].items():
+        for stage, summary in benchmark["stages"].items():
+            try:
+                before = previous["benchmarks"][name]["stages"][stage]["seconds"]
+            except KeyError:
+                continue
+            change = (summary["seconds"] - before) / before * 100 if before else 0
+            logging.info(
+                f"  {name} {stage}: {before} s -> {summary['seconds']} s ({change:+.1f}%)"
+            )
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SCRIPT_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    options = vars(parser.parse_args())
+
+    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    logging.basicConfig(
+        filename=f"{output_helper.get_logging_dir()}/benchmark_{now}.log",
+        filemode="w",
+        encoding="utf-8",
+        format="%(asctime)s|%(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    output_path = options["output"] or (
+        f"{output_helper.get_output_base_dir('benchmark')}/benchmark_{now}.json"
+    )
+
+    if options["work_dir"]:
+        work_directory = os.path.abspath(options["work_dir"])
+        os.makedirs(work_directory, exist_ok=True)
+    else:
+        work_directory = tempfile.mkdtemp(prefix="benchmark_")
+
+    mock = MockOpenSearch(latency=options["mock_latency"] / 1000)
+    mock.write_env_file(f"{work_directory}/.env")
+
+    results = {
+        "started": datetime.now().isoformat(),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": options,
+        "benchmarks": {},
+    }
+
+    try:
+        if "directory" in options["benchmarks"]:
+            tree_parameters = {
+                key: options[key]
+                for key in [
+                    "seed",
+                    "depth",
+                    "fan_out",
+                    "files_per_directory",
+                    "file_size",
+                    "empty_ratio",
+                    "symlink_ratio",
+                ]
+            }
+            input_path, description = prepare_input(
+                work_directory,
+                "directory",
+                tree_parameters,
+                lambda path: synthetic.generate_tree(path, **tree_parameters),
+            )
+            counts = description["counts"]
+            entries = counts["directories"] + counts["files"] + counts["symlinks"]
+
+            stages = run_benchmark(
+                "directory",
+                "export_directory.py",
+                input_path,
+                work_directory,
+                mock,
+                options,
+            )
+            results["benchmarks"]["directory"] = {
+                "input": description,
+                "stages": summarize_stages(stages, "files", entries),
+            }
+
+        if "neofinder" in options["benchmarks"]:
+            neofinder_parameters = {
+                key: options[key]
+                for key in ["seed", "neofinder_files", "neofinder_rows", "broken_ratio"]
+            }
+            input_path, description = prepare_input(
+                work_directory,
+                "neofinder",
+                neofinder_parameters,
+                lambda path: generate_neofinder_exports(path, options),
+            )
+            rows = description["counts"]["rows"]
+
+            stages = run_benchmark(
+                "neofinder",
+                "export_neofinder.py",
+                input_path,
+                work_directory,
+                mock,
+                options,
+            )
+            results["benchmarks"]["neofinder"] = {
+                "input": description,
+                "stages": summarize_stages(stages, "rows", rows),
+            }
+    finally:
+        mock.close()
+        if not options["work_dir"]:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    logging.info(
+        "####################################################################################"
+    )
+    for name, benchmark in results["benchmarks"].items():
+        for stage, summary in benchmark["stages"].items():
+            throughput = [
+                f"{value} {key.replace('_per_second', '')}/s"
+                for (key, value) in summary.items()
+                if key.endswith("_per_second")
+            ]
+            logging.info(
+                f"  {name} {stage}: {summary['seconds']} s, {', '.join(throughput)}, "
+                f"peak RSS {summary['peak_rss_mb']} MB"
+            )
+
+    if options["compare"]:
+        with open(options["compare"], "r") as f:
+            previous = json.load(f)
+        logging.info("Compared to the earlier run:")
+        log_comparison(results, previous)
+
+    logging.info(f"Wrote the results to '{output_path}'.")
@@ -0,0 +1,329 @@
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from lib import (
+    export_files,
+    external_sort,
+    key_index,
+    metrics,
+    output_helper,
+    serializer,
+)
+
+# Number of changed documents collected before a JSON output file is written.
+BATCH_SIZE = 100000
+
+# Number of directories whose sums are kept in memory before they are spilled to disk.
+MAX_DIRECTORIES_IN_MEMORY = 1000000
+
+parser = argparse.ArgumentParser(
+    description="Compare two exports and write the changes as an export that import.py applies to an index."
+)
+parser.add_argument(
+    "old_directory", type=str, help="The output directory of the older export."
+)
+parser.add_argument(
+    "new_directory", type=str, help="The output directory of the newer export."
+)
+parser.add_argument(
+    "--sort-memory",
+    type=int,
+    default=256,
+    help="Memory in MB used to sort each export before sorted runs are spilled to disk, default: 256.",
+)
+parser.add_argument(
+    "--temp-directory",
+    type=str,
+    help="Directory for the sorted runs, default: the output directory.",
+)
+export_files.add_output_arguments(parser)
+metrics.add_metrics_arguments(parser)
+
+
+def is_row_number_id(document):
+    """Checks for the id of a NeoFinder export without --stable-ids, the export file and row number."""
+
+    export_file = document.get("neofinder_export_file")
+    document_id = document["_id"]
+    return (
+        isinstance(export_file, str)
+        and isinstance(document_id, str)
+        and document_id.startswith(f"{export_file}-")
+        and document_id[len(export_file) + 1 :].isdigit()
+    )
+
+
+def sort_export(directory, options, temp_directory, backend):
+    """Returns an ExternalSorter with the documents of all export files in directory by id."""
+
+    sorter = external_sort.ExternalSorter(
+        temp_directory, options["sort_memory"] * 1024 * 1024, backend
+    )
+    progress_meter = metrics.ProgressMeter("documents")
+
+    files = sorted(
+        (
+            f
+            for f in os.scandir(directory)
+            if f.is_file() and export_files.is_export_file(f.name)
+        ),
+        key=lambda f: f.name,
+    )
+    without_id = 0
+    try:
+        for f in files:
+            for document in export_files.read_documents(f.path, backend):
+                if "_id" not in document:
+                    without_id += 1
+                    continue
+                if sorter.count == 0 and is_row_number_id(document):
+                    # These ids shift whenever a row is added or removed.
+                    raise Exception(
+                        f"The NeoFinder export in '{directory}' was written without --stable-ids, "
+                        "its documents can not be matched by id."
+                    )
+                sorter.add(document["_id"], document)
+                progress_meter.update()
+    except BaseException:
+        sorter.close()
+        raise
+
+    logging.info(
+        f"Read {sorter.count} documents from {len(files)} files in '{directory}', "
+        f"{len(sorter.run_paths)} sorted runs were spilled to disk."
+    )
+    if without_id > 0:
+        logging.warning(f"Skipped {without_id} documents without _id in '{directory}'.")
+    return sorter
+
+
+def skip_duplicates(records, counts):
+    """Yields the first of all records with the same key."""
+
+    previous = None
+    for key, document in records:
+        if key == previous:
+            counts["duplicate"] += 1
+            continue
+        previous = key
+        yield (key, document)
+
+
+def join(old_records, new_records):
+    """Yields (id, old document, new document) for the ids of both sorted exports, a document is None if missing."""
+
+    old = next(old_records, None)
+    new = next(new_records, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield (old[0], old[1], None)
+            old = next(old_records, None)
+        elif old is None or new[0] < old[0]:
+            yield (new[0], None, new[1])
+            new = next(new_records, None)
+        else:
+            yield (old[0], old[1], new[1])
+            old = next(old_records, None)
+            new = next(new_records, None)
+
+
+def get_content(document):
+    return {
+        key: value
+        for (key, value) in document.items()
+        if key not in key_index.VOLATILE_FIELDS
+    }
+
+
+def get_size(document):
+    size = document.get("size_bytes")
+    if document.get("type") == "directory" or not isinstance(size, int):
+        return 0
+    return size
+
+
+def get_parent_directories(path):
+    """Yields the directories containing path up to the root, which is '.'."""
+
+    while "/" in path:
+        path = path.rpartition("/")[0]
+        yield path
+    yield "."
+
+
+class DirectoryChanges:
+    """Sums up the size delta and the number of changed entries below each directory.
+
+    The sums are collected in memory, once there are too many directories they are
+    spilled to an ExternalSorter and added up when they are read back.
+    """
+
+    def __init__(self, temp_directory, backend):
+        self.sums = {}
+        self.sorter = external_sort.ExternalSorter(temp_directory, backend=backend)
+
+    def add(self, path, status, size_delta):
+        for directory in get_parent_directories(path):
+            sums = self.sums.get(directory)
+            if sums is None:
+                sums = self.sums[directory] = {
+                    "size_delta": 0,
+                    "added": 0,
+                    "removed": 0,
+                    "modified": 0,
+                }
+            sums["size_delta"] += size_delta
+            sums[status] += 1
+
+        if len(self.sums) >= MAX_DIRECTORIES_IN_MEMORY:
+            self.spill()
+
+    def spill(self):
+        for directory, sums in self.sums.items():
+            self.sorter.add(directory, sums)
+        self.sums = {}
+
+    def __iter__(self):
+        """Yields (directory, sums) by directory."""
+
+        self.spill()
+        current = None
+        for directory, sums in self.sorter:
+            if current is not None and current[0] == directory:
+                for key, value in sums.items():
+                    current[1][key] += value
+                continue
+            if current is not None:
+                yield current
+            current = (directory, sums)
+        if current is not None:
+            yield current
+
+    def close(self):
+        self.sorter.close()
+
+
+if __name__ == "__main__":
+    options = vars(parser.parse_args())
+
+    start_time = time.time()
+    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    logging.basicConfig(
+        filename=f"{output_helper.get_logging_dir('diff')}/diff_{now}.log",
+        filemode="w",
+        encoding="utf-8",
+        format="%(asctime)s|%(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    metrics.start("diff_exports", options)
+
+    output_directory = f"{output_helper.get_output_base_dir('diff')}/diff_{now}"
+    os.makedirs(output_directory)
+    temp_directory = options["temp_directory"] or output_directory
+    backend = serializer.get_backend(options["serializer"])
+
+    logging.info(
+        f"Comparing '{options['old_directory']}' with '{options['new_directory']}'."
+    )
+
+    old_sorter = None
+    new_sorter = None
+    directory_changes = DirectoryChanges(temp_directory, backend)
+
+    counts = {"added": 0, "removed": 0, "modified": 0, "unchanged": 0, "duplicate": 0}
+    size_delta = 0
+    written = 0
+
+    writer = export_files.create_writer(output_directory, "changes", options)
+    progress_meter = metrics.ProgressMeter("entries")
+
+    try:
+        old_sorter = sort_export(
+            options["old_directory"], options, temp_directory, backend
+        )
+        new_sorter = sort_export(
+            options["new_directory"], options, temp_directory, backend
+        )
+
+        with open(f"{output_directory}/deleted_ids.txt", "w") as deleted_ids, open(
+            f"{output_directory}/changes.tsv", "w", newline=""
+        ) as changes_file:
+            changes = csv.writer(changes_file, delimiter="\t")
+            changes.writerow(["status", "id", "path", "size_delta"])
+
+            for document_id, old, new in join(
+                skip_duplicates(iter(old_sorter), counts),
+                skip_duplicates(iter(new_sorter), counts),
+            ):
+                progress_meter.update()
+
+                if new is None:
+                    status = "removed"
+                    delta = -get_size(old)
+                    deleted_ids.write(f"{document_id}\n")
+                elif old is None:
+                    status = "added"
+                    delta = get_size(new)
+                elif get_content(old) != get_content(new):
+                    status = "modified"
+                    delta = get_size(new) - get_size(old)
+                else:
+                    counts["unchanged"] += 1
+                    continue
+
+                counts[status] += 1
+                size_delta += delta
+
+                if new is not None:
+                    writer.write(new)
+                    written += 1
+                    if writer.pending() >= BATCH_SIZE:
+                        writer.flush(f"{written}_changes")
+
+                path = (new or old).get("path")
+                changes.writerow([status, document_id, path, delta])
+                if isinstance(path, str):
+                    directory_changes.add(path, status, delta)
+
+        writer.close(f"{written}_changes")
+
+        with open(f"{output_directory}/directory_changes.tsv", "w", newline="") as f:
+            directories = csv.writer(f, delimiter="\t")
+            directories.writerow(
+                ["directory", "size_delta", "added", "removed", "modified"]
+            )
+            for directory, sums in directory_changes:
+                directories.writerow(
+                    [
+                        directory,
+                        sums["size_delta"],
+                        sums["added"],
+                        sums["removed"],
+                        sums["modified"],
+                    ]
+                )
+    finally:
+        for sorter in [old_sorter, new_sorter]:
+            if sorter is not None:
+                sorter.close()
+        directory_changes.close()
+
+    logging.info(f"Finished after {round(time.time() - start_time, 2)} seconds.")
+    logging.info(
+        f"  {counts['added']} added, {counts['removed']} removed, {counts['modified']} modified "
+        f"and {counts['unchanged']} unchanged entries, {size_delta:+} bytes overall."
+    )
+    if counts["duplicate"] > 0:
+        logging.warning(
+            f"  Skipped {counts['duplicate']} documents with duplicate ids."
+        )
+    logging.info(f"  Wrote the changes to {output_directory}.")
+    metrics.finish(options)
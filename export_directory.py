@@ -1,20 +1,22 @@
 import argparse
-import json
 import logging
-import mimetypes
 import os
 import sys
 import time
-from datetime import date, datetime, timezone
-
-import filetype
-
-from lib import output_helper
+from datetime import datetime
+
+from lib import (
+    checkpoint,
+    directory_scan,
+    export_files,
+    metrics,
+    output_helper,
+    pipeline,
+    scan_state,
+)
 
-batch = []
 counter = 0
-
-zero_byte_file_paths = []
+zero_byte_files = 0
 
 parser = argparse.ArgumentParser(description="Process file system tree.")
 parser.add_argument(
@@ -22,108 +24,33 @@ parser.add_argument(
     type=str,
     help="The directory containing exported NeoFinder files (txt).",
 )
-
-mimetypes.add_type("image/tiff", ".ptif")
-
-
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError("Type %s not serializable" % type(obj))
-
-
-def walk_file_system(current, root_path, output_directory):
-    global batch
-    global counter
-    global zero_byte_file_paths
-
-    subdirs = []
-    try:
-        for f in os.scandir(current):
-            relative_path = f.path[len(root_path) + 1 :]
-            document = {
-                "name": f.name,
-                "path": relative_path,
-                "size_bytes": None,
-                "modified": None,
-                "created": None,
-            }
-
-            try:
-                stats = f.stat()
-
-                document["size_bytes"] = stats.st_size
-
-                try:
-                    document["modified"] = datetime.fromtimestamp(
-                        stats.st_mtime, tz=timezone.utc
-                    )
-                except Exception:
-                    logging.error(
-                        f"Unable to parse modified date {stats.st_mtime} for {f.path}."
-                    )
-
-                try:
-                    document["created"] = datetime.fromtimestamp(
-                        stats.st_ctime, tz=timezone.utc
-                    )
-                except Exception:
-                    logging.error(
-                        f"Unable to parse creation date {stats.st_ctime} for {f.path}."
-                    )
-
-                document["_id"] = relative_path
-
-                if f.is_dir():
-                    subdirs.append(f.path)
-                    document["type"] = "directory"
-                else:
-                    document["type"] = "file"
-
-                    guess = mimetypes.guess_type(f.name, strict=False)
-                    if guess[0]:
-                        document["mime_type"] = guess[0]
-                    else:
-                        try:
-                            guess = filetype.guess(f.path)
-                        except PermissionError:
-                            guess = None
-                        except OSError as e:
-                            logging.error(f"Got exception for {f.path}.")
-                            logging.error(e)
-                            guess = None
-                        if guess:
-                            document["mime_type"] = guess.mime
-
-                    if stats.st_size == 0:
-                        zero_byte_file_paths.append(relative_path)
-
-                batch.append(document)
-                counter += 1
-
-            except FileNotFoundError:
-                if f.is_symlink():
-                    logging.warning(f"Found broken symlink: '{relative_path}'.")
-                else:
-                    logging.error(f"Unknown FileNotFoundError: '{relative_path}'.")
-
-        if len(batch) > 100000:
-            logging.info(f"...processed {counter}, exporting to file.")
-            with open(f"{output_directory}/{counter}_files.json", "w") as f:
-                json.dump(batch, f, default=json_serial)
-
-            batch = []
-
-        for subdir in subdirs:
-            walk_file_system(subdir, root_dir, output_directory)
-
-    except PermissionError:
-        logging.error(f"Got PermissionError for '{current}', ignoring.")
-    except FileNotFoundError as e:
-        logging.error(e)
-        logging.error(
-            f"Got a FileNotFoundError while processing the directory '{current}'."
-        )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of threads scanning directories in parallel, default: 1.",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Only export entries that are new or modified since the last incremental run, "
+    "deleted entries are listed in 'deleted_ids.txt'.",
+)
+directory_scan.add_scan_arguments(parser)
+parser.add_argument(
+    "--no-rollups",
+    action="store_true",
+    help="Do not add the total size, number of files, newest modification time and MIME types "
+    "of their contents to directories.",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue the last interrupted run for this directory from its last checkpoint.",
+)
+export_files.add_output_arguments(parser)
+pipeline.add_index_arguments(parser)
+metrics.add_metrics_arguments(parser)
 
 
 try:
@@ -146,29 +73,233 @@ try:
         )
 
         logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+        metrics.start("export_directory", options)
 
-        output_directory = (
-            f"{output_helper.get_output_base_dir(input_dir_name)}/directory_{input_dir_name}_{now}"
+        # The checkpoint is kept in the database of the incremental scan state, so
+        # both are committed together.
+        state_path = (
+            f"{output_helper.get_state_dir(input_dir_name)}/directory_state.sqlite"
         )
+        run_checkpoint = checkpoint.Checkpoint(state_path)
+
+        resumed = None
+        if options["resume"]:
+            resumed = run_checkpoint.load("run")
+            if resumed is None:
+                logging.info("Found no interrupted run to resume, starting a new run.")
+            elif resumed["root_path"] != os.path.abspath(root_dir):
+                raise Exception(
+                    f"The interrupted run scanned '{resumed['root_path']}', not '{root_dir}'."
+                )
+            else:
+                # Options that change the output are taken from the interrupted run.
+                # Runs of earlier versions did not keep the rollups in checkpoints.
+                options = {
+                    "no_rollups": True,
+                    **resumed["options"],
+                    "workers": options["workers"],
+                    **{key: options[key] for key in directory_scan.IO_OPTIONS},
+                    "resume": True,
+                }
+                logging.info(
+                    f"Resuming the interrupted run after {resumed['counter']} entries."
+                )
+        if resumed is None:
+            run_checkpoint.clear()
+
+        if resumed is not None:
+            output_directory = resumed["output_directory"]
+        else:
+            output_directory = f"{output_helper.get_output_base_dir(input_dir_name)}/directory_{input_dir_name}_{now}"
         try:
             os.makedirs(output_directory)
         except FileExistsError:
             logging.info(f"Output directory {output_directory} already exists.")
 
-        logging.info(f"Scanning {root_dir}")
-        walk_file_system(root_dir, root_dir, output_directory)
-
-        if len(batch) > 0:
-            with open(f"{output_directory}/{counter}_files.json", "w") as f:
-                json.dump(batch, f, default=json_serial)
+        state = None
+        if options["incremental"]:
+            state = scan_state.ScanState(
+                state_path,
+                os.path.abspath(root_dir),
+                resume=resumed is not None,
+                connection=run_checkpoint.connection,
+            )
+            logging.info(f"Running incremental scan #{state.run}.")
+
+        writer = export_files.create_writer(output_directory, "files", options)
+        empty_files_path = f"{output_directory}/empty_files.txt"
+
+        if resumed is not None:
+            counter = resumed["counter"]
+            zero_byte_files = resumed["zero_byte_files"]
+            pending = [
+                (f"{root_dir}/{path}" if path else root_dir, unchanged)
+                for path, unchanged in resumed["pending"]
+            ]
+
+            export_files.remove_unfinished_files(
+                output_directory, resumed["writer"]["files"]
+            )
+            writer.resume(resumed["writer"])
+            os.truncate(empty_files_path, resumed["empty_files_size"])
+            empty_files = open(empty_files_path, "a")
+        else:
+            root_unchanged = False
+            if state is not None:
+                root_stats = os.stat(root_dir)
+                root_unchanged = directory_scan.is_unchanged_directory(
+                    state.lookup(""), root_stats
+                )
+                state.record([scan_state.entry_from_stats("", True, root_stats)])
+
+            pending = [(root_dir, root_unchanged)]
+            empty_files = open(empty_files_path, "w")
+
+        # Directory documents are written once everything below them was scanned.
+        directory_rollups = None
+        if not options["no_rollups"]:
+            directory_rollups = directory_scan.DirectoryRollups(
+                root_dir,
+                state,
+                resumed["rollups"] if resumed is not None else None,
+            )
+        elif state is not None:
+            state.clear_rollups()
+
+        index_pipeline = None
+        if options["index"]:
+            pipeline.create_index(options["index"])
+            index_pipeline = pipeline.create_pipeline(options)
+
+        def save_checkpoint():
+            if index_pipeline is not None:
+                index_pipeline.flush()
+            position = writer.checkpoint(f"{counter}_files")
+            empty_files.flush()
+
+            # Also commits the scan state recorded since the last checkpoint.
+            run_checkpoint.save(
+                "run",
+                {
+                    "root_path": os.path.abspath(root_dir),
+                    "output_directory": output_directory,
+                    "options": options,
+                    "counter": counter,
+                    "zero_byte_files": zero_byte_files,
+                    "empty_files_size": empty_files.tell(),
+                    "writer": position,
+                    "pending": [
+                        [path[len(root_dir) + 1 :], unchanged]
+                        for path, unchanged in pending
+                    ],
+                    "rollups": (
+                        directory_rollups.checkpoint()
+                        if directory_rollups is not None
+                        else None
+                    ),
+                },
+            )
+
+        if resumed is None:
+            save_checkpoint()
+        checkpoint_counter = counter
+
+        logging.info(f"Scanning {root_dir} using {options['workers']} worker(s).")
+        progress_meter = metrics.ProgressMeter("entries")
+        scheduler = directory_scan.create_scheduler(options)
+        hasher = directory_scan.create_hasher(
+            options, output_helper.get_state_dir(input_dir_name), scheduler
+        )
+        sniffer = directory_scan.create_sniffer(
+            options, output_helper.get_state_dir(input_dir_name), scheduler
+        )
 
-            with open(f"{output_directory}/empty_files.txt", "w") as f:
-                data = "\n".join(zero_byte_file_paths)
-                f.write(data)
+        for result in directory_scan.walk_file_system(
+            root_dir,
+            options["workers"],
+            list(pending),
+            state=state,
+            hasher=hasher,
+            sniffer=sniffer,
+            rollup=directory_rollups is not None,
+            scheduler=scheduler,
+        ):
+            # Mirrors the stack of the walk, to know which directories are left.
+            pending.pop()
+            pending.extend(reversed(result.subdirs))
+
+            documents = result.documents
+            if directory_rollups is not None:
+                documents = directory_rollups.add(result)
+
+            for document in documents:
+                writer.write(document)
+                if index_pipeline is not None:
+                    index_pipeline.write(document)
+            counter += len(documents)
+
+            for relative_path in result.zero_byte_paths:
+                if zero_byte_files > 0:
+                    empty_files.write("\n")
+                empty_files.write(relative_path)
+                zero_byte_files += 1
+
+            if state is not None:
+                if result.unchanged is not None:
+                    state.keep_children(result.unchanged)
+                state.record(result.entries)
+                progress_meter.update(len(result.entries))
+            else:
+                progress_meter.update(len(result.documents))
+
+            if counter - checkpoint_counter > 100000:
+                logging.info(f"...processed {counter}, exporting to file.")
+                save_checkpoint()
+                checkpoint_counter = counter
+
+        writer.close(f"{counter}_files")
+        empty_files.close()
+        if index_pipeline is not None:
+            index_pipeline.close()
+
+        if hasher is not None:
+            hasher.close()
+        if sniffer is not None:
+            sniffer.close()
+        if scheduler is not None:
+            scheduler.close()
+
+        if state is not None:
+            # Committed together with the removal of the deleted entries, once they
+            # were also deleted from the index.
+            run_checkpoint.clear(commit=False)
+
+            deleted = 0
+            with open(f"{output_directory}/deleted_ids.txt", "w") as f:
+                for path in state.finish(commit=False):
+                    f.write(f"{path}\n")
+                    deleted += 1
+
+            if index_pipeline is not None:
+                with open(f"{output_directory}/deleted_ids.txt", "r") as f:
+                    index_pipeline.delete(line.rstrip("\n") for line in f)
+            state.commit()
+            logging.info(f"Updated scan state in {state_path}.")
+        else:
+            run_checkpoint.clear()
+        run_checkpoint.close()
 
         logging.info(f"Finished after {round(time.time() - start_time, 2)} seconds.")
         logging.info(f"Processed files {counter} overall.")
-        logging.info(f"Found {len(zero_byte_file_paths)} empty files.")
+        logging.info(f"Found {zero_byte_files} empty files.")
+        if directory_rollups is not None and directory_rollups.root_total is not None:
+            logging.info(
+                f"Found {directory_rollups.root_total['files']} files with "
+                f"{directory_rollups.root_total['size_bytes']} bytes below {root_dir}."
+            )
+        if state is not None:
+            logging.info(f"Found {deleted} deleted entries.")
+        metrics.finish(options)
 
 except Exception as e:
     logging.error("Encountered unhandled exception")
@@ -1,27 +1,32 @@
 import re
-from datetime import date, datetime
+from datetime import datetime
 import dateparser
+import functools
 
 import argparse
+import codecs
+import collections
+import itertools
+import locale
+import logging.handlers
 import mimetypes
+import multiprocessing
+import operator
 import os
+import posixpath
 import sys
 import time
 import logging
-import json
 
-from lib import output_helper
+from concurrent.futures import ProcessPoolExecutor
+
+from lib import checkpoint, export_files, key_index, metrics, output_helper, pipeline
 
 SIZE_PATTERN_PLAIN_BYTE_VALUE = r"^\d+$"
 SIZE_PATTERN_VARIANT_1 = r"^.+\(([\d\.]+) Bytes\)$" # "481,6 KB (481.631 Bytes)"
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
-
+PLAIN_BYTE_VALUE = re.compile(SIZE_PATTERN_PLAIN_BYTE_VALUE)
+SIZE_VARIANT_1 = re.compile(SIZE_PATTERN_VARIANT_1)
 
 HEADING_MAPPING = {
     "name": ["Name"],
@@ -40,14 +45,73 @@ DIRECTORY_VARIANTS = ["Ordner"]
 
 DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%d.%m.%Y", "%d. %A %Y um %H:%M"]
 
+# NeoFinder exports repeat the same timestamps a lot, parsed values are cached by their raw string.
+DATE_CACHE_SIZE = 100000
+
+# MIME types are cached by the last two extensions of a name, see `guess_mime_type`.
+MIME_TYPE_CACHE_SIZE = 10000
+
+# Number of rows passed to `RowDecoder.decode_batch` at once by `process_file`.
+DECODE_BATCH_SIZE = 1000
+
+# Exports are read through a large buffer, which saves most of the read calls of the
+# default 8 KB buffer on multi-GB files.
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Bytes read from the start of an export to detect its encoding, see `detect_encoding`.
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be")
+]
+
+# Tried after the preferred encoding of the system for exports without byte order mark,
+# e.g. of catalogs created by NeoFinder on older Macs.
+CANDIDATE_ENCODINGS = ["utf-8", "mac_roman", "cp1252"]
+
+GERMAN_MONTHS = {
+    "Januar": 1, "Februar": 2, "März": 3, "April": 4, "Mai": 5, "Juni": 6,
+    "Juli": 7, "August": 8, "September": 9, "Oktober": 10, "November": 11, "Dezember": 12
+}
+
+# Precompiled parsers for the DATE_FORMATS above, anything else falls back to dateparser.
+FAST_DATE_PATTERNS = [
+    # "2015-03-04 12:13:14"
+    (re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2}) (\d{1,2}):(\d{1,2}):(\d{1,2})$"),
+        lambda m: datetime(*map(int, m.groups()))),
+    # "04.03.2015"
+    (re.compile(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$"),
+        lambda m: datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))),
+    # "12. März 2015 um 13:45"
+    (re.compile(rf"^(\d{{1,2}})\. ({'|'.join(GERMAN_MONTHS)}) (\d{{4}}) um (\d{{1,2}}):(\d{{1,2}})$"),
+        lambda m: datetime(int(m.group(3)), GERMAN_MONTHS[m.group(2)], int(m.group(1)), int(m.group(4)), int(m.group(5))))
+]
+
 overall_lines = 0
 faulty_lines = 0
 no_date = 0
 
+date_parse_stats = {"empty": 0, "fast_path": 0, "dateparser": 0, "unparsed": 0}
+
+# The key index of an --incremental run, only used by the main process.
+run_keys = None
+
 parser = argparse.ArgumentParser(description='Process NeoFinder export files.')
 parser.add_argument('root_directory', type=str, help="The directory containing exported NeoFinder files (txt).")
-
-def standardize_headings(headings):
+parser.add_argument('--processes', type=int, default=1, help="Number of export files processed in parallel, default: 1.")
+parser.add_argument('--split-size', type=int, default=0, help="With --processes, split export files larger than this many MB into chunks that are processed in parallel, default: 0 (no splitting).")
+parser.add_argument('--stable-ids', action='store_true', help="Derive the document ids from catalog, volume and path instead of export file and row number, so re-imports of a catalog replace its documents.")
+parser.add_argument('--incremental', action='store_true', help="Implies --stable-ids. Only export rows that are new or modified since the last incremental run, rows missing from the exported catalogs are listed in 'deleted_ids.txt'.")
+parser.add_argument('--resume', action='store_true', help="Continue the last interrupted run for this directory from its last checkpoint.")
+parser.add_argument('--encoding', type=str, help="Encoding of the export files, default: detected from the byte order mark and the headings of each file.")
+export_files.add_output_arguments(parser)
+pipeline.add_index_arguments(parser)
+metrics.add_metrics_arguments(parser)
+
+def map_headings(headings):
+    """Returns the headings with the variants in HEADING_MAPPING replaced by their standard name."""
 
     standardized = []
 
@@ -65,6 +129,12 @@ def standardize_headings(headings):
         else:
             standardized.append(heading)
 
+    return standardized
+
+def standardize_headings(headings):
+
+    standardized = map_headings(headings)
+
     if len(HEADING_MAPPING.keys() - standardized) != 0:
         logging.error(" The following column headings were expected but could not be mapped:")
         logging.error(HEADING_MAPPING.keys() - standardized)
@@ -73,173 +143,753 @@ def standardize_headings(headings):
 
     return standardized
 
+def detect_encoding(path, encoding=None):
+    """Returns the encoding of an export and the length of its byte order mark.
+
+    Without a byte order mark, a first line with NUL bytes is taken as UTF-16. Otherwise
+    the preferred encoding of the system and the CANDIDATE_ENCODINGS are tried in turn,
+    the first one the headings can be decoded and mapped with is used. If none fits, the
+    preferred encoding is returned. A given encoding is used as it is.
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_SIZE)
+
+    for (byte_order_mark, byte_order_mark_encoding) in BYTE_ORDER_MARKS:
+        if sample.startswith(byte_order_mark):
+            return (encoding or byte_order_mark_encoding, len(byte_order_mark))
+
+    preferred = locale.getpreferredencoding(False)
+    if encoding:
+        return (encoding, 0)
+
+    first_line = re.split(rb"[\r\n]", sample, maxsplit=1)[0]
+    if b"\x00" in first_line:
+        # ASCII characters have their zero byte first in big endian.
+        return ("utf-16-be" if first_line[0] == 0 else "utf-16-le", 0)
+
+    for candidate in [preferred, *CANDIDATE_ENCODINGS]:
+        try:
+            headings = first_line.decode(candidate).split('\t')
+        except UnicodeDecodeError:
+            continue
+        if len(HEADING_MAPPING.keys() - map_headings(headings)) == 0:
+            return (candidate, 0)
+
+    return (preferred, 0)
+
+def is_ascii_compatible(encoding):
+    return "\t\r\n".encode(encoding) == b"\t\r\n"
+
 def parse_size_in_bytes(neofinder_value):
 
-    if re.match(SIZE_PATTERN_PLAIN_BYTE_VALUE, neofinder_value):
+    if PLAIN_BYTE_VALUE.match(neofinder_value):
         return int(neofinder_value)
 
-    m = re.match(SIZE_PATTERN_VARIANT_1, neofinder_value)
+    m = SIZE_VARIANT_1.match(neofinder_value)
     if m:
         return int(m.group(1).replace('.', ''))
         
     logging.warning(f" Unable to match neofinder size value {neofinder_value}.")
 
-def process_values(values):
-    global no_date
-
-    # Remove all dictionary entries that are not defined as keys in the HEADING_MAPPING above
-    values = dict(filter(lambda item: (item[0] in HEADING_MAPPING.keys()), values.items()))
-
-    modified_standardized = dateparser.parse(values['modified'], date_formats=DATE_FORMATS)
-    if not modified_standardized:
-        if values['modified'] != "-" and values['modified']:
-            logging.info(f" Unable to parse modification date for '{values['path']}': '{values['modified']}'")
-    
-    created_standardized = dateparser.parse(values['created'], date_formats=DATE_FORMATS)
-    if not created_standardized:
-        # Old exports seem to have missing creation dates ('-' values), we fallback to the modified date.
-        if values['created'] != "-" and values['created']:
-            logging.info(f" Unable to parse creation date for '{values['path']}': '{values['created']}'")
-        else:
-            created_standardized = modified_standardized
-
-    values['neofinder_created'] = values["created"]
-    values['neofinder_modified'] = values["modified"]
-
-    if not modified_standardized and not created_standardized:
-        #logging.debug(f" Neither creation nor modification date found for '{values['path']}'.")
-        no_date += 1
-
-    values["created"] = created_standardized
-    values["modified"] = modified_standardized
-
-    values["neofinder_path"] = values["path"]
-    values["path"] = values["path"].lstrip(f"{values['neofinder_catalog']}:") 
-    values["path"] = values["path"].replace(":", "/")
-
-    parsed_value = "unknown"
-    if values["type"] != "":
-        values["neofinder_type"] = values["type"]
-        if values["type"].strip() != "-":
-            if values["type"] in DIRECTORY_VARIANTS:
-                parsed_value = "directory"
-            else: 
-                parsed_value = "file"
-        
-    values["type"] = parsed_value
-
-    values["neofinder_size"] = values["size_bytes"]
-    values["size_bytes"] = parse_size_in_bytes(values["size_bytes"])
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    # Only values missing from the cache are timed.
+    start = time.perf_counter()
+    parsed = parse_uncached_date(value)
+    metrics.observe("date_parse_seconds", time.perf_counter() - start)
+    return parsed
+
+def parse_uncached_date(value):
+    if value == "" or value == "-":
+        date_parse_stats["empty"] += 1
+        return None
+
+    stripped = value.strip()
+    for (pattern, create) in FAST_DATE_PATTERNS:
+        m = pattern.match(stripped)
+        if m:
+            try:
+                parsed = create(m)
+                date_parse_stats["fast_path"] += 1
+                return parsed
+            except ValueError:
+                # Invalid dates like "31.02.2015" are left to dateparser.
+                break
+
+    parsed = dateparser.parse(value, date_formats=DATE_FORMATS)
+    if parsed:
+        date_parse_stats["dateparser"] += 1
+    else:
+        date_parse_stats["unparsed"] += 1
+    return parsed
+
+def get_stats():
+    """Returns the counters of this process, the date parse tiers are prefixed with 'date_'."""
+
+    stats = {
+        "overall_lines": overall_lines,
+        "faulty_lines": faulty_lines,
+        "no_date": no_date,
+        "date_from_cache": parse_date.cache_info().hits
+    }
+    for (tier, count) in date_parse_stats.items():
+        stats[f"date_{tier}"] = count
+
+    return stats
+
+def log_date_parse_stats(stats):
+    tiers = {key[len("date_"):]: value for (key, value) in stats.items() if key.startswith("date_")}
+    total = sum(tiers.values())
+    if total == 0:
+        return
+
+    logging.info(f"  Parsed {total} date values:")
+    for (tier, count) in tiers.items():
+        logging.info(f"    {count} ({round(count / total * 100, 1)}%) {tier.replace('_', ' ')}")
+
+def guess_mime_type(name):
+    """Returns the same as `mimetypes.guess_type(name, strict=False)[0]`.
+
+    The guess only depends on the last extension of a name, and on the one before if the
+    last is an encoding like '.gz'. Names with ':' are parsed like URLs by mimetypes and
+    are not cached.
+    """
+    if ":" in name or "/" in name:
+        return mimetypes.guess_type(name, strict=False)[0]
+
+    (base, extension) = posixpath.splitext(name)
+    return guess_mime_type_by_extensions(posixpath.splitext(base)[1], extension)
+
+@functools.lru_cache(maxsize=MIME_TYPE_CACHE_SIZE)
+def guess_mime_type_by_extensions(previous_extension, extension):
+    return mimetypes.guess_type(f"x{previous_extension}{extension}", strict=False)[0]
+
+class RowDecoder:
+    """Creates the documents of the data rows of an export.
+
+    The columns of the fields in HEADING_MAPPING are looked up once from the standardized
+    headings, all other columns are left out. Like for a dict of all headings, the last
+    of several columns with the same heading is used.
+    """
+
+    def __init__(self, headings):
+        columns = {}
+        for (index, heading) in enumerate(headings):
+            if heading in HEADING_MAPPING:
+                columns[heading] = index
+
+        self.keys = list(columns)
+        self.get_values = operator.itemgetter(*columns.values())
+
+    def decode(self, values):
+        return self.decode_batch([values])[0]
+
+    def decode_batch(self, rows):
+        """Returns the documents for an iterable of rows, each a list with one value per heading."""
+        global no_date
+
+        keys = self.keys
+        get_values = self.get_values
+        documents = []
+        for row in rows:
+            values = dict(zip(keys, get_values(row)))
+
+            modified = values["modified"]
+            modified_standardized = parse_date(modified)
+            if not modified_standardized and modified != "-" and modified:
+                logging.info(f" Unable to parse modification date for '{values['path']}': '{modified}'")
+
+            created = values["created"]
+            created_standardized = parse_date(created)
+            if not created_standardized:
+                # Old exports seem to have missing creation dates ('-' values), we fallback to the modified date.
+                if created != "-" and created:
+                    logging.info(f" Unable to parse creation date for '{values['path']}': '{created}'")
+                else:
+                    created_standardized = modified_standardized
+
+            values["neofinder_created"] = created
+            values["neofinder_modified"] = modified
+
+            if not modified_standardized and not created_standardized:
+                no_date += 1
+
+            values["created"] = created_standardized
+            values["modified"] = modified_standardized
+
+            path = values["path"]
+            values["neofinder_path"] = path
+            values["path"] = path.lstrip(f"{values['neofinder_catalog']}:").replace(":", "/")
+
+            neofinder_type = values["type"]
+            parsed_value = "unknown"
+            if neofinder_type != "":
+                values["neofinder_type"] = neofinder_type
+                if neofinder_type.strip() != "-":
+                    if neofinder_type in DIRECTORY_VARIANTS:
+                        parsed_value = "directory"
+                    else:
+                        parsed_value = "file"
+
+            values["type"] = parsed_value
+
+            values["neofinder_size"] = values["size_bytes"]
+            values["size_bytes"] = parse_size_in_bytes(values["size_bytes"])
+
+            mime_type = guess_mime_type(values["name"])
+            if mime_type:
+                values["mime_type"] = mime_type
+
+            documents.append(values)
+
+        return documents
+
+
+def init_worker(log_queue):
+    # Log records of the worker processes are merged into the log of the main process.
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+    # Forked workers start with a copy of the metrics of the main process.
+    metrics.reset()
+
+def process_file_in_worker(path, output_directory, output_options, checkpoint_path=None, position=None):
+    """Runs `process_file` in a worker process and returns the counters and metrics it added."""
 
-    guessed_mimetype = mimetypes.guess_type(values["name"], strict=False)
-    if guessed_mimetype[0]:
-        values["mime_type"] = guessed_mimetype[0]
-
-    return values
+    before = get_stats()
+    try:
+        logging.info(f"Processing file '{os.path.basename(path)}'.")
+        start_time_file = time.time()
+        index_pipeline = pipeline.create_pipeline(output_options)
+        process_file(path, output_directory, output_options, checkpoint_path, position, index_pipeline)
+        if index_pipeline is not None:
+            index_pipeline.close()
+        logging.info(f"Processed file '{os.path.basename(path)}' in {round(time.time() - start_time_file, 2)} seconds.\n")
+    except Exception as e:
+        logging.error(f"Error when processing file '{os.path.basename(path)}'.")
+        logging.error(e)
+        logging.error("")
+
+    stats = {key: value - before[key] for (key, value) in get_stats().items()}
+    stats["metrics"] = metrics.drain()
+    return stats
+
+def iterate_rows(read_line, headings, found_first_data_row=False, stop_before=None):
+    """Yields the values of all data rows read with `read_line`.
+
+    Rows that were broken into several lines are recombined. If given, `stop_before` is
+    called with the current value of `found_first_data_row` whenever a line was read
+    while no row is being recombined, the iteration stops if it returns True.
+    """
+    global faulty_lines
 
+    found_faulty_line = False
 
-def process_file(path, output_directory):
-    global overall_lines
-    global faulty_lines
+    expect_two_values_next = False
 
-    batch_size = 100000
+    next_line = read_line()
+    recombined = False
+    while(next_line):
 
-    with open(path, 'r') as csv_file:
-        line = csv_file.readline()
-        headings = line.split('\t')
+        if stop_before is not None and not recombined and not expect_two_values_next:
+            if stop_before(found_first_data_row):
+                return
+        recombined = False
 
-        headings = standardize_headings(headings)
+        values = next_line.split('\t')
 
-        line_counter = 0
-        batch = []
-        found_first_data_row = False
-        found_faulty_line = False
+        #logging.debug(f"{len(values)} <> {len(headings)}")
+        #logging.debug(values)
+        #logging.debug(next_line)
+        if len(values) == len(headings) and not expect_two_values_next:
+            if found_faulty_line:
+                #logging.debug("Faulty line fixed.\n")
+                found_faulty_line = False
 
-        expect_two_values_next = False
+            found_first_data_row = True
+            values[-1] = values[-1].strip() # remove newline character '\n'
 
-        next_line = csv_file.readline()
-        while(next_line):
+            yield values
 
-            values = next_line.split('\t')
+            next_line = read_line()
 
-            #logging.debug(f"{len(values)} <> {len(headings)}")
-            #logging.debug(values)
-            #logging.debug(next_line)
-            if len(values) == len(headings) and not expect_two_values_next:
-                if found_faulty_line:
-                    #logging.debug("Faulty line fixed.\n")
-                    found_faulty_line = False
+        elif len(values) < len(headings) and found_first_data_row and next_line != "":
 
-                found_first_data_row = True
-                values[-1] = values[-1].strip() # remove newline character '\n'
+            if headings[len(values) - 2].strip() == "Beschreibung:":
+                #logging.debug("Expecting two.")
+                expect_two_values_next = True
+                next_line.replace("\t", "", -1)
 
-                processed = process_values(dict(zip(headings, values)))
-                # Using path as id caused issues because some path are longer than 512
-                # thus too long for OpenSearch document ids.
-                processed["_id"] = f"{os.path.basename(path)}-{line_counter}"
-                processed["neofinder_export_file"] = os.path.basename(path)
-                batch.append(processed)
+            sanitized = next_line.strip('\n')
+            #logging.debug("Possible faulty new line in data row:")
+            #logging.debug(f"'{sanitized}'")
 
-                line_counter += 1
-                if len(batch) == batch_size:
-                    with open(f"{output_directory}/{os.path.basename(path)}_{line_counter}.json", 'w') as f:
-                        json.dump(batch, f, default=json_serial)
-                    batch = []
-                    logging.info(f" ...processed {line_counter} rows.")
+            preview_new_line = read_line()
+            if preview_new_line == "":
+                logging.error("Unexpected end of file, last line was:")
+                logging.error(sanitized)
+                break
 
-                next_line = csv_file.readline()
 
-            elif len(values) < len(headings) and found_first_data_row and next_line != "":
+            if len(values) == 2 and expect_two_values_next:
+                preview_new_line = preview_new_line.replace("\t", "")
+            elif expect_two_values_next:
+                #logging.debug(preview_new_line)
+                preview_new_line = preview_new_line.replace("\t", "", 2).strip("\n")
+                #logging.debug(preview_new_line)
+                expect_two_values_next = False
 
-                if headings[len(values) - 2].strip() == "Beschreibung:":
-                    #logging.debug("Expecting two.")
-                    expect_two_values_next = True
-                    next_line.replace("\t", "", -1)
+            next_line = f"{sanitized}{preview_new_line}"
+            recombined = True
 
-                sanitized = next_line.strip('\n')
-                #logging.debug("Possible faulty new line in data row:")
-                #logging.debug(f"'{sanitized}'")
+            #logging.debug("Recombined with following line to:")
+            #logging.debug(f"'{next_line}'")
 
-                preview_new_line = csv_file.readline()
-                if preview_new_line == "":
-                    logging.error("Unexpected end of file, last line was:")
-                    logging.error(sanitized)
-                    break
+            found_faulty_line = True
 
+        elif len(values) > len(headings):
+            logging.error("Failed to fix row, ended up with more data columns than headings:")
+            logging.error(f"'{next_line}'")
 
-                if len(values) == 2 and expect_two_values_next:
-                    preview_new_line = preview_new_line.replace("\t", "")
-                elif expect_two_values_next:
-                    #logging.debug(preview_new_line)
-                    preview_new_line = preview_new_line.replace("\t", "", 2).strip("\n")
-                    #logging.debug(preview_new_line)
-                    expect_two_values_next = False
+            next_line = read_line()
+            faulty_lines += 1
 
-                next_line = f"{sanitized}{preview_new_line}"
-                
-                #logging.debug("Recombined with following line to:")
-                #logging.debug(f"'{next_line}'")
+        else:
+            next_line = read_line()
+
+def add_export_file_fields(processed, path, line_counter, stable_ids=False):
+    if stable_ids:
+        processed["_id"] = key_index.create_stable_id(processed.get("neofinder_catalog", ""), processed.get("neofinder_volume", ""), processed["neofinder_path"])
+    else:
+        # Using path as id caused issues because some path are longer than 512
+        # thus too long for OpenSearch document ids.
+        processed["_id"] = f"{os.path.basename(path)}-{line_counter}"
+    processed["neofinder_export_file"] = os.path.basename(path)
+
+def is_exported(processed):
+    """Checks a row against the key index of an --incremental run, see `KeyIndex.add`."""
+
+    return run_keys is None or run_keys.add(processed)
+
+def discard_uncommitted_keys():
+    # Files are processed one after another by the main process, the keys recorded since
+    # the last checkpoint all belong to the failed file. Resuming processes them again.
+    if run_keys is not None:
+        run_keys.rollback()
+
+def save_file_checkpoint(checkpoint_path, path, position):
+    """Stores how far an export file was processed, see `process_file` for the position."""
+
+    if checkpoint_path is None:
+        return
+
+    if run_keys is not None:
+        # Committed together with the keys of the rows written so far.
+        checkpoint.Checkpoint(connection=run_keys.connection).save(f"file:{os.path.basename(path)}", position)
+        return
+
+    file_checkpoint = checkpoint.Checkpoint(checkpoint_path)
+    file_checkpoint.save(f"file:{os.path.basename(path)}", position)
+    file_checkpoint.close()
+
+def process_file(path, output_directory, output_options=None, checkpoint_path=None, position=None, index_pipeline=None, progress_meter=None):
+    """Processes a single export file.
+
+    If given, the documents are also passed to `index_pipeline` and the rows and
+    characters read are counted by `progress_meter`. If a checkpoint path
+    is given, a checkpoint is saved whenever a batch was written.
+    Processing continues from `position`, the last checkpoint of an interrupted run:
+    the rows starting at byte `offset` are parsed, the first `skip` of them were already
+    written before.
+    """
+    global overall_lines
 
-                found_faulty_line = True
+    batch_size = 100000
+    stable_ids = bool(output_options and output_options.get("stable_ids"))
+    writer = export_files.create_writer(output_directory, os.path.basename(path), output_options)
 
-            elif len(values) > len(headings):
-                logging.error("Failed to fix row, ended up with more data columns than headings:")
-                logging.error(f"'{next_line}'")
+    (encoding, header_start) = detect_encoding(path, output_options.get("encoding") if output_options else None)
+    if encoding != locale.getpreferredencoding(False) or header_start > 0:
+        logging.info(f" Reading '{os.path.basename(path)}' as {encoding}{' with byte order mark' if header_start > 0 else ''}.")
 
-                next_line = csv_file.readline()
-                faulty_lines += 1
+    with open(path, 'r', encoding=encoding, buffering=READ_BUFFER_SIZE) as csv_file:
+        csv_file.seek(header_start)
+        line = csv_file.readline()
+        headings = line.split('\t')
 
-            else:
-                next_line = csv_file.readline()
+        headings = standardize_headings(headings)
+        decoder = RowDecoder(headings)
 
-        
-        if len(batch) > 0:
-            with open(f"{output_directory}/{os.path.basename(path)}_{line_counter}.json", 'w') as f:
-                json.dump(batch, f, default=json_serial)
+        line_counter = 0
+        found_first_data_row = False
+        skip = 0
+        if position is not None:
+            writer.resume(position["writer"])
+            line_counter = position["line_counter"]
+            found_first_data_row = position["found_first_data_row"]
+            skip = position["skip"]
+            csv_file.seek(position["offset"])
+            logging.info(f" Resuming after {line_counter} rows.")
+
+        read_line = csv_file.readline
+        if progress_meter is not None:
+            def read_line():
+                line = csv_file.readline()
+                progress_meter.update(0, len(line))
+                return line
+
+        rows = iterate_rows(read_line, headings, found_first_data_row)
+        for _ in itertools.islice(rows, skip):
+            pass
+
+        while True:
+            # Batches end at the next checkpoint, the file is not read beyond their last row.
+            rows_in_batch = min(DECODE_BATCH_SIZE, batch_size - line_counter % batch_size)
+            decoded = decoder.decode_batch(itertools.islice(rows, rows_in_batch))
+            if not decoded:
+                break
+
+            for processed in decoded:
+                add_export_file_fields(processed, path, line_counter, stable_ids)
+                if is_exported(processed):
+                    writer.write(processed)
+                    if index_pipeline is not None:
+                        index_pipeline.write(processed)
+                line_counter += 1
+            if progress_meter is not None:
+                progress_meter.update(len(decoded))
+
+            if line_counter % batch_size == 0:
+                if index_pipeline is not None:
+                    index_pipeline.flush()
+                # The next row starts at the current position of the file.
+                save_file_checkpoint(checkpoint_path, path, {
+                    "writer": writer.checkpoint(f"{os.path.basename(path)}_{line_counter}"),
+                    "line_counter": line_counter,
+                    "offset": csv_file.tell(),
+                    "found_first_data_row": True,
+                    "skip": 0
+                })
+                logging.info(f" ...processed {line_counter} rows.")
+
+        writer.close(f"{os.path.basename(path)}_{line_counter}")
+        if index_pipeline is not None:
+            index_pipeline.flush()
+        save_file_checkpoint(checkpoint_path, path, {"done": True, "writer": {"files": writer.files}})
 
         logging.info(f"Finished processing '{path}', processed {line_counter} rows.")
         overall_lines += line_counter
 
+def split_file(path, encoding, split_size, start=None, header_start=0):
+    """Splits a large export into byte ranges for `process_chunk`.
+
+    Returns the headings and a list of (start, end) pairs, or None if the file can not be
+    split. Ranges start at a line with exactly one value per heading, which is almost
+    always the start of a row. `process_chunk_results` fixes up the rare other cases.
+    If given, the first range begins at `start` instead of the first data row.
+    The headings are read from `header_start`, the end of the byte order mark.
+    """
+    # Lines are split at b'\n', which only works for encodings like UTF-8 (not UTF-16).
+    if not is_ascii_compatible(encoding):
+        return None
+
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        # Chunks are split at '\n', exports with old Mac line endings ('\r' only) are
+        # processed as a whole in text mode. This is checked first, as reading the
+        # headings of such a file would read all of it. A lone '\r' further on is
+        # handled by `process_chunk` like text mode does.
+        f.seek(header_start)
+        sample = f.read(1024 * 1024)
+        if b'\r' in sample.replace(b'\r\n', b''):
+            return None
+
+        f.seek(header_start)
+        headings = standardize_headings(f.readline().decode(encoding).split('\t'))
+        if start is not None:
+            f.seek(start)
+        data_start = f.tell()
+
+        file_size = os.path.getsize(path)
+        starts = [data_start]
+        offset = data_start + split_size
+        while offset < file_size:
+            f.seek(offset)
+            f.readline() # skip the partial line
+            line_start = f.tell()
+            line = f.readline()
+            while line and line.count(b'\t') != len(headings) - 1:
+                line_start = f.tell()
+                line = f.readline()
+
+            if not line:
+                break
+            if line_start > starts[-1]:
+                starts.append(line_start)
+            offset = line_start + split_size
+
+    return (headings, list(zip(starts, starts[1:] + [file_size])))
+
+# A line as split by text mode with universal newlines, ending in '\r\n', '\r' or '\n'.
+UNIVERSAL_LINE = re.compile(rb'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+def decode_line(line, encoding):
+    """Decodes a line and translates its line ending to '\n', as text mode does."""
+    text = line.decode(encoding)
+    if text.endswith('\r\n'):
+        return text[:-2] + '\n'
+    if text.endswith('\r'):
+        return text[:-1] + '\n'
+    return text
+
+def process_chunk(path, encoding, headings, start, end, found_first_data_row):
+    """Processes the rows of an export starting in the byte range [start, end).
+
+    The last row may extend beyond `end`, the returned stop offset and parser state
+    show where the following chunk has to start. Documents are returned without
+    `_id`, as the row numbers depend on the preceding chunks.
+    """
+    before = get_stats()
+
+    stop = None
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        f.seek(start)
+        line_start = start
+        # (offset, line) pairs of the lines after a lone '\r' in the last line read.
+        pending = collections.deque()
+
+        def read_line():
+            # Same as reading in text mode with universal newlines.
+            nonlocal line_start
+            if not pending:
+                offset = f.tell()
+                data = f.readline()
+                if b'\r' not in data.removesuffix(b'\n').removesuffix(b'\r'):
+                    line_start = offset
+                    return decode_line(data, encoding)
+
+                for line in UNIVERSAL_LINE.findall(data):
+                    pending.append((offset, line))
+                    offset += len(line)
+            (line_start, line) = pending.popleft()
+            return decode_line(line, encoding)
+
+        def stop_before(found_first):
+            nonlocal stop
+            if line_start >= end:
+                stop = (line_start, found_first)
+                return True
+            return False
+
+        documents = RowDecoder(headings).decode_batch(iterate_rows(read_line, headings, found_first_data_row, stop_before))
+
+    if stop is None:
+        # Reached the end of file
+        stop = (os.path.getsize(path), True)
+
+    stats = {key: value - before[key] for (key, value) in get_stats().items()}
+    stats["metrics"] = metrics.drain()
+    return (documents, stop, stats)
+
+def generate_tasks(executor, file_list, output_directory, options, checkpoint_path=None, positions=None):
+    """Submits the work for all export files, yields (task, future) pairs in file order.
+
+    A task is either a whole file processed by `process_file_in_worker` or a chunk of a
+    large file processed by `process_chunk`. Files with a position from an interrupted
+    run continue from there. With --incremental, the rows are checked against the key
+    index by this process, so all files are processed in chunks and files that can not
+    be split are left to this process as "local" tasks.
+    """
+    positions = positions or {}
+    split_size = options["split_size"] * 1024 * 1024
+
+    for f in file_list:
+        position = positions.get(f.name)
+        file_size = os.path.getsize(f.path)
+
+        split = None
+        # Offsets of a text mode reader can carry decoder state beyond the file size,
+        # those files are continued as a whole.
+        if (options.get("incremental") or (split_size > 0 and file_size > split_size)) and (position is None or position["offset"] <= file_size):
+            try:
+                (encoding, header_start) = detect_encoding(f.path, options.get("encoding"))
+                split = split_file(f.path, encoding, split_size or file_size, position["offset"] if position else None, header_start)
+            except Exception as e:
+                logging.error(f"Error when processing file '{f.name}'.")
+                logging.error(e)
+                logging.error("")
+                yield ({"type": "failed"}, None)
+                continue
+
+        if split is None and options.get("incremental"):
+            yield ({"type": "local", "path": f.path, "position": position}, None)
+            continue
+
+        if split is None:
+            yield ({"type": "file", "path": f.path}, executor.submit(process_file_in_worker, f.path, output_directory, options, checkpoint_path, position))
+            continue
+
+        (headings, chunks) = split
+        logging.info(f"Processing file '{f.name}' in {len(chunks)} chunks.")
+        for (index, (start, end)) in enumerate(chunks):
+            found_first_data_row = index > 0 or (position is not None and position["found_first_data_row"])
+            task = {
+                "type": "chunk",
+                "path": f.path,
+                "encoding": encoding,
+                "headings": headings,
+                "start": start,
+                "end": end,
+                "found_first_data_row": found_first_data_row,
+                "first": index == 0,
+                "last": index == len(chunks) - 1,
+                "position": position if index == 0 else None
+            }
+            yield (task, executor.submit(process_chunk, f.path, encoding, headings, start, end, found_first_data_row))
+
+def process_files_in_parallel(file_list, output_directory, options, checkpoint_path=None, positions=None, index_pipeline=None, progress_meter=None):
+    """Processes the export files in a process pool, returns the number of files and the summed up counters.
+
+    The metrics of the workers are added to the ones of this process. If given,
+    `progress_meter` is updated whenever a file or chunk is done.
+    """
+    positions = positions or {}
+
+    batch_size = 100000
+
+    file_counter = 0
+    stats = {key: 0 for key in get_stats()}
+
+    def add_stats(task_stats):
+        metrics.merge(task_stats.pop("metrics"))
+        for (key, value) in task_stats.items():
+            stats[key] += value
+
+    # Forked workers would share the open connections of the OpenSearch client with this process.
+    context = multiprocessing.get_context("spawn" if options["index"] else None)
+
+    log_queue = context.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers)
+    log_listener.start()
+
+    with ProcessPoolExecutor(max_workers=options["processes"], mp_context=context, initializer=init_worker, initargs=(log_queue,)) as executor:
+        tasks = generate_tasks(executor, file_list, output_directory, options, checkpoint_path, positions)
+
+        # Only a few tasks are submitted ahead, so finished chunks waiting to be written
+        # don't pile up in memory.
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(task)
+            if len(pending) >= options["processes"] * 2:
+                break
+
+        current = None
+        while pending:
+            (task, future) = pending.popleft()
+            next_task = next(tasks, None)
+            if next_task is not None:
+                pending.append(next_task)
+
+            if task["type"] == "failed":
+                file_counter += 1
+                continue
+
+            if task["type"] == "local":
+                before = get_stats()
+                try:
+                    logging.info(f"Processing file '{os.path.basename(task['path'])}'.")
+                    process_file(task["path"], output_directory, options, checkpoint_path, task["position"], index_pipeline, progress_meter)
+                except Exception as e:
+                    logging.error(f"Error when processing file '{os.path.basename(task['path'])}'.")
+                    logging.error(e)
+                    logging.error("")
+                    discard_uncommitted_keys()
+                for (key, value) in get_stats().items():
+                    stats[key] += value - before[key]
+                file_counter += 1
+                continue
+
+            if task["type"] == "file":
+                task_stats = future.result()
+                add_stats(task_stats)
+                if progress_meter is not None:
+                    progress_meter.update(task_stats["overall_lines"], os.path.getsize(task["path"]))
+                file_counter += 1
+                continue
+
+            path = task["path"]
+            skip = 0
+            if task["first"]:
+                current = {
+                    "writer": export_files.create_writer(output_directory, os.path.basename(path), options),
+                    "line_counter": 0,
+                    "expected": (task["start"], task["found_first_data_row"]),
+                    "failed": False
+                }
+                if task["position"] is not None:
+                    current["writer"].resume(task["position"]["writer"])
+                    current["line_counter"] = task["position"]["line_counter"]
+                    skip = task["position"]["skip"]
+
+            if not current["failed"]:
+                try:
+                    (documents, stop, chunk_stats) = future.result()
+                    add_stats(chunk_stats)
+
+                    if (task["start"], task["found_first_data_row"]) != current["expected"]:
+                        # The previous chunk did not end where this one started (e.g. a broken
+                        # row spanning the boundary), redo this chunk from where it ended.
+                        (documents, stop, chunk_stats) = process_chunk(
+                            path, task["encoding"], task["headings"], current["expected"][0],
+                            task["end"], current["expected"][1]
+                        )
+                        add_stats(chunk_stats)
+
+                    chunk_start = current["expected"]
+                    for (index, processed) in enumerate(documents[skip:], skip):
+                        add_export_file_fields(processed, path, current["line_counter"], options.get("stable_ids"))
+                        if is_exported(processed):
+                            current["writer"].write(processed)
+                            if index_pipeline is not None:
+                                index_pipeline.write(processed)
+
+                        current["line_counter"] += 1
+                        if current["line_counter"] % batch_size == 0:
+                            if index_pipeline is not None:
+                                index_pipeline.flush()
+                            # Resuming redoes this chunk and skips the rows written so far.
+                            save_file_checkpoint(checkpoint_path, path, {
+                                "writer": current["writer"].checkpoint(f"{os.path.basename(path)}_{current['line_counter']}"),
+                                "line_counter": current["line_counter"],
+                                "offset": chunk_start[0],
+                                "found_first_data_row": chunk_start[1],
+                                "skip": index + 1
+                            })
+                            logging.info(f" ...processed {current['line_counter']} rows of '{os.path.basename(path)}'.")
+
+                    current["expected"] = stop
+                    if progress_meter is not None:
+                        progress_meter.update(len(documents) - skip, task["end"] - task["start"])
+                except Exception as e:
+                    logging.error(f"Error when processing file '{os.path.basename(path)}'.")
+                    logging.error(e)
+                    logging.error("")
+                    discard_uncommitted_keys()
+                    current["failed"] = True
+
+            if task["last"]:
+                if not current["failed"]:
+                    current["writer"].close(f"{os.path.basename(path)}_{current['line_counter']}")
+                    if index_pipeline is not None:
+                        index_pipeline.flush()
+                    save_file_checkpoint(checkpoint_path, path, {"done": True, "writer": {"files": current["writer"].files}})
+                    logging.info(f"Finished processing '{path}', processed {current['line_counter']} rows.")
+                    stats["overall_lines"] += current["line_counter"]
+                file_counter += 1
+
+    log_listener.stop()
+
+    return (file_counter, stats)
+
 if __name__ == '__main__':
 
     options = vars(parser.parse_args())
@@ -259,13 +909,57 @@ if __name__ == '__main__':
     )
 
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    metrics.start("export_neofinder", options)
+
+    checkpoint_path = f"{output_helper.get_state_dir(input_dir_name)}/neofinder_checkpoint.sqlite"
+    run_checkpoint = checkpoint.Checkpoint(checkpoint_path)
+
+    resumed = None
+    if options["resume"]:
+        resumed = run_checkpoint.load("run")
+        if resumed is None:
+            logging.info("Found no interrupted run to resume, starting a new run.")
+        elif resumed["root_path"] != os.path.abspath(root_path):
+            raise Exception(f"The interrupted run processed '{resumed['root_path']}', not '{root_path}'.")
+        else:
+            # Options that change the output are taken from the interrupted run.
+            options = {**resumed["options"], "processes": options["processes"], "split_size": options["split_size"], "resume": True}
+
+    if options.get("incremental"):
+        options["stable_ids"] = True
+
+    positions = {}
+    if resumed is None:
+        output_directory = f"{output_helper.get_output_base_dir()}/{input_dir_name}_{now}"
+        run_checkpoint.clear(commit=False)
+        run_checkpoint.save("run", {
+            "root_path": os.path.abspath(root_path),
+            "output_directory": output_directory,
+            "options": options
+        })
+    else:
+        output_directory = resumed["output_directory"]
+        for (key, position) in run_checkpoint.load_all().items():
+            if key.startswith("file:"):
+                positions[key[len("file:"):]] = position
 
-    output_directory = f"{output_helper.get_output_base_dir()}/{input_dir_name}_{now}"
     try:
         os.mkdir(output_directory)
     except FileExistsError:
         logging.info(f"Output directory {output_directory} already exists.")
 
+    if options.get("incremental"):
+        # The key index is kept in the database of the checkpoint, so both are committed together.
+        run_keys = key_index.KeyIndex(checkpoint_path, resume=resumed is not None, connection=run_checkpoint.connection)
+        logging.info(f"Running incremental export #{run_keys.run}.")
+
+    if resumed is not None:
+        logging.info(f"Resuming the interrupted run in {output_directory}.")
+        export_files.remove_unfinished_files(
+            output_directory,
+            [name for position in positions.values() for name in position["writer"]["files"]]
+        )
+
     file_list = []
     for f in os.scandir(root_path):
         if f.is_file() and f.name.endswith('.txt'):
@@ -277,23 +971,79 @@ if __name__ == '__main__':
     for f in file_list:
         logging.info(f.path)
 
+    finished = [f for f in file_list if positions.get(f.name, {}).get("done")]
+    if finished:
+        logging.info(f"Skipping {len(finished)} file(s) finished by the interrupted run.")
+        file_list = [f for f in file_list if f not in finished]
+
+    index_pipeline = None
+    if options["index"]:
+        pipeline.create_index(options["index"])
+        index_pipeline = pipeline.create_pipeline(options)
+
+    # The ETA is based on the size of the input files.
+    progress_meter = metrics.ProgressMeter("rows", total=sum(os.path.getsize(f.path) for f in file_list))
+
     file_counter = 0
-    for f in file_list:
-        try:
-            logging.info(f"Processing file '{f.name}'.")
-            start_time_file = time.time()
-            process_file(f.path, output_directory)
-            logging.info(f"Processed file in {round(time.time() - start_time_file, 2)} seconds.\n")
-        except Exception as e:
-            logging.error(f"Error when processing file '{f.name}'.")
-            logging.error(e)
-            logging.error("")
-        
-        file_counter += 1
+    if options["processes"] > 1:
+        (file_counter, stats) = process_files_in_parallel(file_list, output_directory, options, checkpoint_path, positions, index_pipeline, progress_meter)
+    else:
+        for f in file_list:
+            try:
+                logging.info(f"Processing file '{f.name}'.")
+                start_time_file = time.time()
+                process_file(f.path, output_directory, options, checkpoint_path, positions.get(f.name), index_pipeline, progress_meter)
+                logging.info(f"Processed file in {round(time.time() - start_time_file, 2)} seconds.\n")
+            except Exception as e:
+                logging.error(f"Error when processing file '{f.name}'.")
+                logging.error(e)
+                logging.error("")
+                discard_uncommitted_keys()
+
+            file_counter += 1
+
+        stats = get_stats()
+
+    if index_pipeline is not None:
+        index_pipeline.close()
 
     logging.info("####################################################################################")
     logging.info(f"Finished after {round(time.time() - start_time, 2)} seconds.")
-    logging.info(f"  Processed {file_counter} input files with {overall_lines} rows.")
-    logging.info(f"  Exported {no_date} rows without creation/modification date.")
-    if faulty_lines > 0:
-        logging.warning(f"  Encountered {faulty_lines} unfixable faulty rows, please check the input the CSV.")
+    logging.info(f"  Processed {file_counter} input files with {stats['overall_lines']} rows.")
+    logging.info(f"  Exported {stats['no_date']} rows without creation/modification date.")
+    log_date_parse_stats(stats)
+    if stats['faulty_lines'] > 0:
+        logging.warning(f"  Encountered {stats['faulty_lines']} unfixable faulty rows, please check the input the CSV.")
+
+    unfinished = [
+        f for f in file_list
+        if not (run_checkpoint.load(f"file:{f.name}") or {}).get("done")
+    ]
+    if run_keys is not None:
+        counts = run_keys.counts
+        logging.info(f"  Found {counts['new']} new, {counts['modified']} modified, {counts['unchanged']} unchanged and {counts['duplicate']} duplicate rows.")
+
+    if unfinished:
+        logging.warning(f"  {len(unfinished)} file(s) could not be processed, run with --resume to retry them.")
+    elif run_keys is not None:
+        # Committed together with the removal of the deleted rows, once they were also
+        # deleted from the index.
+        run_checkpoint.clear(commit=False)
+
+        deleted = 0
+        with open(f"{output_directory}/deleted_ids.txt", "w") as f:
+            for deleted_id in run_keys.finish(commit=False):
+                f.write(f"{deleted_id}\n")
+                deleted += 1
+        logging.info(f"  Found {deleted} deleted rows.")
+
+        if index_pipeline is not None:
+            with open(f"{output_directory}/deleted_ids.txt", "r") as f:
+                index_pipeline.delete(line.rstrip("\n") for line in f)
+        run_keys.commit()
+        logging.info(f"Updated key index in {checkpoint_path}.")
+    else:
+        run_checkpoint.clear()
+    run_checkpoint.close()
+
+    metrics.finish(options)
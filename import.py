@@ -1,21 +1,84 @@
 
 from datetime import date, datetime
 import argparse
-import json
+import collections
 import os
 import sys
 import logging
-from lib import open_search, output_helper
+from lib import checkpoint, export_files, metrics, open_search, output_helper, pipeline, serializer
 import time
 
 parser = argparse.ArgumentParser(description='Index result files preprocessed by "index_neofinder.py" or "index_directory.py".')
 parser.add_argument('index_name', type=str, help="The index the data should be imported to.")
 parser.add_argument('root_directory', type=str, help="The directory containing preprocessed files (json).")
 parser.add_argument('--clear', action='store_true',  dest='clear', help="Clear existing index if found, optional.")
+parser.add_argument('--bulk-load', action='store_true', dest='bulk_load', help="Disable refreshes and replicas during the import and restore them afterwards, optional.")
+parser.add_argument('--force-merge', action='store_true', dest='force_merge', help="Force merge the index into a single segment after a bulk load, optional.")
+pipeline.add_bulk_arguments(parser)
+serializer.add_serializer_argument(parser)
+metrics.add_metrics_arguments(parser)
+parser.add_argument('--resume', action='store_true', help="Continue the last interrupted or failed import of this directory, only documents that were not acknowledged yet are sent.")
 
 
 options = vars(parser.parse_args())
 
+# The progress of the import for each file: the positions of all acknowledged documents
+# and the number of documents, once the file was read completely.
+progress = collections.defaultdict(lambda: {"acknowledged": checkpoint.RangeSet(), "count": None})
+
+def is_imported(name):
+    file_progress = progress[name]
+    return file_progress["count"] is not None and file_progress["acknowledged"].covers(0, file_progress["count"])
+
+def skip_acknowledged(name, items):
+    """Yields ((name, position), item) pairs for all items that were not acknowledged before."""
+
+    file_progress = progress[name]
+    position = -1
+    for (position, item) in enumerate(items):
+        if position not in file_progress["acknowledged"]:
+            yield ((name, position), item)
+    file_progress["count"] = position + 1
+
+def tag_actions(tagged_items, generate_actions, index_name):
+    """Runs `generate_actions` for the items of (checkpoint, item) pairs, the checkpoints are added to the actions."""
+
+    checkpoints = collections.deque()
+
+    def items():
+        for (tag, item) in tagged_items:
+            checkpoints.append(tag)
+            yield item
+
+    for action in generate_actions(items(), index_name):
+        action[open_search.CHECKPOINT_KEY] = checkpoints.popleft()
+        yield action
+
+def list_export_files(root_path):
+    return [f for f in os.scandir(root_path) if f.is_file() and export_files.is_export_file(f.name)]
+
+def read_export_files(root_path, backend, progress_meter):
+    for f in list_export_files(root_path):
+        if is_imported(f.name):
+            logging.info(f"Skipping file '{f.name}', it was imported before.")
+            continue
+        logging.info(f"Processing file '{f.name}'.")
+        yield from skip_acknowledged(f.name, export_files.read_documents(f.path, backend))
+        progress_meter.update(0, f.stat().st_size)
+
+def read_deleted_ids(path):
+    with open(path, 'r') as file_handle:
+        for line in file_handle:
+            yield line.rstrip('\n')
+
+def save_progress(import_checkpoint, names):
+    for name in names:
+        import_checkpoint.save(name, {
+            "acknowledged": progress[name]["acknowledged"].ranges(),
+            "count": progress[name]["count"]
+        }, commit=False)
+    import_checkpoint.commit()
+
 if __name__ == '__main__':
 
     start_time = time.time()
@@ -33,13 +96,86 @@ if __name__ == '__main__':
     )
 
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    metrics.start("import", options)
+
+    import_checkpoint = checkpoint.Checkpoint(f"{output_helper.get_state_dir(index_name)}/import_checkpoint.sqlite")
+
+    resumed = None
+    if options['resume']:
+        resumed = import_checkpoint.load('run')
+        if resumed is None:
+            logging.info("Found no interrupted import to resume, starting a new import.")
+        elif resumed['root_path'] != os.path.abspath(root_path):
+            raise Exception(f"The interrupted import read '{resumed['root_path']}', not '{root_path}'.")
+        else:
+            for (name, file_progress) in import_checkpoint.load_all().items():
+                if name != 'run':
+                    progress[name]["acknowledged"] = checkpoint.RangeSet(file_progress["acknowledged"])
+                    progress[name]["count"] = file_progress["count"]
+            logging.info(f"Resuming the interrupted import of '{root_path}'.")
+
+    if resumed is None:
+        import_checkpoint.clear(commit=False)
+        import_checkpoint.save('run', {'root_path': os.path.abspath(root_path)})
+
+    # The ETA is based on the size of the export files that were read completely.
+    progress_meter = metrics.ProgressMeter(
+        "documents",
+        total=sum(f.stat().st_size for f in list_export_files(root_path) if not is_imported(f.name))
+    )
+
+    def acknowledge(checkpoints):
+        for (name, position) in checkpoints:
+            progress[name]["acknowledged"].add(position, position + 1)
+        save_progress(import_checkpoint, {name for (name, position) in checkpoints})
+        progress_meter.update(len(checkpoints))
+
+    open_search.create_index(index_name, options['clear'] and resumed is None)
+
+    settings = pipeline.create_bulk_settings(options)
+
+    if options['bulk_load']:
+        # The settings to restore are kept in the checkpoint before they are changed, a
+        # resumed import restores the ones from before the interrupted import.
+        previous_index_settings = resumed.get('bulk_load') if resumed is not None else None
+        if previous_index_settings is None:
+            previous_index_settings = open_search.get_bulk_load_settings(index_name)
+            import_checkpoint.save('run', {**import_checkpoint.load('run'), 'bulk_load': previous_index_settings})
+        open_search.begin_bulk_load(index_name)
+
+    try:
+        (successes, failures) = open_search.push_actions(
+            tag_actions(read_export_files(root_path, settings.serializer, progress_meter), open_search.generate_index_actions, index_name),
+            settings,
+            acknowledge
+        )
+        logging.info(f"Indexed {successes} documents, {failures} failed.")
+        overall_failures = failures
 
-    open_search.create_index(index_name, options['clear'])
+        deleted_ids_path = f"{root_path}/deleted_ids.txt"
+        if os.path.isfile(deleted_ids_path) and not is_imported("deleted_ids.txt"):
+            logging.info(f"Deleting documents listed in '{deleted_ids_path}'.")
+            (successes, failures) = open_search.push_actions(
+                tag_actions(
+                    skip_acknowledged("deleted_ids.txt", read_deleted_ids(deleted_ids_path)),
+                    open_search.generate_delete_actions,
+                    index_name
+                ),
+                settings,
+                acknowledge
+            )
+            logging.info(f"Deleted {successes} documents, {failures} failed.")
+            overall_failures += failures
+    finally:
+        if options['bulk_load']:
+            open_search.end_bulk_load(index_name, previous_index_settings, options['force_merge'])
 
-    for f in os.scandir(root_path):
-        if f.is_file() and f.name.endswith('.json'):
-            with open(f, 'r') as file_handle:
-                logging.info(f"Processing file '{f.name}'.")
-                open_search.push_batch(json.loads(file_handle.read()), index_name)
+    if overall_failures > 0:
+        save_progress(import_checkpoint, list(progress))
+        logging.warning(f"{overall_failures} action(s) failed, run with --resume to retry them.")
+    else:
+        import_checkpoint.clear()
+    import_checkpoint.close()
 
     logging.info(f"Finished after {round(time.time() - start_time, 2)} seconds.")
+    metrics.finish(options)
@@ -0,0 +1,88 @@
+import bisect
+import json
+import sqlite3
+
+# Stores the progress of a run, so an interrupted run can be resumed with --resume.
+# Values are stored as JSON by key, each save is committed right away unless the
+# caller commits it together with other changes on the same connection.
+
+
+class Checkpoint:
+    def __init__(self, database_path=None, connection=None):
+        if connection is None:
+            connection = sqlite3.connect(
+                database_path, timeout=60, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+        self.connection = connection
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.connection.commit()
+
+    def load(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM checkpoint WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_all(self):
+        return {
+            key: json.loads(value)
+            for key, value in self.connection.execute(
+                "SELECT key, value FROM checkpoint"
+            )
+        }
+
+    def save(self, key, value, commit=True):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO checkpoint (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+        if commit:
+            self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def clear(self, commit=True):
+        self.connection.execute("DELETE FROM checkpoint")
+        if commit:
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class RangeSet:
+    """A set of integers stored as sorted, non-overlapping [start, end) ranges."""
+
+    def __init__(self, ranges=None):
+        self.starts = []
+        self.ends = []
+        for start, end in ranges or []:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+
+        # Merge with all ranges that overlap or touch [start, end).
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value < self.ends[index]
+
+    def covers(self, start, end):
+        index = bisect.bisect_right(self.starts, start) - 1
+        return start >= end or (index >= 0 and end <= self.ends[index])
+
+    def ranges(self):
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
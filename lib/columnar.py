@@ -0,0 +1,270 @@
+import json
+from datetime import datetime, timedelta
+
+from lib import serializer
+
+# Converts between export documents and Arrow tables for the parquet output format,
+# pyarrow is only imported when the format is used.
+#
+# Each field becomes a column, its kind is kept in the schema metadata:
+#
+# string, int, float, bool: stored as they are. String columns with few distinct
+#     values (e.g. type and mime_type) are dictionary-encoded.
+# timestamp, timestamp_utc: naive or UTC datetimes, stored as integer microseconds.
+# path: split into the dictionary-encoded parent directory and the last component,
+#     which is left out if it equals the name of the document.
+# path_copy: the same value as the path of every document (the _id of directory exports).
+# json: fields with other or mixed types, stored as JSON strings. Also strings that
+#     Arrow can not store as UTF-8, i.e. file names with surrogate escapes.
+#
+# Fields missing from some documents and null in others get an additional column
+# telling them apart. Documents read back serialize to the same JSON as the ones
+# written, values of json columns are read back as they were serialized (e.g. dates
+# as ISO strings).
+
+METADATA_KEY = b"file_index"
+LAYOUT_VERSION = 1
+
+PATH_PARENT_COLUMN = "__path_parent"
+PATH_NAME_COLUMN = "__path_name"
+PRESENT_PREFIX = "__present_"
+
+# String columns with at most this fraction of distinct values are dictionary-encoded.
+DICTIONARY_RATIO = 0.5
+
+READ_BATCH_SIZE = 10000
+
+INT64_LIMIT = 2**63
+
+MISSING = object()
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("The parquet format requires the 'pyarrow' package.")
+    return pyarrow
+
+
+def get_kind(values):
+    types = {type(value) for value in values if value is not None}
+
+    if not types:
+        return "string"
+    if len(types) > 1:
+        return "json"
+
+    value_type = types.pop()
+    if value_type is str:
+        return "string" if is_utf8(values) else "json"
+    if value_type is bool:
+        return "bool"
+    if value_type is float:
+        return "float"
+    if value_type is int:
+        if all(
+            -INT64_LIMIT <= value < INT64_LIMIT for value in values if value is not None
+        ):
+            return "int"
+        return "json"
+    if value_type is datetime:
+        offsets = {value.utcoffset() for value in values if value is not None}
+        if offsets == {None}:
+            return "timestamp"
+        if offsets == {timedelta(0)}:
+            return "timestamp_utc"
+    return "json"
+
+
+def is_utf8(values):
+    try:
+        "".join(value for value in values if value is not None).encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def split_path(path, name):
+    """Returns the parent of path and its last component, or None if that equals name."""
+
+    parent, separator, last = path.rpartition("/")
+    return (parent if separator else None, None if last == name else last)
+
+
+def to_table(documents):
+    """Returns an Arrow table with the documents and their layout in the schema metadata."""
+
+    pyarrow = import_pyarrow()
+
+    keys = {}
+    for document in documents:
+        for key in document:
+            keys.setdefault(key)
+
+    arrays = {}
+    layout = {"version": LAYOUT_VERSION, "fields": []}
+
+    def add_string_array(name, values):
+        array = pyarrow.array(values, type=pyarrow.string())
+        if len(set(values)) <= len(values) * DICTIONARY_RATIO:
+            array = array.dictionary_encode()
+        arrays[name] = array
+
+    for key in keys:
+        values = [document.get(key, MISSING) for document in documents]
+        field = {"name": key}
+
+        missing = any(value is MISSING for value in values)
+        if missing:
+            if any(value is None for value in values):
+                field["present"] = f"{PRESENT_PREFIX}{key}"
+                arrays[field["present"]] = pyarrow.array(
+                    [key in document for document in documents], type=pyarrow.bool_()
+                )
+            else:
+                field["optional"] = True
+            values = [None if value is MISSING else value for value in values]
+
+        kind = get_kind(values)
+        if key == "path" and kind == "string" and None not in values:
+            kind = "path"
+            parents = []
+            names = []
+            for document, path in zip(documents, values):
+                parent, name = split_path(path, document.get("name"))
+                parents.append(parent)
+                names.append(name)
+            arrays[PATH_PARENT_COLUMN] = pyarrow.array(
+                parents, type=pyarrow.string()
+            ).dictionary_encode()
+            arrays[PATH_NAME_COLUMN] = pyarrow.array(names, type=pyarrow.string())
+        elif (
+            key == "_id"
+            and not missing
+            and all(
+                document.get("path", MISSING) == value
+                for document, value in zip(documents, values)
+            )
+        ):
+            kind = "path_copy"
+        elif kind == "string":
+            add_string_array(key, values)
+        elif kind == "json":
+            arrays[key] = pyarrow.array(
+                [
+                    (
+                        None
+                        if value is None
+                        else json.dumps(value, default=serializer.json_serial)
+                    )
+                    for value in values
+                ],
+                type=pyarrow.string(),
+            )
+        elif kind == "timestamp_utc":
+            arrays[key] = pyarrow.array(values, type=pyarrow.timestamp("us", tz="UTC"))
+        else:
+            arrays[key] = pyarrow.array(
+                values,
+                type={
+                    "int": pyarrow.int64(),
+                    "float": pyarrow.float64(),
+                    "bool": pyarrow.bool_(),
+                    "timestamp": pyarrow.timestamp("us"),
+                }[kind],
+            )
+
+        field["kind"] = kind
+        layout["fields"].append(field)
+
+    table = pyarrow.table(arrays)
+    return table.replace_schema_metadata({METADATA_KEY: json.dumps(layout)})
+
+
+def write_parquet(path, documents, compression="none"):
+    pyarrow = import_pyarrow()
+    pyarrow.parquet.write_table(to_table(documents), path, compression=compression)
+
+
+def decode_column(array):
+    """Returns the values of an Arrow array as a list, dictionary values are only decoded once."""
+
+    pyarrow = import_pyarrow()
+    if pyarrow.types.is_timestamp(array.type):
+        # Creating datetime objects is slow, dates repeat a lot in most exports.
+        array = array.dictionary_encode()
+
+    if hasattr(array, "dictionary"):
+        dictionary = array.dictionary.to_pylist()
+        return [
+            None if index is None else dictionary[index]
+            for index in array.indices.to_pylist()
+        ]
+    return array.to_pylist()
+
+
+def join_paths(parents, lasts, names):
+    paths = []
+    for parent, last, name in zip(parents, lasts, names):
+        if last is None:
+            last = name
+        paths.append(last if parent is None else f"{parent}/{last}")
+    return paths
+
+
+def from_batch(batch, layout):
+    """Returns the documents of a record batch written by `to_table`."""
+
+    values_by_name = {}
+    for field in layout["fields"]:
+        if field["kind"] == "json":
+            values_by_name[field["name"]] = [
+                None if value is None else json.loads(value)
+                for value in decode_column(batch.column(field["name"]))
+            ]
+        elif field["kind"] not in ["path", "path_copy"]:
+            values_by_name[field["name"]] = decode_column(batch.column(field["name"]))
+
+    # Paths and their copies are restored once the names are known.
+    if any(field["kind"] == "path" for field in layout["fields"]):
+        values_by_name["path"] = join_paths(
+            decode_column(batch.column(PATH_PARENT_COLUMN)),
+            decode_column(batch.column(PATH_NAME_COLUMN)),
+            values_by_name.get("name", [None] * batch.num_rows),
+        )
+    for field in layout["fields"]:
+        if field["kind"] == "path_copy":
+            values_by_name[field["name"]] = values_by_name["path"]
+
+    keys = [field["name"] for field in layout["fields"]]
+    documents = [
+        dict(zip(keys, row)) for row in zip(*(values_by_name[key] for key in keys))
+    ]
+
+    # Removing the missing fields afterwards keeps the order of the others.
+    for field in layout["fields"]:
+        key = field["name"]
+        if "present" in field:
+            present = decode_column(batch.column(field["present"]))
+            for document, is_present in zip(documents, present):
+                if not is_present:
+                    del document[key]
+        elif field.get("optional"):
+            for document, value in zip(documents, values_by_name[key]):
+                if value is None:
+                    del document[key]
+
+    return documents
+
+
+def read_parquet(path, batch_size=READ_BATCH_SIZE):
+    """Lazily yields the documents of a Parquet export file, read in batches of `batch_size` rows."""
+
+    pyarrow = import_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    layout = json.loads(parquet_file.schema_arrow.metadata[METADATA_KEY])
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield from from_batch(batch, layout)
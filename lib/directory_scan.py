@@ -0,0 +1,568 @@
+import argparse
+import json
+import logging
+import mimetypes
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from lib import (
+    hashing,
+    metrics,
+    mime_sniffer,
+    rollups,
+    scan_state,
+    serializer,
+    throttle,
+)
+
+# Creates the documents of a file system tree, used by export_directory.py and
+# watch_directory.py.
+
+mimetypes.add_type("image/tiff", ".ptif")
+
+# Options of the I/O scheduler, they do not change the output of a scan.
+IO_OPTIONS = ["io_max_ops", "io_max_read", "io_profile", "io_adaptive"]
+
+
+def add_scan_arguments(parser):
+    """Adds the checksum, MIME sniffing and I/O scheduling options."""
+
+    parser.add_argument(
+        "--hash",
+        choices=hashing.ALGORITHMS,
+        help="Add a checksum of the file contents using the given algorithm, "
+        "blake3 and xxh64/xxh128 require the blake3 or xxhash package.",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=4,
+        help="Number of threads reading files for checksums, default: 4.",
+    )
+    parser.add_argument(
+        "--hash-max-size",
+        type=int,
+        default=0,
+        help="Skip checksums for files larger than this many MB, default: 0 (no limit).",
+    )
+    parser.add_argument(
+        "--hash-max-rate",
+        type=int,
+        default=0,
+        help="Read at most this many MB per second for checksums, default: 0 (no limit).",
+    )
+    parser.add_argument(
+        "--no-sniff",
+        action="store_true",
+        help="Do not read file headers to detect the MIME type of files without a known extension.",
+    )
+    parser.add_argument(
+        "--sniff-workers",
+        type=int,
+        default=4,
+        help="Number of threads reading file headers, default: 4.",
+    )
+    parser.add_argument(
+        "--sniff-min-hit-rate",
+        type=float,
+        help="Turn off MIME sniffing if less than this fraction (0-1) of the sniffed files are recognised.",
+    )
+    parser.add_argument(
+        "--sniff-max-latency",
+        type=float,
+        help="Turn off MIME sniffing if reading a file header takes longer than this many ms on average.",
+    )
+    parser.add_argument(
+        "--io-max-ops",
+        type=float,
+        default=0,
+        help="Perform at most this many metadata operations (directory listings, stat calls "
+        "and file header reads) per second, default: 0 (no limit).",
+    )
+    parser.add_argument(
+        "--io-max-read",
+        type=float,
+        default=0,
+        help="Read at most this many MB per second for checksums and MIME sniffing, default: 0 (no limit).",
+    )
+    parser.add_argument(
+        "--io-profile",
+        type=check_io_profile,
+        action="append",
+        help="Other limits for a time of day, e.g. '08:00-18:00=200/20' for 200 metadata operations "
+        "and 20 MB read per second during business hours, 0 means no limit, can be repeated.",
+    )
+    parser.add_argument(
+        "--io-adaptive",
+        action="store_true",
+        help="Run fewer metadata operations in parallel while their latency rises.",
+    )
+
+
+def check_io_profile(value):
+    try:
+        throttle.parse_profile(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def create_scheduler(options):
+    """Returns an IoScheduler for the --io options, or None if I/O is not limited."""
+
+    if not (
+        options["io_max_ops"]
+        or options["io_max_read"]
+        or options["io_profile"]
+        or options["io_adaptive"]
+    ):
+        return None
+
+    max_concurrency = None
+    if options["io_adaptive"]:
+        # The scan workers and the threads reading file headers run metadata operations.
+        max_concurrency = options["workers"] + (
+            0 if options["no_sniff"] else options["sniff_workers"]
+        )
+    return throttle.IoScheduler(
+        max_ops=options["io_max_ops"],
+        max_read=options["io_max_read"] * 1024 * 1024,
+        profiles=[
+            throttle.parse_profile(value) for value in options["io_profile"] or []
+        ],
+        max_concurrency=max_concurrency,
+    )
+
+
+def create_hasher(options, state_directory, scheduler=None):
+    """Returns a FileHasher for the --hash options, or None if no checksums are requested."""
+
+    if not options["hash"]:
+        return None
+    return hashing.FileHasher(
+        options["hash"],
+        f"{state_directory}/checksum_cache.sqlite",
+        workers=options["hash_workers"],
+        max_size=options["hash_max_size"] * 1024 * 1024,
+        max_rate=options["hash_max_rate"] * 1024 * 1024,
+        scheduler=scheduler,
+    )
+
+
+def create_sniffer(options, state_directory, scheduler=None):
+    """Returns a MimeSniffer for the --sniff options, or None if sniffing is turned off."""
+
+    if options["no_sniff"]:
+        return None
+    return mime_sniffer.MimeSniffer(
+        f"{state_directory}/mime_cache.sqlite",
+        workers=options["sniff_workers"],
+        min_hit_rate=options["sniff_min_hit_rate"],
+        max_latency=(
+            options["sniff_max_latency"] / 1000
+            if options["sniff_max_latency"] is not None
+            else None
+        ),
+        scheduler=scheduler,
+    )
+
+
+ScanResult = namedtuple(
+    "ScanResult",
+    [
+        "documents",
+        "subdirs",
+        "zero_byte_paths",
+        "entries",
+        "unchanged",
+        "directory",
+        "rollup",
+    ],
+)
+ScanResult.__doc__ = """The result of scanning a single directory.
+
+documents: the documents for new or modified entries.
+subdirs: (path, unchanged) pairs of the subdirectories that still have to be scanned.
+zero_byte_paths: the relative paths of the empty files among the documents.
+entries: the scan state entries seen in the directory (incremental mode only).
+unchanged: the relative path of the directory if it was skipped as unchanged.
+directory: the relative path of the directory, the root directory is ''.
+rollup: the rollup of the files directly inside the directory (if requested).
+"""
+
+
+def create_document(name, relative_path, stats):
+    document = {
+        "name": name,
+        "path": relative_path,
+        "size_bytes": stats.st_size,
+        "modified": None,
+        "created": None,
+    }
+
+    try:
+        document["modified"] = datetime.fromtimestamp(stats.st_mtime, tz=timezone.utc)
+    except Exception:
+        logging.error(
+            f"Unable to parse modified date {stats.st_mtime} for {relative_path}."
+        )
+
+    try:
+        document["created"] = datetime.fromtimestamp(stats.st_ctime, tz=timezone.utc)
+    except Exception:
+        logging.error(
+            f"Unable to parse creation date {stats.st_ctime} for {relative_path}."
+        )
+
+    document["_id"] = relative_path
+
+    return document
+
+
+def create_entry_document(name, relative_path, stats, is_dir):
+    """Creates the document of a file or directory, with the MIME type guessed from its name."""
+
+    document = create_document(name, relative_path, stats)
+
+    if is_dir:
+        document["type"] = "directory"
+    else:
+        document["type"] = "file"
+
+        guess = mimetypes.guess_type(name, strict=False)
+        if guess[0]:
+            document["mime_type"] = guess[0]
+
+    return document
+
+
+def is_unchanged_directory(stored, stats):
+    return stored is not None and stored[1] == stats.st_mtime_ns
+
+
+def scan_directory(
+    current,
+    root_path,
+    unchanged=False,
+    state=None,
+    hasher=None,
+    sniffer=None,
+    rollup=False,
+    scheduler=None,
+    stat_files=False,
+):
+    """Creates the documents for all entries of a single directory.
+
+    If a scan state is given, only documents for new or modified entries are
+    created. Directories that are known to be unchanged are not listed again, unless
+    stat_files is set: a file modified in place does not change the modification
+    time of its directory, only its own stats show the change.
+    If a hasher is given, the checksums of all files are added to their documents.
+    If a sniffer is given, the MIME type of files without a known extension is
+    detected from their contents.
+    If rollup is set, the files directly inside the directory are summed up, see
+    `DirectoryRollups`.
+    If a scheduler is given, listing the directory and the stat calls are limited by it.
+    """
+    relative_current = current[len(root_path) + 1 :]
+    if unchanged and not stat_files:
+        stored_rollup = state.get_rollup(relative_current) if rollup else None
+        # Without a stored rollup (e.g. from a run without rollups) the directory
+        # is listed, only its new or modified entries get documents anyway.
+        if not rollup or stored_rollup is not None:
+            return scan_unchanged_directory(
+                current,
+                root_path,
+                state,
+                stored_rollup and stored_rollup[0],
+                scheduler,
+            )
+
+    documents = []
+    subdirs = []
+    zero_byte_paths = []
+    entries = []
+    files_to_hash = []
+    files_to_sniff = []
+    files = []
+    try:
+        start = time.perf_counter()
+        if scheduler is not None:
+            directory_entries = scheduler.call(list_directory, current, sample=False)
+        else:
+            directory_entries = list_directory(current)
+        metrics.observe("scandir_seconds", time.perf_counter() - start)
+
+        for f in directory_entries:
+            relative_path = f.path[len(root_path) + 1 :]
+
+            try:
+                start = time.perf_counter()
+                stats = f.stat() if scheduler is None else scheduler.call(f.stat)
+                metrics.observe("stat_seconds", time.perf_counter() - start)
+                is_dir = f.is_dir()
+
+                if state is not None:
+                    entry = scan_state.entry_from_stats(relative_path, is_dir, stats)
+                    entries.append(entry)
+                    stored = state.lookup(relative_path)
+                    if is_dir:
+                        subdirs.append((f.path, is_unchanged_directory(stored, stats)))
+                    if stored == entry[3:]:
+                        if rollup and not is_dir:
+                            # Only needed for the rollup, the MIME type of
+                            # unchanged files is usually cached.
+                            document = create_entry_document(
+                                f.name, relative_path, stats, False
+                            )
+                            if "mime_type" not in document and sniffer is not None:
+                                files_to_sniff.append((document, f.path, stats))
+                            files.append((document, stats))
+                        continue
+                elif is_dir:
+                    subdirs.append((f.path, False))
+
+                document = create_entry_document(f.name, relative_path, stats, is_dir)
+
+                if not is_dir:
+                    files.append((document, stats))
+                    if "mime_type" not in document and sniffer is not None:
+                        files_to_sniff.append((document, f.path, stats))
+
+                    if stats.st_size == 0:
+                        zero_byte_paths.append(relative_path)
+
+                    if hasher is not None:
+                        files_to_hash.append((document, f.path, stats))
+
+                documents.append(document)
+
+            except FileNotFoundError:
+                if f.is_symlink():
+                    logging.warning(f"Found broken symlink: '{relative_path}'.")
+                else:
+                    logging.error(f"Unknown FileNotFoundError: '{relative_path}'.")
+
+    except PermissionError:
+        logging.error(f"Got PermissionError for '{current}', ignoring.")
+        subdirs = []
+    except FileNotFoundError as e:
+        logging.error(e)
+        logging.error(
+            f"Got a FileNotFoundError while processing the directory '{current}'."
+        )
+        subdirs = []
+
+    if files_to_sniff:
+        sniffer.sniff_documents(files_to_sniff)
+    if files_to_hash:
+        hasher.hash_documents(files_to_hash)
+
+    return ScanResult(
+        documents,
+        subdirs,
+        zero_byte_paths,
+        entries,
+        None,
+        relative_current,
+        rollups.create_rollup(files) if rollup else None,
+    )
+
+
+def list_directory(path):
+    return list(os.scandir(path))
+
+
+def scan_unchanged_directory(
+    current, root_path, state, stored_rollup=None, scheduler=None
+):
+    """Handles a directory whose modification time did not change since the last run.
+
+    The set of entries can not have changed, so instead of listing the directory
+    only the subdirectories known from the last run are checked. The rollup of the
+    files is the stored one.
+    """
+    relative_current = current[len(root_path) + 1 :]
+
+    documents = []
+    subdirs = []
+    entries = []
+    for relative_path in state.child_directories(relative_current):
+        path = f"{root_path}/{relative_path}"
+        try:
+            stats = (
+                os.stat(path) if scheduler is None else scheduler.call(os.stat, path)
+            )
+        except OSError as e:
+            logging.error(f"Unable to stat known directory '{relative_path}'.")
+            logging.error(e)
+            continue
+
+        entry = scan_state.entry_from_stats(relative_path, True, stats)
+        entries.append(entry)
+        stored = state.lookup(relative_path)
+        subdirs.append((path, is_unchanged_directory(stored, stats)))
+
+        if stored != entry[3:]:
+            document = create_document(os.path.basename(path), relative_path, stats)
+            document["type"] = "directory"
+            documents.append(document)
+
+    return ScanResult(
+        documents,
+        subdirs,
+        [],
+        entries,
+        relative_current,
+        relative_current,
+        stored_rollup,
+    )
+
+
+def walk_file_system(root_path, workers=1, pending=None, **scan_options):
+    """Yields the results of `scan_directory` for all directories below root_path.
+
+    The scan_options are passed on to `scan_directory`. `pending` is the initial
+    stack of (path, unchanged) pairs, it defaults to the root directory and is used
+    to continue an interrupted walk.
+
+    The directories are yielded in depth first order, no matter how many workers
+    are used. With more than one worker, the directories that will be yielded next
+    are scanned ahead of time by a thread pool, which hides the metadata latency of
+    network shares.
+    """
+    if pending is None:
+        pending = [(root_path, False)]
+
+    if workers <= 1:
+        stack = list(pending)
+        while stack:
+            path, unchanged = stack.pop()
+            result = scan_directory(path, root_path, unchanged, **scan_options)
+            yield result
+            stack.extend(reversed(result.subdirs))
+        return
+
+    # Each stack entry is a [path, unchanged, future] list, the future is only created
+    # once the entry gets close enough to the top of the stack. This keeps the number
+    # of directories that are scanned ahead (and held in memory) bounded.
+    prefetch_window = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stack = [[path, unchanged, None] for path, unchanged in pending]
+        while stack:
+            for entry in reversed(stack[-prefetch_window:]):
+                if entry[2] is None:
+                    entry[2] = executor.submit(
+                        scan_directory, entry[0], root_path, entry[1], **scan_options
+                    )
+
+            result = stack.pop()[2].result()
+            yield result
+            stack.extend(
+                [path, unchanged, None] for path, unchanged in reversed(result.subdirs)
+            )
+
+
+class DirectoryRollups:
+    """Adds the rollup of everything below a directory to its document.
+
+    `scan_directory` sums up the files directly inside each directory. The walk
+    yields the directories in depth first order, so the directories on the path to
+    the current one form a stack: a directory is complete once all its
+    subdirectories are, its total is then added to the one of its parent. Directory
+    documents are held back until their directory is complete.
+    """
+
+    def __init__(self, root_path, state=None, frames=None):
+        """Collects the rollups of a walk, frames are the state of an interrupted walk.
+
+        With a scan state (incremental mode), the rollups are stored in it. Directories
+        whose total changed get a new document, even if the directory itself did not.
+        """
+        self.root_path = root_path
+        self.state = state
+        self.frames = [] if frames is None else [load_frame(f) for f in frames]
+        self.root_total = None
+
+    def add(self, result):
+        """Takes the next result of `walk_file_system`, returns the documents to write.
+
+        These are the documents of files right away and those of directories once
+        everything below them was added.
+        """
+        output = []
+        deferred = {}
+        for document in result.documents:
+            if document.get("type") == "directory":
+                deferred[document["path"]] = document
+            else:
+                output.append(document)
+
+        self.frames.append(
+            {
+                "path": result.directory,
+                "remaining": len(result.subdirs),
+                "direct": result.rollup,
+                "total": rollups.copy_rollup(result.rollup),
+                "documents": deferred,
+            }
+        )
+
+        while self.frames and self.frames[-1]["remaining"] == 0:
+            self.complete(self.frames.pop(), output)
+        return output
+
+    def complete(self, frame, output):
+        path = frame["path"]
+        total = frame["total"]
+        parent = self.frames[-1] if self.frames else None
+
+        document = None
+        if parent is not None:
+            document = parent["documents"].pop(path, None)
+            rollups.add_rollup(parent["total"], total)
+            parent["remaining"] -= 1
+        else:
+            self.root_total = total
+
+        if self.state is not None:
+            stored = self.state.get_rollup(path)
+            if stored != (frame["direct"], total):
+                self.state.set_rollup(path, frame["direct"], total)
+                if document is None and path and (stored is None or stored[1] != total):
+                    document = create_directory_document(self.root_path, path)
+
+        if document is not None:
+            document.update(rollups.rollup_fields(total))
+            output.append(document)
+
+        # Subdirectories that were not walked, as listing the directory failed half way.
+        output.extend(frame["documents"].values())
+
+    def checkpoint(self):
+        """Returns the directories that are not complete yet, as JSON compatible values."""
+
+        return json.loads(json.dumps(self.frames, default=serializer.json_serial))
+
+
+def create_directory_document(root_path, path):
+    """Creates the document of a directory without listing it, None if stat fails."""
+
+    try:
+        stats = os.stat(f"{root_path}/{path}")
+    except OSError as e:
+        logging.error(f"Unable to stat directory '{path}'.")
+        logging.error(e)
+        return None
+    return create_entry_document(os.path.basename(path), path, stats, True)
+
+
+def load_frame(frame):
+    for document in frame["documents"].values():
+        for field in rollups.DATE_FIELDS:
+            if isinstance(document.get(field), str):
+                document[field] = datetime.fromisoformat(document[field])
+    return frame
@@ -0,0 +1,359 @@
+import gzip
+import logging
+import os
+import time
+
+from lib import columnar, metrics, serializer
+
+# Writers and readers for the files created by the export scripts and read by import.py.
+#
+# json: Lists of up to 100.000 documents, each list is written with a single dump.
+# ndjson: One document per line, written as soon as it is produced. Files are rotated
+#         once they reach a size limit and can be compressed with gzip or zstd.
+# parquet: Columnar files (see lib/columnar.py), batched like json. Requires pyarrow.
+# none: No files are written, used when the documents are indexed directly.
+#
+# All writers support checkpoints: `checkpoint` makes everything written so far
+# durable and returns a position, `resume` continues writing from such a position
+# after an interrupted run.
+
+OUTPUT_FORMATS = ["json", "ndjson", "parquet", "none"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="json",
+        dest="output_format",
+        help="Output format, 'ndjson' streams each document to disk as it is produced, "
+        "'parquet' writes compact columnar files (requires pyarrow), "
+        "'none' writes no files (see --index), default: json.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default="none",
+        help="Compression for the ndjson and parquet output, 'zstd' requires the zstandard package "
+        "for ndjson, default: none.",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=1024,
+        help="Uncompressed size in MB after which a new ndjson file is started, default: 1024.",
+    )
+    serializer.add_serializer_argument(parser)
+
+
+def create_writer(output_directory, prefix, options=None):
+    if options is None:
+        return JsonBatchWriter(output_directory)
+
+    backend = serializer.get_backend(options["serializer"])
+    if options["output_format"] == "none":
+        return NullWriter()
+    if options["output_format"] == "parquet":
+        return ParquetWriter(output_directory, options["compression"])
+    if options["output_format"] == "ndjson":
+        return NdjsonWriter(
+            output_directory,
+            prefix,
+            options["compression"],
+            options["max_file_size"] * 1024 * 1024,
+            backend,
+        )
+    return JsonBatchWriter(output_directory, backend)
+
+
+class NullWriter:
+    """Discards all documents."""
+
+    def __init__(self):
+        self.files = []
+
+    def write(self, document):
+        pass
+
+    def pending(self):
+        return 0
+
+    def flush(self, name=None):
+        pass
+
+    def checkpoint(self, name=None):
+        return {"files": []}
+
+    def resume(self, position):
+        pass
+
+    def close(self, name=None):
+        pass
+
+
+class JsonBatchWriter:
+    """Collects documents in memory, the caller decides when to flush them into a file."""
+
+    def __init__(self, output_directory, backend=None):
+        self.output_directory = output_directory
+        self.backend = backend or serializer.get_backend()
+        self.batch = []
+        self.files = []
+
+    def write(self, document):
+        self.batch.append(document)
+
+    def pending(self):
+        return len(self.batch)
+
+    def flush(self, name):
+        if len(self.batch) == 0:
+            return
+
+        start = time.perf_counter()
+        data = self.backend.dumps(self.batch)
+        metrics.observe("serialize_batch_seconds", time.perf_counter() - start)
+        metrics.increment("documents_written", len(self.batch))
+
+        with open(f"{self.output_directory}/{name}.json", "wb") as f:
+            f.write(data)
+
+        self.batch = []
+        self.files.append(f"{name}.json")
+
+    def checkpoint(self, name):
+        self.flush(name)
+        return {"files": list(self.files)}
+
+    def resume(self, position):
+        self.files = list(position["files"])
+
+    def close(self, name):
+        self.flush(name)
+
+
+class ParquetWriter(JsonBatchWriter):
+    """Collects documents in memory like JsonBatchWriter, each flush writes a Parquet file."""
+
+    def __init__(self, output_directory, compression="none"):
+        # Fail early if pyarrow is not available.
+        columnar.import_pyarrow()
+
+        super().__init__(output_directory)
+        self.compression = compression
+
+    def flush(self, name):
+        if len(self.batch) == 0:
+            return
+
+        start = time.perf_counter()
+        columnar.write_parquet(
+            f"{self.output_directory}/{name}.parquet", self.batch, self.compression
+        )
+        metrics.observe("serialize_batch_seconds", time.perf_counter() - start)
+        metrics.increment("documents_written", len(self.batch))
+
+        self.batch = []
+        self.files.append(f"{name}.parquet")
+
+
+class NdjsonWriter:
+    """Writes each document as a single line as soon as it is produced.
+
+    At a checkpoint the current compressed stream is ended (gzip member or zstd frame)
+    and the file is kept open, so the file can be truncated to the checkpoint and
+    continued with a new stream. Concatenated streams are read as one.
+    """
+
+    def __init__(
+        self, output_directory, prefix, compression, max_file_size, backend=None
+    ):
+        self.output_directory = output_directory
+        self.prefix = prefix
+        self.compression = compression
+        self.max_file_size = max_file_size
+        self.backend = backend or serializer.get_backend()
+
+        self.raw = None
+        self.file = None
+        self.file_counter = 0
+        self.file_size = 0
+        self.files = []
+
+    def write(self, document):
+        start = time.perf_counter()
+        line = self.backend.dumps(document) + b"\n"
+        metrics.observe("serialize_seconds", time.perf_counter() - start)
+        metrics.increment("documents_written")
+
+        if self.file is not None and self.file_size + len(line) > self.max_file_size:
+            self.rotate()
+        if self.file is None:
+            self.open_next_file()
+
+        self.file.write(line)
+        self.file_size += len(line)
+
+    def pending(self):
+        return 0
+
+    def flush(self, name=None):
+        pass
+
+    def checkpoint(self, name=None):
+        offset = 0
+        if self.file is not None:
+            if self.compression == "gzip":
+                self.file.close()
+            elif self.compression == "zstd":
+                import zstandard
+
+                self.file.flush(zstandard.FLUSH_FRAME)
+            self.raw.flush()
+            offset = self.raw.tell()
+
+            # The header of the next gzip member is written right away, it has to
+            # come after the checkpoint.
+            if self.compression == "gzip":
+                self.file = gzip.GzipFile(fileobj=self.raw, mode="wb")
+
+        return {
+            "files": list(self.files),
+            "file_counter": self.file_counter,
+            "offset": offset,
+            "file_size": self.file_size,
+        }
+
+    def resume(self, position):
+        self.rotate()
+        self.files = list(position["files"])
+        self.file_counter = position["file_counter"]
+        if position["offset"] > 0:
+            self.raw = open(self.get_path(), "r+b")
+            self.raw.truncate(position["offset"])
+            self.raw.seek(position["offset"])
+            self.file = wrap_compressed(self.raw, self.compression)
+            self.file_size = position["file_size"]
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+            if not self.raw.closed:
+                self.raw.close()
+            self.raw = None
+            self.file = None
+
+    def close(self, name=None):
+        self.rotate()
+
+    def get_path(self):
+        return (
+            f"{self.output_directory}/{self.prefix}_{self.file_counter:05d}.ndjson"
+            f"{COMPRESSION_SUFFIXES[self.compression]}"
+        )
+
+    def open_next_file(self):
+        self.file_counter += 1
+        self.file_size = 0
+        path = self.get_path()
+        self.files.append(os.path.basename(path))
+        self.raw = open(path, "wb")
+        self.file = wrap_compressed(self.raw, self.compression)
+
+
+def wrap_compressed(raw, compression):
+    """Wraps a binary file opened for writing, the compressed stream can be ended without closing the file."""
+
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression requires the 'zstandard' package.")
+        return zstandard.ZstdCompressor().stream_writer(raw)
+    return raw
+
+
+def open_compressed(path, mode, compression):
+    if compression == "gzip":
+        return gzip.open(path, mode)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression requires the 'zstandard' package.")
+
+        if "w" in mode:
+            return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, mode), read_across_frames=True
+        )
+    return open(path, mode)
+
+
+def is_export_file(name):
+    return name.endswith(".json") or name.endswith(".parquet") or ".ndjson" in name
+
+
+def remove_unfinished_files(output_directory, finished_files):
+    """Removes the export files of an interrupted run that were written after its last checkpoint."""
+
+    for f in os.scandir(output_directory):
+        if is_export_file(f.name) and f.name not in finished_files:
+            logging.info(
+                f"Removing '{f.name}', it was written after the last checkpoint."
+            )
+            os.remove(f.path)
+
+
+def read_documents(path, backend=None):
+    """Lazily yields the documents of an export file.
+
+    ndjson files are read line by line, parquet files in batches of rows.
+    """
+
+    if backend is None:
+        backend = serializer.get_backend()
+
+    name = os.path.basename(path)
+    if name.endswith(".parquet"):
+        yield from columnar.read_parquet(path)
+        return
+    if name.endswith(".json"):
+        with open(path, "rb") as f:
+            yield from backend.loads(f.read())
+        return
+
+    compression = "none"
+    for candidate, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and name.endswith(suffix):
+            compression = candidate
+
+    with open_compressed(path, "rb", compression) as f:
+        for line_number, line in enumerate(
+            iterate_lines(f) if compression == "zstd" else f
+        ):
+            if not line.strip():
+                continue
+            try:
+                yield backend.loads(line)
+            except ValueError:
+                logging.error(f"Unable to parse line {line_number + 1} of '{path}'.")
+
+
+def iterate_lines(binary_stream, chunk_size=1024 * 1024):
+    """Splits a binary stream without readline support into lines."""
+
+    remainder = b""
+    chunk = binary_stream.read(chunk_size)
+    while chunk:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+        chunk = binary_stream.read(chunk_size)
+    if remainder:
+        yield remainder
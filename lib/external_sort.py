@@ -0,0 +1,73 @@
+import heapq
+import os
+import tempfile
+from operator import itemgetter
+
+from lib import serializer
+
+# Sorts (key, value) records that do not fit into memory, used by diff_exports.py.
+# Records are collected in memory up to a size limit, sorted and spilled into a
+# temporary file as one run. Iterating merges the runs, holding one record per run.
+# The runs end in '.run', so they are not taken for export files if they are left in
+# an output directory.
+# Values are stored as JSON, so they are read back as their JSON representation
+# (e.g. dates as ISO strings), no matter whether they were spilled.
+
+
+class ExternalSorter:
+    def __init__(self, temp_directory=None, max_memory=256 * 1024 * 1024, backend=None):
+        self.temp_directory = temp_directory
+        self.max_memory = max_memory
+        self.backend = backend or serializer.get_backend()
+
+        self.records = []
+        self.memory = 0
+        self.run_paths = []
+        self.count = 0
+
+    def add(self, key, value):
+        line = self.backend.dumps([key, value])
+        self.records.append((key, line))
+        # Rough size of the tuple and the key on top of the serialized record.
+        self.memory += len(line) + len(key) + 120
+        self.count += 1
+
+        if self.memory >= self.max_memory:
+            self.spill()
+
+    def spill(self):
+        self.records.sort(key=itemgetter(0))
+
+        fd, path = tempfile.mkstemp(
+            prefix="sort_", suffix=".run", dir=self.temp_directory
+        )
+        with os.fdopen(fd, "wb") as f:
+            for _, line in self.records:
+                f.write(line)
+                f.write(b"\n")
+        self.run_paths.append(path)
+
+        self.records = []
+        self.memory = 0
+
+    def read_run(self, path):
+        with open(path, "rb") as f:
+            for line in f:
+                yield tuple(self.backend.loads(line))
+
+    def __iter__(self):
+        """Yields all (key, value) records by key, records with equal keys in the order they were added."""
+
+        self.records.sort(key=itemgetter(0))
+        in_memory = (tuple(self.backend.loads(line)) for _, line in self.records)
+        if not self.run_paths:
+            return in_memory
+
+        runs = [self.read_run(path) for path in self.run_paths]
+        return heapq.merge(*runs, in_memory, key=itemgetter(0))
+
+    def close(self):
+        for path in self.run_paths:
+            os.remove(path)
+        self.run_paths = []
+        self.records = []
@@ -0,0 +1,55 @@
+import sqlite3
+import threading
+
+# Caches values that are derived from file contents (checksums, sniffed MIME types)
+# across runs. Entries are keyed by (device, inode, size, mtime), so a cached value
+# is only used as long as the file was not modified or replaced.
+#
+# Writes are committed in batches, so each cache should use its own database file,
+# a second connection would have to wait for the open write transaction.
+
+
+class FileCache:
+    def __init__(self, database_path, name, commit_interval=10000):
+        self.name = name
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"""CREATE TABLE IF NOT EXISTS {name} (
+                device INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime INTEGER,
+                value TEXT,
+                PRIMARY KEY (device, inode)
+            )""")
+
+    def get(self, stats):
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT size, mtime, value FROM {self.name} WHERE device = ? AND inode = ?",
+                (stats.st_dev, stats.st_ino),
+            ).fetchone()
+
+        if row is None or row[0] != stats.st_size or row[1] != stats.st_mtime_ns:
+            return None
+        return row[2]
+
+    def put(self, stats, value):
+        with self.lock:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?, ?, ?)",
+                (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns, value),
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
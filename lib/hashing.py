@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import metrics
+from lib.file_cache import FileCache
+from lib.throttle import RateLimiter
+
+HASHLIB_ALGORITHMS = ["md5", "sha1", "sha256", "blake2b"]
+OPTIONAL_ALGORITHMS = ["blake3", "xxh64", "xxh128"]
+ALGORITHMS = HASHLIB_ALGORITHMS + OPTIONAL_ALGORITHMS
+
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def create_hash(algorithm):
+    if algorithm in HASHLIB_ALGORITHMS:
+        return hashlib.new(algorithm)
+    if algorithm == "blake3":
+        try:
+            import blake3
+        except ImportError:
+            raise Exception("The blake3 algorithm requires the 'blake3' package.")
+        return blake3.blake3()
+    if algorithm in ["xxh64", "xxh128"]:
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception(f"The {algorithm} algorithm requires the 'xxhash' package.")
+        return getattr(xxhash, algorithm)()
+    raise Exception(f"Unknown hash algorithm '{algorithm}'.")
+
+
+class FileHasher:
+    """Calculates content checksums of files in a thread pool.
+
+    Checksums are cached by (device, inode, size, mtime), so unchanged files are not
+    read again by later runs. Files larger than `max_size` bytes are skipped and reads
+    are limited to `max_rate` bytes per second overall and by the scheduler, if given.
+    """
+
+    def __init__(
+        self,
+        algorithm,
+        cache_path,
+        workers=4,
+        max_size=None,
+        max_rate=None,
+        scheduler=None,
+    ):
+        # Fail early if the algorithm is not available.
+        create_hash(algorithm)
+
+        self.algorithm = algorithm
+        self.max_size = max_size
+        self.cache = FileCache(cache_path, f"checksums_{algorithm}")
+        self.limiter = RateLimiter(max_rate)
+        self.scheduler = scheduler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.stats_lock = threading.Lock()
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.cached_files = 0
+        self.skipped_files = 0
+
+    def hash_documents(self, files):
+        """Adds the checksum to the documents of the given (document, path, stats) tuples."""
+
+        futures = []
+        for document, path, stats in files:
+            if self.max_size and stats.st_size > self.max_size:
+                with self.stats_lock:
+                    self.skipped_files += 1
+                continue
+            futures.append(
+                (document, self.executor.submit(self.get_checksum, path, stats))
+            )
+
+        for document, future in futures:
+            checksum = future.result()
+            if checksum is not None:
+                document["checksum"] = checksum
+                document["checksum_algorithm"] = self.algorithm
+
+    def get_checksum(self, path, stats):
+        checksum = self.cache.get(stats)
+        if checksum is not None:
+            with self.stats_lock:
+                self.cached_files += 1
+            return checksum
+
+        start = time.perf_counter()
+        try:
+            checksum = self.read_checksum(path)
+        except OSError as e:
+            logging.error(f"Unable to calculate checksum for {path}.")
+            logging.error(e)
+            return None
+        metrics.observe("hash_seconds", time.perf_counter() - start)
+
+        self.cache.put(stats, checksum)
+        with self.stats_lock:
+            self.hashed_files += 1
+            self.hashed_bytes += stats.st_size
+        return checksum
+
+    def read_checksum(self, path):
+        file_hash = create_hash(self.algorithm)
+        buffer = bytearray(READ_BUFFER_SIZE)
+        view = memoryview(buffer)
+
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                file_hash.update(view[:read])
+                self.limiter.acquire(read)
+                if self.scheduler is not None:
+                    self.scheduler.read(read)
+
+        return file_hash.hexdigest()
+
+    def close(self):
+        self.executor.shutdown()
+        self.cache.close()
+
+        logging.info(
+            f"Checksums: {self.hashed_files} files hashed ({self.hashed_bytes} bytes), "
+            f"{self.cached_files} from cache, {self.skipped_files} skipped as too large."
+        )
@@ -0,0 +1,103 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from collections import namedtuple
+
+# A minimal ctypes binding of the Linux inotify API, used by watch_directory.py.
+# Creating an Inotify instance raises OSError where inotify is not available.
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+EVENT_HEADER = struct.Struct("iIII")
+
+READ_SIZE = 64 * 1024
+
+Event = namedtuple("Event", ["wd", "mask", "cookie", "name"])
+
+
+class Inotify:
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.add_watch_function = libc.inotify_add_watch
+            self.rm_watch_function = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available on this system.")
+
+        self.add_watch_function.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.rm_watch_function.argtypes = [ctypes.c_int, ctypes.c_int]
+        init.argtypes = [ctypes.c_int]
+
+        self.fd = init(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise_errno("inotify_init1")
+
+    def add_watch(self, path, mask):
+        """Watches path, returns the watch descriptor.
+
+        Raises OSError, with errno ENOSPC once the limit of watches
+        (fs.inotify.max_user_watches) is reached.
+        """
+        wd = self.add_watch_function(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise_errno(path)
+        return wd
+
+    def remove_watch(self, wd):
+        # Fails if the watch was already removed by the kernel, e.g. for deleted directories.
+        self.rm_watch_function(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Waits up to timeout seconds for events and returns them."""
+
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def raise_errno(filename):
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error), filename)
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import sqlite3
+import unicodedata
+
+# Stores the stable ids of the NeoFinder rows seen by the incremental runs of
+# export_neofinder.py together with a fingerprint of their content, so repeated exports
+# of the same catalogs only write new and modified rows and list the removed ones.
+
+# OpenSearch rejects document ids longer than 512 bytes.
+MAX_ID_BYTES = 512
+
+# Fields that differ between exports of the same row and are left out of its fingerprint.
+VOLATILE_FIELDS = ["_id", "neofinder_export_file"]
+
+
+def create_stable_id(catalog, volume, neofinder_path):
+    """Returns an id for a row that stays the same in every export of its catalog.
+
+    The path is taken as exported by NeoFinder, with the catalog prefix removed and
+    ':' replaced by '/'. Names are normalized to NFC, as exports created on macOS may use decomposed
+    characters. Ids longer than MAX_ID_BYTES or containing line breaks, which would
+    break the lines of 'deleted_ids.txt', are replaced by their SHA-256.
+    """
+    path = neofinder_path.removeprefix(f"{catalog}:").replace(":", "/").strip("/")
+    stable_id = unicodedata.normalize("NFC", f"{catalog}:{volume}:{path}")
+    encoded = stable_id.encode("utf-8")
+    if len(encoded) > MAX_ID_BYTES or "\n" in stable_id or "\r" in stable_id:
+        return hashlib.sha256(encoded).hexdigest()
+    return stable_id
+
+
+def create_fingerprint(document):
+    content = repr(
+        sorted(
+            (key, value)
+            for (key, value) in document.items()
+            if key not in VOLATILE_FIELDS
+        )
+    )
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest()
+
+
+class KeyIndex:
+    def __init__(self, database_path, resume=False, connection=None):
+        """Starts a new run, or continues the last one if resume is set.
+
+        A connection to the database can be passed in, to commit other changes (e.g. a
+        checkpoint) together with the index.
+        """
+        self.database_path = database_path
+        if connection is None:
+            connection = sqlite3.connect(database_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+        self.connection = connection
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS keys (
+                id TEXT PRIMARY KEY,
+                catalog TEXT NOT NULL,
+                fingerprint BLOB NOT NULL,
+                run INTEGER NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS keys_catalog ON keys (catalog, run)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'run'"
+        ).fetchone()
+        self.run = int(row[0]) if row else 0
+        if not resume:
+            self.run += 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('run', ?)",
+            (str(self.run),),
+        )
+        self.connection.commit()
+
+        self.counts = {"new": 0, "modified": 0, "unchanged": 0, "duplicate": 0}
+
+    def add(self, document):
+        """Records a row as seen in this run, returns True if it has to be exported.
+
+        That is the case for rows that are new or modified since the run they were last
+        seen in. Rows seen before in this run, e.g. because a catalog was exported into
+        several files, are only exported once.
+        """
+        row = self.connection.execute(
+            "SELECT fingerprint, run FROM keys WHERE id = ?", (document["_id"],)
+        ).fetchone()
+        if row is not None and row[1] == self.run:
+            self.counts["duplicate"] += 1
+            return False
+
+        fingerprint = create_fingerprint(document)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO keys (id, catalog, fingerprint, run) VALUES (?, ?, ?, ?)",
+            (
+                document["_id"],
+                document.get("neofinder_catalog", ""),
+                fingerprint,
+                self.run,
+            ),
+        )
+
+        if row is None:
+            self.counts["new"] += 1
+        elif row[0] != fingerprint:
+            self.counts["modified"] += 1
+        else:
+            self.counts["unchanged"] += 1
+            return False
+        return True
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def finish(self, commit=True):
+        """Removes and yields the ids of all rows that were not seen in this run.
+
+        Only catalogs with at least one row in this run are considered, so exporting a
+        subset of the catalogs does not remove the others. Without commit, the caller
+        commits once the deleted rows were also removed from the index.
+        """
+        condition = (
+            "run != ? AND catalog IN (SELECT DISTINCT catalog FROM keys WHERE run = ?)"
+        )
+        cursor = self.connection.execute(
+            f"SELECT id FROM keys WHERE {condition} ORDER BY id", (self.run, self.run)
+        )
+        for (deleted,) in cursor:
+            yield deleted
+
+        self.connection.execute(
+            f"DELETE FROM keys WHERE {condition}", (self.run, self.run)
+        )
+        if commit:
+            self.connection.commit()
+            logging.info(f"Updated key index in {self.database_path}.")
@@ -0,0 +1,269 @@
+import bisect
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from datetime import timedelta
+
+# Counters and latency histograms shared by the scripts. Values are recorded in
+# module-level registries from any thread, worker processes return theirs with
+# `drain` and the main process adds them with `merge`. `start` and `finish` wrap a
+# run: they set up the periodic progress output and write the metrics file and the
+# profile requested on the command line.
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is unbounded.
+BUCKETS = [
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+]
+
+# Prefix of all metric names in the Prometheus output.
+PROMETHEUS_PREFIX = "file_index"
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+
+settings = {"script": None, "metrics_path": None, "progress_interval": 10}
+profiler = None
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=10,
+        help="Seconds between progress messages, 0 disables them, default: 10.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write counters and latency histograms to this file, updated with each "
+        "progress message. Paths ending in '.prom' get the Prometheus text format, all others JSON.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="Profile the main thread with cProfile and write the pstats data to this file.",
+    )
+
+
+def start(script, options):
+    global profiler
+
+    settings["script"] = script
+    settings["metrics_path"] = options.get("metrics")
+    settings["progress_interval"] = options.get("progress_interval", 10)
+
+    if options.get("profile"):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+
+def finish(options):
+    """Writes the profile and metrics file and logs a summary of the histograms."""
+
+    global profiler
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options["profile"])
+
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(15)
+        logging.info(f"Wrote the profile to '{options['profile']}', top functions:")
+        logging.info(output.getvalue())
+        profiler = None
+
+    write_metrics()
+    log_summary()
+
+
+def increment(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name, seconds):
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {
+                "buckets": [0] * (len(BUCKETS) + 1),
+                "count": 0,
+                "sum": 0,
+                "max": 0,
+            }
+        histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        if seconds > histogram["max"]:
+            histogram["max"] = seconds
+
+
+def snapshot():
+    with lock:
+        return {
+            "counters": dict(counters),
+            "histograms": {
+                name: {**histogram, "buckets": list(histogram["buckets"])}
+                for (name, histogram) in histograms.items()
+            },
+        }
+
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def drain():
+    """Returns and clears the values recorded so far, used by worker processes."""
+
+    with lock:
+        values = {"counters": dict(counters), "histograms": dict(histograms)}
+        counters.clear()
+        histograms.clear()
+    return values
+
+
+def merge(values):
+    """Adds the values returned by `drain` in another process."""
+
+    with lock:
+        for name, amount in values["counters"].items():
+            counters[name] = counters.get(name, 0) + amount
+        for name, other in values["histograms"].items():
+            histogram = histograms.get(name)
+            if histogram is None:
+                histograms[name] = {**other, "buckets": list(other["buckets"])}
+                continue
+            for index, count in enumerate(other["buckets"]):
+                histogram["buckets"][index] += count
+            histogram["count"] += other["count"]
+            histogram["sum"] += other["sum"]
+            histogram["max"] = max(histogram["max"], other["max"])
+
+
+def to_prometheus(values, script):
+    labels = f'script="{script}"'
+    lines = []
+    for name, amount in sorted(values["counters"].items()):
+        metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{{{labels}}} {amount}")
+
+    for name, histogram in sorted(values["histograms"].items()):
+        metric = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ["+Inf"], histogram["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum{{{labels}}} {histogram['sum']}")
+        lines.append(f"{metric}_count{{{labels}}} {histogram['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    """Writes the current values to the --metrics file, if one was given.
+
+    The file is replaced atomically, so collectors never read a partial file.
+    """
+
+    path = settings["metrics_path"]
+    if path is None:
+        return
+
+    values = snapshot()
+    if path.endswith(".prom"):
+        content = to_prometheus(values, settings["script"])
+    else:
+        content = json.dumps(
+            {"script": settings["script"], "time": time.time(), **values}, indent=2
+        )
+
+    with open(f"{path}.tmp", "w") as f:
+        f.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+def log_summary():
+    values = snapshot()
+    if not values["histograms"] and not values["counters"]:
+        return
+
+    logging.info("Metrics:")
+    for name, histogram in sorted(values["histograms"].items()):
+        mean = histogram["sum"] / histogram["count"]
+        logging.info(
+            f"  {name}: {histogram['count']} times, {histogram['sum']:.3f} s overall, "
+            f"{mean * 1000:.3f} ms on average, {histogram['max'] * 1000:.3f} ms at most"
+        )
+    for name, amount in sorted(values["counters"].items()):
+        logging.info(f"  {name}: {amount}")
+
+
+class ProgressMeter:
+    """Logs the number of processed items and their rate every --progress-interval seconds.
+
+    If the size of the whole input is known as `total` (e.g. in bytes), the progress
+    through it is passed to `update` as well and an ETA is logged. The metrics file is
+    rewritten with each message.
+    """
+
+    def __init__(self, unit, total=None):
+        self.unit = unit
+        self.total = total
+        self.count = 0
+        self.position = 0
+        self.start_time = time.monotonic()
+        self.interval = settings["progress_interval"]
+        self.next_report = self.start_time + self.interval
+
+    def update(self, count=1, advance=0):
+        self.count += count
+        self.position += advance
+        if self.interval > 0:
+            now = time.monotonic()
+            if now >= self.next_report:
+                self.next_report = now + self.interval
+                self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.start_time
+        message = f"Progress: {self.count} {self.unit}, {self.count / elapsed:.1f} {self.unit}/s"
+
+        if self.total and self.position > 0:
+            fraction = min(self.position / self.total, 1)
+            remaining = elapsed / fraction - elapsed
+            message += (
+                f", {fraction:.1%} done, ETA {timedelta(seconds=round(remaining))}"
+            )
+
+        logging.info(message)
+        write_metrics()
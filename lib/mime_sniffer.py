@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import filetype
+
+from lib import metrics
+from lib.file_cache import FileCache
+
+# filetype never looks at more than the first 8192 bytes of a file.
+HEADER_SIZE = 8192
+
+# Number of files that are sniffed before the hit rate and latency limits are checked.
+WARM_UP_FILES = 1000
+
+
+def read_header(path):
+    """Returns the header of a file and the seconds it took to read it."""
+
+    start = time.monotonic()
+    with open(path, "rb", buffering=0) as f:
+        header = f.read(HEADER_SIZE)
+    return (header, time.monotonic() - start)
+
+
+class MimeSniffer:
+    """Detects the MIME type of files without a known extension from their header.
+
+    The header of each file is read with a single open and read call, detection runs
+    on the in-memory buffer. Results, including misses, are cached by (device, inode,
+    size, mtime). Sniffing is turned off for the rest of the run if less than
+    `min_hit_rate` of the sniffed files are recognised or if reading a header takes
+    longer than `max_latency` seconds on average. Reading a header counts as a metadata
+    operation of the scheduler, if given.
+    """
+
+    def __init__(
+        self,
+        cache_path,
+        workers=4,
+        min_hit_rate=None,
+        max_latency=None,
+        scheduler=None,
+    ):
+        self.cache = FileCache(cache_path, "mime_types")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.min_hit_rate = min_hit_rate
+        self.max_latency = max_latency
+        self.disabled = False
+        self.scheduler = scheduler
+
+        self.stats_lock = threading.Lock()
+        self.sniffed_files = 0
+        self.recognised_files = 0
+        self.cached_files = 0
+        self.skipped_files = 0
+        self.read_time = 0
+
+    def sniff_documents(self, files):
+        """Adds the MIME type to the documents of the given (document, path, stats) tuples."""
+
+        futures = [
+            (document, self.executor.submit(self.get_mime_type, path, stats))
+            for document, path, stats in files
+        ]
+
+        for document, future in futures:
+            mime_type = future.result()
+            if mime_type:
+                document["mime_type"] = mime_type
+
+    def get_mime_type(self, path, stats):
+        mime_type = self.cache.get(stats)
+        if mime_type is not None:
+            with self.stats_lock:
+                self.cached_files += 1
+            return mime_type
+
+        if self.disabled:
+            with self.stats_lock:
+                self.skipped_files += 1
+            return None
+
+        try:
+            # Waiting for the scheduler does not count as read time.
+            if self.scheduler is not None:
+                header, read_time = self.scheduler.call(read_header, path, sample=False)
+                self.scheduler.read(len(header))
+            else:
+                header, read_time = read_header(path)
+        except PermissionError:
+            return None
+        except OSError as e:
+            logging.error(f"Got exception for {path}.")
+            logging.error(e)
+            return None
+
+        start = time.monotonic()
+        guess = filetype.guess(header)
+        mime_type = guess.mime if guess else ""
+        metrics.observe("mime_sniff_seconds", read_time + time.monotonic() - start)
+        self.cache.put(stats, mime_type)
+
+        with self.stats_lock:
+            self.sniffed_files += 1
+            self.read_time += read_time
+            if guess:
+                self.recognised_files += 1
+            self.check_limits()
+
+        return mime_type
+
+    def check_limits(self):
+        if self.disabled or self.sniffed_files < WARM_UP_FILES:
+            return
+
+        hit_rate = self.recognised_files / self.sniffed_files
+        latency = self.read_time / self.sniffed_files
+        if self.min_hit_rate is not None and hit_rate < self.min_hit_rate:
+            logging.warning(
+                f"Only {hit_rate:.1%} of {self.sniffed_files} sniffed files were recognised, "
+                "turning off MIME sniffing."
+            )
+            self.disabled = True
+        elif self.max_latency is not None and latency > self.max_latency:
+            logging.warning(
+                f"Reading a file header took {latency * 1000:.3f} ms on average, "
+                "turning off MIME sniffing."
+            )
+            self.disabled = True
+
+    def close(self):
+        self.executor.shutdown()
+        self.cache.close()
+
+        logging.info(
+            f"MIME sniffing: {self.sniffed_files} files sniffed ({self.recognised_files} recognised), "
+            f"{self.cached_files} from cache, {self.skipped_files} skipped."
+        )
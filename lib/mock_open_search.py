@@ -0,0 +1,120 @@
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A minimal stand-in for OpenSearch used by benchmark.py. It answers the index
+# management requests of lib.open_search and acknowledges every bulk action without
+# storing it, so imports can be measured without a cluster.
+
+
+class MockOpenSearch:
+    """Serves the mock endpoint on 127.0.0.1 from a background thread.
+
+    `latency` seconds are added to each bulk request to simulate a cluster. The
+    number of requests and acknowledged actions are counted in `stats`.
+    """
+
+    def __init__(self, port=0, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {"bulk_requests": 0, "bulk_bytes": 0, "indexed": 0, "deleted": 0}
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.read_body()
+                self.send_json({})
+
+            def do_GET(self):
+                self.read_body()
+                if "_settings" in self.path:
+                    name = self.path.strip("/").split("/")[0]
+                    settings = {"index": {"number_of_replicas": "1"}}
+                    self.send_json({name: {"settings": settings}})
+                else:
+                    self.send_json({"version": {"number": "2.0.0"}})
+
+            def do_PUT(self):
+                self.read_body()
+                self.send_json({"acknowledged": True})
+
+            def do_DELETE(self):
+                self.read_body()
+                self.send_json({"acknowledged": True})
+
+            def do_POST(self):
+                body = self.read_body()
+                if "_bulk" not in self.path:
+                    self.send_json({"acknowledged": True})
+                    return
+
+                items = mock.handle_bulk(body)
+                self.send_json({"took": 1, "errors": False, "items": items})
+
+            def read_body(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                if self.headers.get("content-encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def send_json(self, value):
+                body = json.dumps(value).encode("utf-8")
+                self.send_response(200)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle_bulk(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        items = []
+        lines = body.splitlines()
+        index = 0
+        while index < len(lines):
+            action = json.loads(lines[index])
+            op_type, meta = next(iter(action.items()))
+            # All actions except deletions are followed by the document.
+            index += 1 if op_type == "delete" else 2
+            items.append({op_type: {"_id": meta.get("_id"), "status": 200}})
+
+        with self.lock:
+            self.stats["bulk_requests"] += 1
+            self.stats["bulk_bytes"] += len(body)
+            for item in items:
+                if "delete" in item:
+                    self.stats["deleted"] += 1
+                else:
+                    self.stats["indexed"] += 1
+
+        return items
+
+    def reset(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def write_env_file(self, path):
+        """Writes an .env file that points the scripts to this endpoint."""
+
+        with open(path, "w") as f:
+            f.write("FILE_INDEX_HOST=127.0.0.1\n")
+            f.write(f"FILE_INDEX_PORT={self.port}\n")
+            f.write("FILE_INDEX_USER=benchmark\n")
+            f.write("FILE_INDEX_PASSWORD=benchmark\n")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,66 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from opensearchpy import OpenSearch, helpers
-from opensearchpy.exceptions import RequestError
+from opensearchpy import ConnectionSelector, OpenSearch, Urllib3HttpConnection, helpers
+from opensearchpy.exceptions import RequestError, TransportError
+from lib import metrics
+from lib.serializer import get_backend
 
 import os
 import logging
+import threading
+import time
 
-host = None
-port = None
-user = None
-password = None
-use_ssl = False
+# Seconds between two sniffs of the cluster nodes if FILE_INDEX_SNIFF is enabled.
+SNIFF_INTERVAL = 300
 
-with open('.env', 'r') as env_file:
-    line = env_file.readline()
-    while line:
-        try:
-            [key, val] = line.split('=')
+def read_env_file(path='.env'):
+    """Returns the connection settings from the .env file, see .env_template."""
 
-            if key.strip()[0] == '#':
-                # ignore lines that are commented out
-                pass
-            else:
-                if key == "FILE_INDEX_HOST":
-                    host = val.strip()
-                if key == "FILE_INDEX_PORT":
-                    port = val.strip()
-                if key == "FILE_INDEX_USER":
-                    user = val.strip()
-                if key == "FILE_INDEX_PASSWORD":
-                    password = val.strip()
-                if key == "FILE_INDEX_USE_SSL":
-                    if val.strip() == "True":
-                        use_ssl = True
-        except ValueError as e:
-            # Ignore lines without a key value pair separted by '='
-            pass
+    config = {
+        "hosts": None,
+        "port": None,
+        "user": None,
+        "password": None,
+        "use_ssl": False,
+        "sniff": False,
+        "timeout": 10,
+        "max_connections": 10
+    }
+
+    with open(path, 'r') as env_file:
         line = env_file.readline()
+        while line:
+            try:
+                [key, val] = line.split('=')
+
+                if key.strip()[0] == '#':
+                    # ignore lines that are commented out
+                    pass
+                else:
+                    if key == "FILE_INDEX_HOST":
+                        config["hosts"] = val.strip()
+                    if key == "FILE_INDEX_PORT":
+                        config["port"] = val.strip()
+                    if key == "FILE_INDEX_USER":
+                        config["user"] = val.strip()
+                    if key == "FILE_INDEX_PASSWORD":
+                        config["password"] = val.strip()
+                    if key == "FILE_INDEX_USE_SSL":
+                        if val.strip() == "True":
+                            config["use_ssl"] = True
+                    if key == "FILE_INDEX_SNIFF":
+                        if val.strip() == "True":
+                            config["sniff"] = True
+                    if key == "FILE_INDEX_TIMEOUT":
+                        config["timeout"] = float(val.strip())
+                    if key == "FILE_INDEX_MAX_CONNECTIONS":
+                        config["max_connections"] = int(val.strip())
+            except ValueError as e:
+                # Ignore lines without a key value pair separted by '='
+                pass
+            line = env_file.readline()
+
+    if config["hosts"] is None:
+        raise Exception("Found no FILE_INDEX_HOST in .env")
+    if config["user"] is None:
+        raise Exception("Found no FILE_INDEX_USER in .env")
+    if config["password"] is None:
+        raise Exception("Found no FILE_INDEX_PASSWORD in .env")
+
+    config["hosts"] = parse_hosts(config["hosts"], config["port"])
+    return config
+
+def parse_hosts(value, default_port):
+    """Parses a comma separated list of `host` or `host:port` entries, FILE_INDEX_PORT is used for hosts without a port."""
+
+    hosts = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        (host, separator, port) = entry.rpartition(':')
+        if not separator or not port.isdigit():
+            (host, port) = (entry, default_port)
+        if port is None:
+            raise Exception(f"Found no port for '{entry}' and no FILE_INDEX_PORT in .env")
+        hosts.append({'host': host, 'port': port})
+
+    if not hosts:
+        raise Exception("Found no FILE_INDEX_HOST in .env")
+    return hosts
+
+class LimitedConnection(Urllib3HttpConnection):
+    """A connection to a single node that sends at most `max_requests` requests at the same time.
 
-if host is None:
-    raise Exception("Found no FILE_INDEX_HOST in .env")
-if port is None:
-    raise Exception("Found no FILE_INDEX_PORT in .env")
-if user is None:
-    raise Exception("Found no FILE_INDEX_USER in .env")
-if password is None:
-    raise Exception("Found no FILE_INDEX_PASSWORD in .env")
+    Further requests wait for a free slot. `inflight` counts the running and waiting
+    requests, it is used by the LeastBusySelector.
+    """
 
-auth = (user, password)
+    def __init__(self, max_requests=10, **kwargs):
+        super().__init__(**kwargs)
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.inflight_lock = threading.Lock()
+        self.inflight = 0
 
-client = OpenSearch(
-    hosts = [{'host': host, 'port': port}],
-    http_compress = True, # enables gzip compression for request bodies
-    http_auth = auth,
-    use_ssl = use_ssl
-)
+    def perform_request(self, *args, **kwargs):
+        with self.inflight_lock:
+            self.inflight += 1
+        try:
+            with self.slots:
+                return super().perform_request(*args, **kwargs)
+        finally:
+            with self.inflight_lock:
+                self.inflight -= 1
+
+class LeastBusySelector(ConnectionSelector):
+    """Selects the live node with the fewest requests in flight, nodes with the same number take turns.
+
+    Requests to a slow node take longer, so it gets fewer new requests than the others.
+    """
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self.turn = 0
+
+    def select(self, connections):
+        self.turn = (self.turn + 1) % len(connections)
+        rotated = connections[self.turn:] + connections[:self.turn]
+        return min(rotated, key=lambda connection: connection.inflight)
+
+def create_client(config):
+    """Creates a client for the nodes of the cluster.
+
+    Requests are spread over the nodes by the LeastBusySelector. Nodes that fail or time
+    out are put on a timeout by the connection pool and the request is retried on
+    another one, this is safe as all bulk actions carry their id. Each node keeps up to
+    `max_connections` connections alive, which is also the limit of parallel requests to it.
+    """
+
+    hosts = config["hosts"]
+    sniff = config["sniff"]
+    nodes = ", ".join(f"{host['host']}:{host['port']}" for host in hosts)
+    logging.info(f"Connecting to OpenSearch at {nodes}.")
+    return OpenSearch(
+        hosts = hosts,
+        http_compress = True, # enables gzip compression for request bodies
+        http_auth = (config["user"], config["password"]),
+        use_ssl = config["use_ssl"],
+        timeout = config["timeout"],
+        connection_class = LimitedConnection,
+        selector_class = LeastBusySelector,
+        # size of the pool of kept-alive connections per node
+        maxsize = config["max_connections"],
+        max_requests = config["max_connections"],
+        retry_on_timeout = len(hosts) > 1 or sniff,
+        sniff_on_start = sniff,
+        sniff_on_connection_fail = sniff,
+        sniffer_timeout = SNIFF_INTERVAL if sniff else None
+    )
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    """Returns the client for the cluster configured in .env, it is created on first use."""
+
+    global client
+    with client_lock:
+        if client is None:
+            client = create_client(read_env_file())
+        return client
 
 logging.getLogger('opensearch').setLevel(logging.WARNING)
 
+NEOFINDER_KEYWORD_FIELDS = [
+    "neofinder_catalog",
+    "neofinder_created",
+    "neofinder_export_file",
+    "neofinder_modified",
+    "neofinder_path",
+    "neofinder_size",
+    "neofinder_type",
+    "neofinder_volume"
+]
+
 def create_index(index_name, clear=False):
     try:
         # Create an index with non-default settings.
         index_body = {
+            "settings": {
+                "analysis": {
+                    "analyzer": {
+                        "path_tree": {
+                            "tokenizer": "path_hierarchy"
+                        }
+                    }
+                }
+            },
             "mappings":{
                 "properties":{
                     "created":{
@@ -75,17 +209,81 @@ def create_index(index_name, clear=False):
                     "size_bytes": {
                         "type": "long"
                     },
+                    # Rollups of directories, see directory_scan.DirectoryRollups
+                    "total_size_bytes": {
+                        "type": "long"
+                    },
+                    "total_files": {
+                        "type": "long"
+                    },
+                    "newest_modified": {
+                        "type": "date"
+                    },
+                    "mime_types": {
+                        "type": "nested",
+                        "properties": {
+                            "mime_type": {
+                                "type": "keyword"
+                            },
+                            "files": {
+                                "type": "long"
+                            },
+                            "size_bytes": {
+                                "type": "long"
+                            }
+                        }
+                    },
+                    "name": {
+                        "type": "text",
+                        "fields": {
+                            "keyword": {
+                                "type": "keyword",
+                                "ignore_above": 8191
+                            }
+                        }
+                    },
+                    "path": {
+                        "type": "text",
+                        "fields": {
+                            "keyword": {
+                                "type": "keyword",
+                                "ignore_above": 8191
+                            },
+                            # "path.tree" matches all documents below a directory, e.g. "a/b" matches "a/b/c.txt"
+                            "tree": {
+                                "type": "text",
+                                "analyzer": "path_tree",
+                                "search_analyzer": "keyword"
+                            }
+                        }
+                    },
+                    "size": {
+                        "type": "keyword"
+                    },
+                    "mime_type": {
+                        "type": "keyword"
+                    },
+                    "type": {
+                        "type": "keyword"
+                    },
+                    "checksum": {
+                        "type": "keyword"
+                    },
+                    "checksum_algorithm": {
+                        "type": "keyword"
+                    },
+                    **{field: {"type": "keyword", "ignore_above": 8191} for field in NEOFINDER_KEYWORD_FIELDS}
                 }
             }
         }
 
-        response = client.indices.create(index_name, body=index_body)
+        response = get_client().indices.create(index_name, body=index_body)
         logging.info(f"Created index: '{index_name}'.\n")
     except RequestError as e:
         if e.status_code == 400 and e.error == "resource_already_exists_exception":
             if clear:
                 logging.info(f"'{index_name}' index already exists, recreating...")
-                client.indices.delete(index_name)
+                get_client().indices.delete(index_name)
                 logging.info(f"Deleted index: '{index_name}'.")
                 create_index(index_name)
             else:
@@ -93,35 +291,297 @@ def create_index(index_name, clear=False):
         else:
             raise e
 
-def push_batch(docs, index_name):
+def get_bulk_load_settings(index_name):
+    """Returns the settings of an index that `end_bulk_load` restores after a large import.
+
+    Disabled refreshes and no replicas are the values of a bulk load that never finished
+    (e.g. a killed import), they are replaced by None, the OpenSearch default.
+    """
+
+    settings = get_client().indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+    refresh_interval = settings.get("refresh_interval")
+    number_of_replicas = settings.get("number_of_replicas")
+    return {
+        # None resets a setting to the OpenSearch default
+        "refresh_interval": None if str(refresh_interval) == "-1" else refresh_interval,
+        "number_of_replicas": None if str(number_of_replicas) == "0" else number_of_replicas
+    }
+
+def begin_bulk_load(index_name):
+    """Disables refreshes and replicas for a large import, see `get_bulk_load_settings` for the ones to restore."""
 
-    data = []
+    get_client().indices.put_settings(
+        index=index_name,
+        body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+    )
+    logging.info(f"Disabled refresh and replicas for '{index_name}' during import.")
 
-    for doc in docs:
+def end_bulk_load(index_name, previous, force_merge=False):
+    get_client().indices.put_settings(index=index_name, body={"index": previous})
+    get_client().indices.refresh(index=index_name)
+    logging.info(f"Restored settings {previous} for '{index_name}'.")
 
-        doc["indexed"] = datetime.now()
+    if force_merge:
+        logging.info(f"Force merging '{index_name}'...")
+        get_client().indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+        logging.info(f"Force merged '{index_name}'.")
+
+# Number of documents that share the same `indexed` timestamp.
+INDEXED_TIMESTAMP_BATCH = 500
+
+def generate_index_actions(docs, index_name):
+    """Yields index actions, the keys of `_source` are sorted when the chunk is serialized."""
+
+    indexed = None
+    for (position, doc) in enumerate(docs):
+
+        if position % INDEXED_TIMESTAMP_BATCH == 0:
+            indexed = datetime.now().isoformat()
+        doc["indexed"] = indexed
         doc["size"] = bytes_to_human_readable(doc["size_bytes"])
-        _id = doc["_id"]
-        del doc["_id"]
+        _id = doc.pop("_id")
 
-        data.append({
+        yield {
             '_op_type': 'index',
             '_index': index_name,
             '_id': _id,
-            '_source': dict(sorted(doc.items()))
-        })
-
-    try: 
-        (successes, errors) = helpers.bulk(
-            client,
-            data
-        )
-
-        if successes != len(docs):
-            raise Exception(errors)
-    except Exception as e:
-        logging.error(f"Exception while running bulk import:")
-        logging.error(e)
+            '_source': doc
+        }
+
+def generate_delete_actions(ids, index_name):
+
+    for _id in ids:
+        yield {
+            '_op_type': 'delete',
+            '_index': index_name,
+            '_id': _id
+        }
+
+# Bounds of the number of actions per bulk request if the chunk size is adapted.
+MIN_ADAPTIVE_CHUNK_SIZE = 10
+MAX_ADAPTIVE_CHUNK_SIZE = 10000
+
+class ChunkSizer:
+    """Adapts the number of actions per bulk request to the latency and rejections of the cluster.
+
+    The size grows by a quarter after each chunk of more than half the size that was sent
+    within `target_latency` seconds, smaller chunks (e.g. the last one) tell little about
+    the capacity of the cluster. It is halved after a slower request or one with actions
+    rejected with 429.
+    """
+
+    def __init__(self, chunk_size, target_latency):
+        self.size = chunk_size
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def record(self, actions, seconds, rejected):
+        with self.lock:
+            if rejected or seconds > self.target_latency:
+                # Based on the size of the chunk, so the rejections of several chunks
+                # sent at the same time only halve the size once.
+                self.size = max(MIN_ADAPTIVE_CHUNK_SIZE, min(self.size, actions // 2))
+            elif actions * 2 > self.size:
+                self.size = min(MAX_ADAPTIVE_CHUNK_SIZE, self.size + max(1, self.size // 4))
+
+class BulkSettings:
+    """Settings for `push_actions`, the defaults match the ones of the opensearch-py bulk helpers.
+
+    `serializer` is a backend of `lib.serializer`, by default orjson if it is installed.
+    If `target_latency` is set, `chunk_size` is only the initial size of the chunks,
+    see ChunkSizer.
+    """
+
+    def __init__(self, chunk_size=500, thread_count=4, max_chunk_bytes=10 * 1024 * 1024,
+                 max_inflight_bytes=100 * 1024 * 1024, max_retries=5, initial_backoff=2, max_backoff=120,
+                 serializer=None, target_latency=None):
+        self.chunk_size = chunk_size
+        self.thread_count = thread_count
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.serializer = serializer or get_backend()
+        self.chunk_sizer = ChunkSizer(chunk_size, target_latency) if target_latency else None
+
+    def get_chunk_size(self):
+        return self.chunk_sizer.size if self.chunk_sizer is not None else self.chunk_size
+
+bulk_settings = BulkSettings()
+
+# Optional key of a bulk action, its value is passed to the `on_acknowledged` callback
+# of `push_actions` once the action succeeded.
+CHECKPOINT_KEY = '_checkpoint'
+
+def push_actions(actions, settings=None, on_acknowledged=None):
+    """Streams bulk actions to OpenSearch using a pool of threads.
+
+    The actions are consumed lazily and serialized into chunks. At most
+    `max_inflight_bytes` of serialized chunks are queued or being sent at any
+    time, so memory stays bounded no matter how many actions are passed in.
+    If the chunk size is adapted, at most two chunks per thread are queued or
+    being sent, so new chunks follow the adapted size soon.
+
+    If given, `on_acknowledged` is called from the calling thread with the
+    CHECKPOINT_KEY values of the successful actions of each chunk.
+
+    Returns the number of successful and failed actions.
+    """
+    if settings is None:
+        settings = bulk_settings
+
+    inflight = threading.Condition()
+    inflight_bytes = 0
+    inflight_chunks = 0
+    max_inflight_chunks = 2 * settings.thread_count if settings.chunk_sizer is not None else None
+    successes = 0
+    failures = 0
+
+    def release(chunk_bytes):
+        nonlocal inflight_bytes, inflight_chunks
+        with inflight:
+            inflight_bytes -= chunk_bytes
+            inflight_chunks -= 1
+            inflight.notify_all()
+
+    def collect(future):
+        nonlocal successes, failures
+        (chunk_successes, chunk_failures, acknowledged) = future.result()
+        successes += chunk_successes
+        failures += chunk_failures
+        if on_acknowledged is not None and acknowledged:
+            on_acknowledged(acknowledged)
+
+    with ThreadPoolExecutor(max_workers=settings.thread_count) as executor:
+        futures = []
+        for (chunk, chunk_bytes) in chunk_actions(actions, settings):
+            with inflight:
+                inflight.wait_for(
+                    lambda: inflight_bytes == 0 or (
+                        inflight_bytes + chunk_bytes <= settings.max_inflight_bytes
+                        and (max_inflight_chunks is None or inflight_chunks < max_inflight_chunks)
+                    )
+                )
+                inflight_bytes += chunk_bytes
+                inflight_chunks += 1
+
+            future = executor.submit(send_chunk, chunk, settings)
+            future.add_done_callback(lambda _, chunk_bytes=chunk_bytes: release(chunk_bytes))
+            futures.append(future)
+
+            # Collect finished chunks right away, so the list of futures stays short.
+            while futures and futures[0].done():
+                collect(futures.pop(0))
+
+        for future in futures:
+            collect(future)
+
+    if failures > 0:
+        logging.error(f"{failures} bulk action(s) failed, {successes} succeeded.")
+    if settings.chunk_sizer is not None:
+        logging.info(f"Adapted the bulk chunk size to {settings.chunk_sizer.size} action(s).")
+
+    return (successes, failures)
+
+def chunk_actions(actions, settings):
+    """Serializes the actions and groups them by count and size, yields (chunk, size in bytes) pairs.
+
+    A chunk is a list of (lines, checkpoint) pairs, one for each action. The lines are
+    encoded like the opensearch-py serializer does, with the keys of documents sorted.
+    """
+
+    backend = settings.serializer
+
+    chunk = []
+    chunk_bytes = 0
+    for action in actions:
+        checkpoint = action.pop(CHECKPOINT_KEY, None)
+        (action_line, data) = helpers.expand_action(action)
+        start = time.perf_counter()
+        lines = [backend.dumps_compact(action_line)]
+        if data is not None:
+            lines.append(backend.dumps_compact(data, sort_keys=True))
+        metrics.observe("bulk_serialize_seconds", time.perf_counter() - start)
+        # +1 to account for the trailing new line character
+        action_bytes = sum(len(line) + 1 for line in lines)
+
+        if chunk and (len(chunk) >= settings.get_chunk_size() or chunk_bytes + action_bytes > settings.max_chunk_bytes):
+            yield (chunk, chunk_bytes)
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append((lines, checkpoint))
+        chunk_bytes += action_bytes
+
+    if chunk:
+        yield (chunk, chunk_bytes)
+
+def send_chunk(chunk, settings):
+    """Sends a single chunk, actions rejected with 429 are retried with an exponential backoff.
+
+    Returns the number of successful and failed actions and the checkpoints of the successful ones.
+    """
+
+    successes = 0
+    failures = 0
+    acknowledged = []
+
+    for attempt in range(settings.max_retries + 1):
+        if attempt > 0:
+            time.sleep(min(settings.max_backoff, settings.initial_backoff * 2 ** (attempt - 1)))
+
+        body = b"\n".join(line for (lines, _) in chunk for line in lines) + b"\n"
+        # Uncompressed size, the client compresses the body with gzip.
+        metrics.increment("bulk_bytes_sent", len(body))
+        start = time.perf_counter()
+        try:
+            response = get_client().bulk(body)
+        except TransportError as e:
+            if e.status_code == 429 and settings.chunk_sizer is not None:
+                settings.chunk_sizer.record(len(chunk), time.perf_counter() - start, True)
+            if e.status_code == 429 and attempt < settings.max_retries:
+                logging.warning(f"Bulk request rejected with 429, retrying {len(chunk)} action(s).")
+                metrics.increment("bulk_retried_actions", len(chunk))
+                continue
+            logging.error("Exception while running bulk import:")
+            logging.error(e)
+            metrics.increment("bulk_succeeded_actions", successes)
+            metrics.increment("bulk_failed_actions", failures + len(chunk))
+            return (successes, failures + len(chunk), acknowledged)
+        finally:
+            metrics.observe("bulk_request_seconds", time.perf_counter() - start)
+
+        rejected = []
+        for ((lines, checkpoint), item) in zip(chunk, response["items"]):
+            (op_type, result) = item.popitem()
+            status = result.get("status", 500)
+
+            if 200 <= status < 300 or (op_type == 'delete' and status == 404):
+                # Documents that are already missing from the index are no error for deletions.
+                successes += 1
+                if checkpoint is not None:
+                    acknowledged.append(checkpoint)
+            elif status == 429 and attempt < settings.max_retries:
+                rejected.append((lines, checkpoint))
+            else:
+                failures += 1
+                logging.error(f"Bulk {op_type} failed for '{result.get('_id')}': {result.get('error')}")
+
+        # Retries of rejected actions are smaller than the chunk, they only count if rejected again.
+        if settings.chunk_sizer is not None and (attempt == 0 or rejected):
+            settings.chunk_sizer.record(len(chunk), time.perf_counter() - start, len(rejected) > 0)
+
+        if not rejected:
+            break
+
+        logging.warning(f"{len(rejected)} action(s) rejected with 429, retrying.")
+        metrics.increment("bulk_retried_actions", len(rejected))
+        chunk = rejected
+
+    metrics.increment("bulk_succeeded_actions", successes)
+    metrics.increment("bulk_failed_actions", failures)
+    return (successes, failures, acknowledged)
 
 def bytes_to_human_readable(number: int):
     if number is None:
@@ -6,6 +6,9 @@ def get_logging_dir(target_directory=""):
 def get_output_base_dir(target_directory=""):
     return create(f'output/{target_directory}')
 
+def get_state_dir(target_directory=""):
+    return create(f'state/{target_directory}')
+
 def create(path):
 
     try:
@@ -0,0 +1,217 @@
+import logging
+import queue
+import threading
+
+from lib import serializer
+
+# Indexes documents while they are produced by the export scripts, without writing
+# and reading intermediate files. lib.open_search is only imported once indexing is
+# actually used, it needs the opensearch-py package of requirements_import.txt.
+
+# Items of the queue besides documents.
+FLUSH = object()
+CLOSE = object()
+
+
+def add_bulk_arguments(parser):
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="Number of documents per bulk request, default: 500.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Number of parallel bulk requests, default: 4.",
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        type=int,
+        default=10,
+        help="Maximum size of a bulk request in MB, default: 10.",
+    )
+    parser.add_argument(
+        "--max-inflight-bytes",
+        type=int,
+        default=100,
+        help="Maximum size of all queued and running bulk requests in MB, default: 100.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="Number of retries for documents rejected with 429 (too many requests), default: 5.",
+    )
+    parser.add_argument(
+        "--target-latency",
+        type=float,
+        help="Adapt the number of documents per bulk request, so requests take at most this many seconds "
+        "and are not rejected, --chunk-size is the initial size, optional.",
+    )
+
+
+def add_index_arguments(parser):
+    """Adds the options of the direct indexing mode of the export scripts."""
+
+    parser.add_argument(
+        "--index",
+        type=str,
+        help="Index the documents into this OpenSearch index while they are produced, "
+        "use '--format none' to skip writing the output files.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=10000,
+        help="Number of documents waiting to be indexed before the export pauses, default: 10000.",
+    )
+    add_bulk_arguments(parser)
+
+
+def create_bulk_settings(options):
+    from lib import open_search
+
+    return open_search.BulkSettings(
+        chunk_size=options["chunk_size"],
+        thread_count=options["threads"],
+        max_chunk_bytes=options["max_chunk_bytes"] * 1024 * 1024,
+        max_inflight_bytes=options["max_inflight_bytes"] * 1024 * 1024,
+        max_retries=options["max_retries"],
+        target_latency=options.get("target_latency"),
+        serializer=serializer.get_backend(options.get("serializer", "auto")),
+    )
+
+
+def create_index(index_name):
+    from lib import open_search
+
+    open_search.create_index(index_name)
+
+
+def create_pipeline(options):
+    """Returns an IndexPipeline if the options enable direct indexing, else None."""
+
+    if not options.get("index"):
+        return None
+    return IndexPipeline(
+        options["index"], create_bulk_settings(options), options["queue_size"]
+    )
+
+
+class IndexPipeline:
+    """Feeds documents through a bounded queue into `open_search.push_actions`.
+
+    The bulk requests are sent by a background thread while the producer continues,
+    a full queue blocks the producer. `flush` waits until all documents written so
+    far were sent, e.g. before a checkpoint is saved. `flush`, `delete` and `close`
+    raise if documents failed since the last of these calls, so the caller does not
+    save progress the index does not contain.
+    """
+
+    def __init__(self, index_name, settings, queue_size=10000):
+        self.index_name = index_name
+        self.settings = settings
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flushed = threading.Semaphore(0)
+        self.error = None
+
+        self.successes = 0
+        self.failures = 0
+        self.reported_failures = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        from lib import open_search
+
+        try:
+            closed = False
+            while not closed:
+                last_item = None
+
+                def documents():
+                    nonlocal last_item
+                    while True:
+                        item = self.queue.get()
+                        if item is FLUSH or item is CLOSE:
+                            last_item = item
+                            return
+                        yield item
+
+                successes, failures = open_search.push_actions(
+                    open_search.generate_index_actions(documents(), self.index_name),
+                    self.settings,
+                )
+                self.successes += successes
+                self.failures += failures
+
+                closed = last_item is CLOSE
+                self.flushed.release()
+        except Exception as e:
+            self.error = e
+            self.flushed.release()
+
+    def put(self, item):
+        # Waits for free space in the queue, unless the indexing thread failed.
+        while True:
+            self.raise_error()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def raise_error(self):
+        if self.error is not None:
+            raise Exception(f"Indexing failed: {self.error}")
+
+    def raise_failures(self):
+        failures = self.failures - self.reported_failures
+        self.reported_failures = self.failures
+        if failures > 0:
+            raise Exception(
+                f"{failures} document(s) failed to index into '{self.index_name}'."
+            )
+
+    def write(self, document):
+        # The document may still be held by a writer, indexing adds and removes fields.
+        self.put(dict(document))
+
+    def flush(self):
+        self.put(FLUSH)
+        self.flushed.acquire()
+        self.raise_error()
+        self.raise_failures()
+
+    def delete(self, ids):
+        """Deletes the documents with the given ids, call after `flush` or `close`."""
+
+        from lib import open_search
+
+        successes, failures = open_search.push_actions(
+            open_search.generate_delete_actions(ids, self.index_name), self.settings
+        )
+        logging.info(
+            f"Deleted {successes} documents from '{self.index_name}', {failures} failed."
+        )
+        if failures > 0:
+            raise Exception(
+                f"{failures} document(s) failed to delete from '{self.index_name}'."
+            )
+
+    def close(self):
+        """Waits until all documents were sent, returns the number of successful and failed ones."""
+
+        self.put(CLOSE)
+        self.flushed.acquire()
+        self.thread.join()
+        self.raise_error()
+
+        logging.info(
+            f"Indexed {self.successes} documents into '{self.index_name}', {self.failures} failed."
+        )
+        self.raise_failures()
+        return (self.successes, self.failures)
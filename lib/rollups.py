@@ -0,0 +1,79 @@
+import logging
+from datetime import datetime, timezone
+
+# Sums up the size, number of files, newest modification time and MIME types of the
+# files below a directory, see `directory_scan.DirectoryRollups`.
+#
+# A rollup is a dict that can be stored as JSON:
+# {"size_bytes": 0, "files": 0, "newest": None, "mime_types": {mime_type: [files, size_bytes]}}
+# with newest being the modification time of the newest file as a POSIX timestamp.
+
+DATE_FIELDS = ["modified", "created", "newest_modified"]
+
+
+def empty_rollup():
+    return {"size_bytes": 0, "files": 0, "newest": None, "mime_types": {}}
+
+
+def create_rollup(files):
+    """Returns the rollup of the given (document, stats) tuples of files."""
+
+    rollup = empty_rollup()
+    for document, stats in files:
+        add_file(rollup, stats.st_size, stats.st_mtime, document.get("mime_type"))
+    return rollup
+
+
+def add_file(rollup, size, mtime, mime_type):
+    rollup["size_bytes"] += size
+    rollup["files"] += 1
+    if rollup["newest"] is None or mtime > rollup["newest"]:
+        rollup["newest"] = mtime
+    if mime_type:
+        counts = rollup["mime_types"].setdefault(mime_type, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+
+def add_rollup(rollup, other):
+    rollup["size_bytes"] += other["size_bytes"]
+    rollup["files"] += other["files"]
+    if other["newest"] is not None and (
+        rollup["newest"] is None or other["newest"] > rollup["newest"]
+    ):
+        rollup["newest"] = other["newest"]
+    for mime_type, (files, size) in other["mime_types"].items():
+        counts = rollup["mime_types"].setdefault(mime_type, [0, 0])
+        counts[0] += files
+        counts[1] += size
+
+
+def copy_rollup(rollup):
+    return {
+        **rollup,
+        "mime_types": {
+            mime_type: list(counts)
+            for mime_type, counts in rollup["mime_types"].items()
+        },
+    }
+
+
+def rollup_fields(rollup):
+    """Returns the document fields of a rollup."""
+
+    newest_modified = None
+    if rollup["newest"] is not None:
+        try:
+            newest_modified = datetime.fromtimestamp(rollup["newest"], tz=timezone.utc)
+        except Exception:
+            logging.error(f"Unable to parse modified date {rollup['newest']}.")
+
+    return {
+        "total_size_bytes": rollup["size_bytes"],
+        "total_files": rollup["files"],
+        "newest_modified": newest_modified,
+        "mime_types": [
+            {"mime_type": mime_type, "files": files, "size_bytes": size}
+            for mime_type, (files, size) in sorted(rollup["mime_types"].items())
+        ],
+    }
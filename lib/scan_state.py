@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# Stores the file system metadata seen by the last run of export_directory.py, used
+# by the incremental mode to find new, modified and deleted entries, and the rollups
+# of the directories (see directory_scan.DirectoryRollups).
+
+
+class ScanState:
+    def __init__(self, database_path, root_path, resume=False, connection=None):
+        """Starts a new run, or continues the last one if resume is set.
+
+        A connection to the database can be passed in, to commit other changes (e.g. a
+        checkpoint) together with the state.
+        """
+        self.database_path = database_path
+        if connection is None:
+            connection = sqlite3.connect(database_path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+        self.connection = connection
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                is_dir INTEGER NOT NULL,
+                size INTEGER,
+                mtime INTEGER,
+                ctime INTEGER,
+                inode INTEGER,
+                run INTEGER NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)"
+        )
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS rollups (
+                path TEXT PRIMARY KEY,
+                direct TEXT NOT NULL,
+                total TEXT NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+        stored_root = self.get_meta("root_path")
+        if stored_root is not None and stored_root != root_path:
+            raise Exception(
+                f"State in {database_path} belongs to '{stored_root}', not '{root_path}'."
+            )
+        self.set_meta("root_path", root_path)
+
+        self.run = int(self.get_meta("run") or 0)
+        if not resume:
+            self.run += 1
+        self.set_meta("run", self.run)
+        self.connection.commit()
+
+        # Lookups are done by the walker threads, each of them gets its own read
+        # connection. All writes go through the main connection.
+        self.local = threading.local()
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    def read_connection(self):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.database_path)
+        return self.local.connection
+
+    def lookup(self, path):
+        """Returns the stored (size, mtime, ctime, inode) for path or None."""
+        return (
+            self.read_connection()
+            .execute(
+                "SELECT size, mtime, ctime, inode FROM entries WHERE path = ?", (path,)
+            )
+            .fetchone()
+        )
+
+    def child_directories(self, path):
+        return [
+            row[0]
+            for row in self.read_connection().execute(
+                "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (path,)
+            )
+        ]
+
+    def get_rollup(self, path):
+        """Returns the stored (direct, total) rollups of a directory or None."""
+        row = (
+            self.read_connection()
+            .execute("SELECT direct, total FROM rollups WHERE path = ?", (path,))
+            .fetchone()
+        )
+        return (json.loads(row[0]), json.loads(row[1])) if row else None
+
+    def get_current_rollups(self, path):
+        """Returns the stored (direct, total) rollups of a directory and the totals of its subdirectories.
+
+        Unlike `get_rollup`, this reads through the main connection and includes the
+        changes that were not committed yet, so it must be called by the writing thread.
+        """
+        row = self.connection.execute(
+            "SELECT direct, total FROM rollups WHERE path = ?", (path,)
+        ).fetchone()
+        children = [
+            json.loads(total)
+            for (total,) in self.connection.execute(
+                "SELECT rollups.total FROM rollups JOIN entries "
+                "ON entries.path = rollups.path WHERE entries.parent = ? AND entries.is_dir = 1",
+                (path,),
+            )
+        ]
+        return ((json.loads(row[0]), json.loads(row[1])) if row else None, children)
+
+    def set_rollup(self, path, direct, total):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO rollups VALUES (?, ?, ?)",
+            (path, json.dumps(direct), json.dumps(total)),
+        )
+
+    def clear_rollups(self):
+        """Removes all rollups, e.g. after a run that did not keep them up to date."""
+        self.connection.execute("DELETE FROM rollups")
+
+    def record(self, entries):
+        """Stores (path, parent, is_dir, size, mtime, ctime, inode) tuples as seen in this run."""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*entry, self.run) for entry in entries],
+        )
+
+    def keep_children(self, path):
+        """Marks all direct children of an unchanged directory as seen in this run."""
+        self.connection.execute(
+            "UPDATE entries SET run = ? WHERE parent = ?", (self.run, path)
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def start_run(self):
+        """Starts another run on the same state, e.g. to rescan a subtree."""
+        self.run += 1
+        self.set_meta("run", self.run)
+
+    def finish(self, path=None, commit=True):
+        """Removes and yields the paths of all entries that were not seen in this run.
+
+        If a path is given, only the entries below it are considered, for runs that
+        rescanned a single subtree. Without commit, the caller commits once the deleted
+        entries were also removed elsewhere, e.g. from the index.
+        """
+        condition, parameters = subtree_condition(path, include_root=False)
+        cursor = self.connection.execute(
+            f"SELECT path FROM entries WHERE run != ? AND {condition} ORDER BY path",
+            (self.run, *parameters),
+        )
+        for (deleted,) in cursor:
+            yield deleted
+
+        self.connection.execute(
+            f"DELETE FROM entries WHERE run != ? AND {condition}",
+            (self.run, *parameters),
+        )
+        self.connection.execute(
+            "DELETE FROM rollups WHERE path NOT IN (SELECT path FROM entries)"
+        )
+        if commit:
+            self.connection.commit()
+            logging.info(f"Updated scan state in {self.database_path}.")
+
+    def remove_subtree(self, path):
+        """Removes the entry of path and all entries below it, returns their paths."""
+        condition, parameters = subtree_condition(path, include_root=True)
+        paths = [
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT path FROM entries WHERE {condition} ORDER BY path", parameters
+            )
+        ]
+        self.connection.execute(f"DELETE FROM entries WHERE {condition}", parameters)
+        self.connection.execute(f"DELETE FROM rollups WHERE {condition}", parameters)
+        return paths
+
+
+def subtree_condition(path, include_root):
+    """Returns an SQL condition and its parameters matching the entries below path.
+
+    The root directory is the empty path, None matches all entries.
+
+    Paths below 'a/b' sort between 'a/b/' and 'a/b0', as '0' follows '/'. Unlike
+    LIKE, the range is case-sensitive and can use the primary key.
+    """
+    if path is None:
+        return ("1", ())
+    if path == "":
+        return ("1", ()) if include_root else ("path != ''", ())
+
+    condition = "(path > ? AND path < ?)"
+    parameters = (f"{path}/", f"{path}0")
+    if include_root:
+        condition = f"(path = ? OR {condition})"
+        parameters = (path, *parameters)
+    return (condition, parameters)
+
+
+def entry_from_stats(path, is_dir, stats):
+    return (
+        path,
+        os.path.dirname(path) if path else None,
+        int(is_dir),
+        stats.st_size,
+        stats.st_mtime_ns,
+        stats.st_ctime_ns,
+        stats.st_ino,
+    )
@@ -0,0 +1,88 @@
+import json
+from datetime import date, datetime
+
+# JSON backends used for the export files and the bulk requests. orjson encodes
+# datetimes natively and is used when it is installed, the standard library is the
+# fallback. Both produce the same bytes for the bulk requests sent to OpenSearch.
+
+BACKENDS = ["auto", "orjson", "json"]
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError("Type %s not serializable" % type(obj))
+
+
+def add_serializer_argument(parser):
+    parser.add_argument(
+        "--serializer",
+        choices=BACKENDS,
+        default="auto",
+        help="JSON library, 'auto' uses orjson if it is installed, default: auto.",
+    )
+
+
+class StdlibBackend:
+    name = "json"
+
+    def dumps(self, obj):
+        """Encodes obj for the export files."""
+        return json.dumps(obj, default=json_serial).encode("utf-8")
+
+    def dumps_compact(self, obj, sort_keys=False):
+        """Encodes obj the way opensearch-py does for requests, optionally with sorted keys."""
+        # Like opensearch-py, surrogate escapes of undecodable file names are kept.
+        return json.dumps(
+            obj,
+            default=json_serial,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            sort_keys=sort_keys,
+        ).encode("utf-8", "surrogatepass")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonBackend(StdlibBackend):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+
+    def dumps(self, obj):
+        try:
+            return self.orjson.dumps(obj)
+        except self.orjson.JSONEncodeError:
+            # e.g. file names with surrogate escapes or integers above 64 bit.
+            return super().dumps(obj)
+
+    def dumps_compact(self, obj, sort_keys=False):
+        try:
+            return self.orjson.dumps(
+                obj, option=self.orjson.OPT_SORT_KEYS if sort_keys else 0
+            )
+        except self.orjson.JSONEncodeError:
+            return super().dumps_compact(obj, sort_keys)
+
+    def loads(self, data):
+        try:
+            return self.orjson.loads(data)
+        except self.orjson.JSONDecodeError:
+            # orjson rejects the escaped surrogates of undecodable file names.
+            return super().loads(data)
+
+
+def get_backend(name="auto"):
+    if name in ["auto", "orjson"]:
+        try:
+            return OrjsonBackend()
+        except ImportError:
+            if name == "orjson":
+                raise Exception("The orjson serializer requires the 'orjson' package.")
+    return StdlibBackend()
@@ -0,0 +1,299 @@
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+from lib import export_files, metrics, serializer
+
+# Answers filter and aggregation queries on the files of an export without importing
+# them into OpenSearch, used by query_export.py.
+#
+# The documents are loaded into an SQLite database next to the export files on first
+# use. Its indexes on path, size_bytes, modified, mime_type and extension turn the
+# filters into range scans: a path prefix is the range of paths between the prefix and
+# the prefix followed by '0' (the character after '/'), sizes and dates are ranges of
+# sorted values and each MIME type lists its documents. The database is rebuilt once
+# the export files change.
+#
+# Dates are compared as they were written by the export, as ISO strings. A date
+# without a time (e.g. 2010-01-01) compares as the start of that day.
+#
+# SQLite only stores valid UTF-8, the bytes of file names that are not (held as
+# surrogate escapes) are stored as escapes like '\xff' in the indexed columns, and
+# the filters are converted the same way. The documents themselves are unchanged.
+
+INDEX_FILE_NAME = "query_index.sqlite"
+INDEX_VERSION = 1
+
+# Number of documents inserted at once while the index is built.
+INSERT_BATCH_SIZE = 10000
+
+INDEXED_COLUMNS = ["path", "size_bytes", "modified", "mime_type", "extension"]
+
+GROUP_BY_EXPRESSIONS = {
+    "mime_type": "mime_type",
+    "type": "type",
+    "extension": "extension",
+    "directory": "directory",
+    "year": "substr(modified, 1, 4)",
+}
+
+SORT_COLUMNS = ["path", "size_bytes", "modified"]
+
+# Directories are left out of the sizes summed up by the aggregations, their size is
+# not the one of their content.
+FILE_SIZE = "CASE WHEN type = 'directory' THEN 0 ELSE size_bytes END"
+
+
+def get_export_files(export_directory):
+    """Returns the name, size and modification time of the export files, sorted by name."""
+
+    return sorted(
+        [f.name, f.stat().st_size, f.stat().st_mtime_ns]
+        for f in os.scandir(export_directory)
+        if f.is_file() and export_files.is_export_file(f.name)
+    )
+
+
+def to_text(value):
+    """Returns a string SQLite can store, surrogate escapes become escapes like '\\xff'."""
+
+    try:
+        value.encode("utf-8")
+        return value
+    except UnicodeEncodeError:
+        pass
+    try:
+        encoded = value.encode("utf-8", "surrogateescape")
+    except UnicodeEncodeError:
+        encoded = value.encode("utf-8", "surrogatepass")
+    return encoded.decode("utf-8", "backslashreplace")
+
+
+def get_string(document, key):
+    value = document.get(key)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return to_text(value) if isinstance(value, str) else None
+
+
+def get_extension(name):
+    if name is None:
+        return None
+    return os.path.splitext(name)[1].lstrip(".").lower()
+
+
+def create_row(document, encoded):
+    size = document.get("size_bytes")
+    if not isinstance(size, int) or isinstance(size, bool):
+        size = None
+    path = get_string(document, "path")
+    name = get_string(document, "name")
+
+    return (
+        path,
+        path.rpartition("/")[0] if path is not None else None,
+        name,
+        get_extension(name),
+        get_string(document, "type"),
+        get_string(document, "mime_type"),
+        size,
+        get_string(document, "modified"),
+        get_string(document, "created"),
+        encoded,
+    )
+
+
+def build_index(export_directory, index_path, files, backend):
+    """Loads the documents of all export files into a new database at index_path.
+
+    The database is written to a temporary file first, so an interrupted build is
+    never used.
+    """
+
+    temp_path = f"{index_path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("""CREATE TABLE documents (
+            path TEXT,
+            directory TEXT,
+            name TEXT,
+            extension TEXT,
+            type TEXT,
+            mime_type TEXT,
+            size_bytes INTEGER,
+            modified TEXT,
+            created TEXT,
+            document BLOB NOT NULL
+        )""")
+    connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    insert = "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    progress_meter = metrics.ProgressMeter("documents")
+    count = 0
+    for name, _, _ in files:
+        rows = []
+        for document in export_files.read_documents(
+            f"{export_directory}/{name}", backend
+        ):
+            rows.append(create_row(document, backend.dumps(document)))
+            if len(rows) == INSERT_BATCH_SIZE:
+                connection.executemany(insert, rows)
+                progress_meter.update(len(rows))
+                count += len(rows)
+                rows = []
+        connection.executemany(insert, rows)
+        progress_meter.update(len(rows))
+        count += len(rows)
+
+    # Creating the indexes after loading is faster than updating them on each insert.
+    for column in INDEXED_COLUMNS:
+        connection.execute(f"CREATE INDEX documents_{column} ON documents ({column})")
+    connection.execute("ANALYZE")
+    connection.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?)",
+        [("version", str(INDEX_VERSION)), ("files", json.dumps(files))],
+    )
+    connection.commit()
+    connection.close()
+
+    os.replace(temp_path, index_path)
+    logging.info(
+        f"Indexed {count} documents of {len(files)} files into '{index_path}'."
+    )
+
+
+def is_current(index_path, files):
+    connection = sqlite3.connect(index_path)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+    return meta.get("version") == str(INDEX_VERSION) and meta.get(
+        "files"
+    ) == json.dumps(files)
+
+
+def open_index(export_directory, index_path=None, rebuild=False, backend=None):
+    """Returns a connection to the index of an export, it is built if it is missing or outdated."""
+
+    if index_path is None:
+        index_path = f"{export_directory}/{INDEX_FILE_NAME}"
+    if backend is None:
+        backend = serializer.get_backend()
+
+    files = get_export_files(export_directory)
+    if not files:
+        raise Exception(f"Found no export files in '{export_directory}'.")
+
+    if rebuild or not os.path.exists(index_path) or not is_current(index_path, files):
+        logging.info(f"Building the query index of '{export_directory}'.")
+        build_index(export_directory, index_path, files, backend)
+
+    return sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+
+
+def create_conditions(filters):
+    """Returns the SQL condition and its parameters for a dict of filters.
+
+    path: documents at or below this path.
+    name: a glob pattern for the name, e.g. '*.tif'.
+    mime_types, types, extensions: lists of accepted values.
+    min_size, max_size: bounds of size_bytes in bytes, inclusive.
+    modified_after, modified_before: bounds of modified, inclusive and exclusive.
+    """
+
+    conditions = []
+    parameters = []
+
+    path = to_text(filters.get("path") or "").strip("/")
+    if path not in ["", "."]:
+        # The range holds the path itself, the paths below it and the ones continuing
+        # with a character before '/', e.g. 'a-b' for 'a', which the second check skips.
+        conditions.append("path >= ? AND path < ? AND (path = ? OR path > ?)")
+        parameters += [path, f"{path}0", path, f"{path}/"]
+
+    if filters.get("name"):
+        conditions.append("name GLOB ?")
+        parameters.append(to_text(filters["name"]))
+
+    for key, column in [
+        ("mime_types", "mime_type"),
+        ("types", "type"),
+        ("extensions", "extension"),
+    ]:
+        values = filters.get(key)
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' for _ in values)})")
+            parameters += [to_text(value) for value in values]
+
+    for key, condition in [
+        ("min_size", "size_bytes >= ?"),
+        ("max_size", "size_bytes <= ?"),
+        ("modified_after", "modified >= ?"),
+        ("modified_before", "modified < ?"),
+    ]:
+        if filters.get(key) is not None:
+            conditions.append(condition)
+            parameters.append(filters[key])
+
+    if not conditions:
+        return ("1", [])
+    return (" AND ".join(f"({condition})" for condition in conditions), parameters)
+
+
+def find_documents(connection, filters, sort=None, descending=False, limit=None):
+    """Lazily yields the matching documents, serialized as they are stored in the index."""
+
+    condition, parameters = create_conditions(filters)
+    query = f"SELECT document FROM documents WHERE {condition}"
+    if sort is not None:
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Unable to sort by '{sort}'.")
+        query += f" ORDER BY {sort} {'DESC' if descending else 'ASC'}"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters = parameters + [limit]
+
+    for (document,) in connection.execute(query, parameters):
+        yield document
+
+
+def aggregate(connection, filters, group_by):
+    """Yields (value, documents, size in bytes) for each value of group_by, the largest first."""
+
+    if group_by not in GROUP_BY_EXPRESSIONS:
+        raise ValueError(f"Unable to group by '{group_by}'.")
+
+    condition, parameters = create_conditions(filters)
+    expression = GROUP_BY_EXPRESSIONS[group_by]
+    query = (
+        f"SELECT {expression} AS value, COUNT(*) AS documents, "
+        f"COALESCE(SUM({FILE_SIZE}), 0) AS size FROM documents WHERE {condition} "
+        "GROUP BY value ORDER BY size DESC, documents DESC, value"
+    )
+    yield from connection.execute(query, parameters)
+
+
+def summarize(connection, filters):
+    """Returns the number of matching documents, the sum of their sizes and the range of their modification dates."""
+
+    condition, parameters = create_conditions(filters)
+    documents, size, oldest, newest = connection.execute(
+        f"SELECT COUNT(*), COALESCE(SUM({FILE_SIZE}), 0), MIN(modified), MAX(modified) "
+        f"FROM documents WHERE {condition}",
+        parameters,
+    ).fetchone()
+    return {
+        "documents": documents,
+        "size_bytes": size,
+        "oldest_modified": oldest,
+        "newest_modified": newest,
+    }
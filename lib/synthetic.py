@@ -0,0 +1,185 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+# Generators for the synthetic inputs of benchmark.py. All generators are seeded, the
+# same parameters always produce the same input.
+
+FILE_EXTENSIONS = [".txt", ".jpg", ".pdf", ".mp3", ".docx", ".tar.gz", ".py", ""]
+
+# Files without a known extension get one of these headers, so MIME sniffing has
+# something to recognise.
+SNIFFABLE_HEADERS = [
+    b"\x89PNG\r\n\x1a\n",
+    b"%PDF-1.4\n",
+    b"PK\x03\x04",
+    b"\xff\xd8\xff\xe0",
+    b"plain text without magic number\n",
+]
+
+NEOFINDER_HEADINGS = [
+    "Name",
+    "Pfad",
+    "Größe",
+    "Erstelldatum",
+    "Änderungsdatum",
+    "Art",
+    "Name des Volumes",
+    "Katalog",
+    "Beschreibung:",
+    "media_info",
+]
+
+NEOFINDER_TYPES = ["", "-", "Ordner", "JPEG-Bild", "PDF-Dokument"]
+
+GERMAN_MONTHS = [
+    "Januar",
+    "Februar",
+    "März",
+    "April",
+    "Mai",
+    "Juni",
+    "Juli",
+    "August",
+    "September",
+    "Oktober",
+    "November",
+    "Dezember",
+]
+
+# Descriptions containing line breaks, NeoFinder writes them unescaped which breaks
+# the row into several lines. The second one also contains a tab, the exporter can not
+# recombine such rows and counts them as faulty.
+BROKEN_DESCRIPTIONS = ["zeile1\nzeile2", "a\nb\tc"]
+
+
+def generate_tree(
+    root_path,
+    depth=3,
+    fan_out=4,
+    files_per_directory=50,
+    file_size=1024,
+    empty_ratio=0.05,
+    symlink_ratio=0.01,
+    seed=1,
+):
+    """Creates a directory tree below `root_path` and returns the number of entries by kind.
+
+    Every directory above `depth` has `fan_out` subdirectories and each directory holds
+    `files_per_directory` entries. Of those, `empty_ratio` are empty files and
+    `symlink_ratio` are symlinks to files, a tenth of them broken. Symlinks never point
+    to directories, the exporter follows them.
+    """
+
+    rng = random.Random(seed)
+    counts = {"directories": 0, "files": 0, "empty_files": 0, "symlinks": 0, "bytes": 0}
+    content = rng.randbytes(file_size)
+
+    os.makedirs(root_path, exist_ok=True)
+    pending = [(root_path, 0)]
+    while pending:
+        current, level = pending.pop()
+
+        previous_file = None
+        for index in range(files_per_directory):
+            extension = rng.choice(FILE_EXTENSIONS)
+            path = f"{current}/file_{index}{extension}"
+            choice = rng.random()
+
+            if choice < symlink_ratio and previous_file is not None:
+                target = previous_file if rng.random() >= 0.1 else f"{path}.missing"
+                os.symlink(target, path)
+                counts["symlinks"] += 1
+                continue
+
+            with open(path, "wb") as f:
+                if choice < symlink_ratio + empty_ratio:
+                    counts["empty_files"] += 1
+                else:
+                    size = rng.randint(1, file_size)
+                    if extension == "":
+                        f.write(rng.choice(SNIFFABLE_HEADERS))
+                    f.write(content[:size])
+                    counts["bytes"] += f.tell()
+            counts["files"] += 1
+            previous_file = os.path.basename(path)
+
+        if level < depth:
+            for index in range(fan_out):
+                path = f"{current}/directory_{index}"
+                os.mkdir(path)
+                counts["directories"] += 1
+                pending.append((path, level + 1))
+
+    return counts
+
+
+def neofinder_size(rng):
+    size = rng.randint(0, 10**9)
+    variant = rng.random()
+    if variant < 0.45:
+        return str(size)
+    if variant < 0.95:
+        # "481,6 KB (481.631 Bytes)"
+        kilobytes = f"{size / 1000:.1f}".replace(".", ",")
+        grouped = f"{size:,}".replace(",", ".")
+        return f"{kilobytes} KB ({grouped} Bytes)"
+    return "-"
+
+
+def neofinder_date(rng):
+    value = datetime(2000, 1, 1) + timedelta(seconds=rng.randint(0, 25 * 365 * 86400))
+    variant = rng.random()
+    if variant < 0.6:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if variant < 0.8:
+        return value.strftime("%d.%m.%Y")
+    if variant < 0.95:
+        month = GERMAN_MONTHS[value.month - 1]
+        return f"{value.day}. {month} {value.year} um {value.hour}:{value.minute:02}"
+    if variant < 0.99:
+        return rng.choice(["-", ""])
+    # Only understood by dateparser
+    return value.strftime("%B %d, %Y")
+
+
+def generate_neofinder_export(path, rows, broken_ratio=0.01, seed=1, encoding="utf-8"):
+    """Writes a NeoFinder export with `rows` data rows and returns the number of lines.
+
+    The rows mix the size and date variants found in real exports, `broken_ratio` of
+    them have a description with line breaks.
+    """
+
+    rng = random.Random(seed)
+    catalog = f"Katalog {seed}"
+    volume = f"Volume {seed}"
+
+    lines = 1
+    with open(path, "w", encoding=encoding, newline="\n") as f:
+        f.write("\t".join(NEOFINDER_HEADINGS) + "\n")
+        for row in range(rows):
+            name = f"datei_{row}{rng.choice(FILE_EXTENSIONS)}"
+            folders = ":".join(
+                f"ordner_{rng.randint(0, 20)}" for _ in range(rng.randint(1, 6))
+            )
+            description = ""
+            if rng.random() < broken_ratio:
+                description = rng.choice(BROKEN_DESCRIPTIONS)
+
+            values = [
+                name,
+                f"{catalog}:{folders}:{name}",
+                neofinder_size(rng),
+                neofinder_date(rng),
+                neofinder_date(rng),
+                rng.choice(NEOFINDER_TYPES),
+                volume,
+                catalog,
+                description,
+                "info",
+            ]
+            line = "\t".join(values) + "\n"
+            f.write(line)
+            lines += line.count("\n")
+
+    return lines
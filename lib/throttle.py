@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+# Number of latency samples averaged before the concurrency limit is adjusted.
+LATENCY_WINDOW = 100
+
+# The concurrency limit is halved once the average latency of a window exceeds the
+# baseline by this factor.
+LATENCY_TOLERANCE = 2.0
+
+# Fraction of the gap by which the baseline follows higher averages, so a storage
+# that stays slower is accepted after a while.
+BASELINE_ADAPTATION = 0.05
+
+# Seconds between two checks for a different time-of-day profile.
+PROFILE_CHECK_INTERVAL = 10
+
+
+class RateLimiter:
+    """Limits the rate of an operation (e.g. bytes read per second) across threads."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.next_time = min(self.next_time, time.monotonic())
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + amount / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class AdaptiveLimit:
+    """Limits the number of parallel operations, the limit adapts to their latency.
+
+    The average latency of each window of LATENCY_WINDOW operations is compared with
+    a baseline, the lowest average seen so far that slowly follows higher ones. If it
+    is more than LATENCY_TOLERANCE times higher, the storage is busy and the limit is
+    halved, otherwise it grows by one up to `max_limit`.
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.lowest_limit = self.limit
+        self.condition = threading.Condition()
+        self.running = 0
+
+        self.baseline = None
+        self.window_sum = 0
+        self.window_count = 0
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.running < self.limit)
+            self.running += 1
+
+    def release(self, seconds=None):
+        with self.condition:
+            self.running -= 1
+            if seconds is not None:
+                self.window_sum += seconds
+                self.window_count += 1
+                if self.window_count == LATENCY_WINDOW:
+                    self.adapt(self.window_sum / self.window_count)
+                    self.window_sum = 0
+                    self.window_count = 0
+            self.condition.notify_all()
+
+    def adapt(self, average):
+        if self.baseline is None or average < self.baseline:
+            self.baseline = average
+        elif average > self.baseline * LATENCY_TOLERANCE:
+            self.limit = max(1, self.limit // 2)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            logging.debug(
+                f"I/O latency rose to {average * 1000:.3f} ms, limiting to {self.limit} parallel operation(s)."
+            )
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        self.baseline += (average - self.baseline) * BASELINE_ADAPTATION
+
+
+def parse_profile(value):
+    """Parses a time-of-day profile like '08:00-18:00=200/20'.
+
+    The limits of 200 metadata operations and 20 MB read per second apply between
+    08:00 and 18:00 local time, 0 means no limit. Ranges may span midnight.
+    Returns (start minute, end minute, operations per second, bytes per second).
+    """
+
+    try:
+        times, limits = value.split("=")
+        start, end = [
+            datetime.strptime(part.strip(), "%H:%M") for part in times.split("-")
+        ]
+        max_ops, max_read = [float(part) for part in limits.split("/")]
+    except ValueError:
+        raise ValueError(
+            f"Invalid I/O profile '{value}', expected e.g. '08:00-18:00=200/20'."
+        )
+    return (
+        start.hour * 60 + start.minute,
+        end.hour * 60 + end.minute,
+        max_ops,
+        max_read * 1024 * 1024,
+    )
+
+
+def is_active(profile, minute):
+    start, end = profile[:2]
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def format_profile(profile):
+    if profile is None:
+        return "the default profile"
+    start, end = profile[:2]
+    return f"{start // 60:02}:{start % 60:02}-{end // 60:02}:{end % 60:02}"
+
+
+class IoScheduler:
+    """Limits the metadata operations (e.g. stat) and bytes read per second of a scan.
+
+    The limits are `max_ops` and `max_read` outside of the time-of-day profiles (see
+    `parse_profile`), the first profile containing the current time replaces both. If
+    `max_concurrency` is given, the number of parallel metadata operations adapts to
+    their latency, see AdaptiveLimit.
+    """
+
+    def __init__(self, max_ops=0, max_read=0, profiles=None, max_concurrency=None):
+        self.default_limits = (max_ops, max_read)
+        self.profiles = profiles or []
+        self.ops = RateLimiter(max_ops)
+        self.reads = RateLimiter(max_read)
+        self.concurrency = (
+            AdaptiveLimit(max_concurrency) if max_concurrency is not None else None
+        )
+
+        self.lock = threading.Lock()
+        self.active_profile = None
+        self.next_profile_check = 0
+        self.operations = 0
+        self.read_bytes = 0
+
+        self.check_profiles()
+
+    def check_profiles(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_profile_check:
+                return
+            self.next_profile_check = now + PROFILE_CHECK_INTERVAL
+
+            time_of_day = datetime.now()
+            minute = time_of_day.hour * 60 + time_of_day.minute
+            profile = next((p for p in self.profiles if is_active(p, minute)), None)
+            if profile is self.active_profile:
+                return
+            self.active_profile = profile
+
+        max_ops, max_read = profile[2:] if profile else self.default_limits
+        self.ops.set_rate(max_ops)
+        self.reads.set_rate(max_read)
+        logging.info(
+            f"Switched to the I/O limits of {format_profile(profile)}: "
+            f"{max_ops or 'unlimited'} metadata operations and "
+            f"{round(max_read / 1024 / 1024, 2) if max_read else 'unlimited'} MB read per second."
+        )
+
+    def call(self, function, *args, sample=True):
+        """Runs a metadata operation, e.g. `scheduler.call(os.stat, path)`.
+
+        Only the latency of sampled operations adapts the concurrency, operations whose
+        duration depends on their size (like listing a directory) are not sampled.
+        """
+
+        self.check_profiles()
+        self.ops.acquire()
+        with self.lock:
+            self.operations += 1
+        if self.concurrency is None:
+            return function(*args)
+
+        self.concurrency.acquire()
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.concurrency.release(time.perf_counter() - start if sample else None)
+
+    def read(self, amount):
+        """Accounts for `amount` bytes read, waits if reading continues too fast."""
+
+        self.check_profiles()
+        self.reads.acquire(amount)
+        with self.lock:
+            self.read_bytes += amount
+
+    def close(self):
+        message = (
+            f"I/O scheduler: {self.operations} metadata operations, "
+            f"{round(self.read_bytes / 1024 / 1024, 2)} MB read"
+        )
+        if self.concurrency is not None:
+            message += (
+                f", parallel metadata operations limited to {self.concurrency.limit} "
+                f"of {self.concurrency.max_limit} at the end, {self.concurrency.lowest_limit} at least"
+            )
+        logging.info(f"{message}.")
@@ -0,0 +1,208 @@
+import argparse
+import csv
+import logging
+import re
+import sys
+import time
+from datetime import datetime
+
+from lib import metrics, output_helper, serializer, snapshot_index
+
+SIZE_UNITS = {"B": 1, "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4}
+
+
+def parse_size(value):
+    """Parses sizes like '1500', '1.5 GB' or '200KB', units are powers of 1000 like the `size` field."""
+
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([a-zA-Z]*)\s*", value)
+    if match is None or match.group(2).upper() not in ["", *SIZE_UNITS]:
+        raise argparse.ArgumentTypeError(f"invalid size: '{value}'")
+    try:
+        number = float(match.group(1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: '{value}'")
+    return int(number * SIZE_UNITS.get(match.group(2).upper(), 1))
+
+
+def parse_date(value):
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: '{value}', use YYYY-MM-DD")
+    return value
+
+
+parser = argparse.ArgumentParser(
+    description="Query the documents of an export without importing them, "
+    "writes the matching documents as NDJSON or an aggregation as TSV to stdout."
+)
+parser.add_argument("directory", type=str, help="The output directory of an export.")
+parser.add_argument(
+    "--path",
+    type=str,
+    help="Only documents at or below this path, e.g. 'projects/2009'.",
+)
+parser.add_argument(
+    "--name",
+    type=str,
+    help="Only documents whose name matches this glob, e.g. '*.tif'.",
+)
+parser.add_argument(
+    "--mime-type",
+    type=str,
+    action="append",
+    dest="mime_types",
+    help="Only documents of this MIME type, can be repeated.",
+)
+parser.add_argument(
+    "--type",
+    type=str,
+    action="append",
+    dest="types",
+    help="Only documents of this type (e.g. file or directory), can be repeated.",
+)
+parser.add_argument(
+    "--extension",
+    type=str,
+    action="append",
+    dest="extensions",
+    help="Only documents with this file extension (e.g. tif), can be repeated.",
+)
+parser.add_argument(
+    "--min-size",
+    type=parse_size,
+    help="Only documents of at least this size, e.g. 1GB.",
+)
+parser.add_argument(
+    "--max-size",
+    type=parse_size,
+    help="Only documents of at most this size, e.g. 10MB.",
+)
+parser.add_argument(
+    "--modified-after",
+    type=parse_date,
+    help="Only documents modified on or after this date (YYYY-MM-DD).",
+)
+parser.add_argument(
+    "--modified-before",
+    type=parse_date,
+    help="Only documents modified before this date (YYYY-MM-DD).",
+)
+parser.add_argument(
+    "--group-by",
+    choices=list(snapshot_index.GROUP_BY_EXPRESSIONS),
+    help="Write the number and total size of the matching documents for each value instead of the documents.",
+)
+parser.add_argument(
+    "--count",
+    action="store_true",
+    help="Only log the number and total size of the matching documents.",
+)
+parser.add_argument(
+    "--sort",
+    choices=["path", "size", "modified"],
+    help="Sort the documents, default: the order of the export.",
+)
+parser.add_argument(
+    "--descending", action="store_true", help="Sort in descending order."
+)
+parser.add_argument("--limit", type=int, help="Write at most this many documents.")
+parser.add_argument(
+    "--index-file",
+    type=str,
+    help=f"The index of the export, default: '{snapshot_index.INDEX_FILE_NAME}' in the export directory.",
+)
+parser.add_argument(
+    "--rebuild",
+    action="store_true",
+    help="Rebuild the index, even if the export files did not change.",
+)
+serializer.add_serializer_argument(parser)
+metrics.add_metrics_arguments(parser)
+
+
+if __name__ == "__main__":
+    options = vars(parser.parse_args())
+
+    start_time = time.time()
+    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    logging.basicConfig(
+        filename=f"{output_helper.get_logging_dir('query')}/query_{now}.log",
+        filemode="w",
+        encoding="utf-8",
+        format="%(asctime)s|%(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    # stdout is kept for the results.
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+    metrics.start("query_export", options)
+
+    connection = snapshot_index.open_index(
+        options["directory"],
+        options["index_file"],
+        options["rebuild"],
+        serializer.get_backend(options["serializer"]),
+    )
+    filters = {
+        key: options[key]
+        for key in [
+            "path",
+            "name",
+            "mime_types",
+            "types",
+            "extensions",
+            "min_size",
+            "max_size",
+            "modified_after",
+            "modified_before",
+        ]
+    }
+    if options["extensions"]:
+        filters["extensions"] = [
+            extension.lstrip(".").lower() for extension in options["extensions"]
+        ]
+
+    written = 0
+    try:
+        if options["group_by"]:
+            writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+            writer.writerow([options["group_by"], "documents", "size_bytes"])
+            for row in snapshot_index.aggregate(
+                connection, filters, options["group_by"]
+            ):
+                writer.writerow(row)
+                written += 1
+        elif not options["count"]:
+            output = sys.stdout.buffer
+            for document in snapshot_index.find_documents(
+                connection,
+                filters,
+                {"size": "size_bytes"}.get(options["sort"], options["sort"]),
+                options["descending"],
+                options["limit"],
+            ):
+                output.write(document)
+                output.write(b"\n")
+                written += 1
+            output.flush()
+
+        summary = snapshot_index.summarize(connection, filters)
+    except BrokenPipeError:
+        # e.g. piped into head, the rest of the results is not needed.
+        sys.stderr.close()
+        sys.exit(0)
+    finally:
+        connection.close()
+
+    logging.info(
+        f"{summary['documents']} documents match with {summary['size_bytes']} bytes "
+        f"in files, modified between {summary['oldest_modified']} and {summary['newest_modified']}."
+    )
+    if options["group_by"]:
+        logging.info(f"Wrote {written} groups by {options['group_by']}.")
+    elif not options["count"]:
+        logging.info(f"Wrote {written} documents.")
+    logging.info(f"Finished after {round(time.time() - start_time, 2)} seconds.")
+    metrics.finish(options)
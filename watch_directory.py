@@ -0,0 +1,613 @@
+import argparse
+import errno
+import logging
+import os
+import signal
+import stat
+import sys
+import time
+from datetime import datetime
+
+from lib import (
+    directory_scan,
+    inotify,
+    metrics,
+    output_helper,
+    pipeline,
+    rollups,
+    scan_state,
+)
+
+WATCH_MASK = (
+    inotify.IN_CREATE
+    | inotify.IN_DELETE
+    | inotify.IN_MODIFY
+    | inotify.IN_CLOSE_WRITE
+    | inotify.IN_ATTRIB
+    | inotify.IN_MOVED_FROM
+    | inotify.IN_MOVED_TO
+    | inotify.IN_DELETE_SELF
+    | inotify.IN_MOVE_SELF
+    | inotify.IN_ONLYDIR
+)
+
+# Events that add or remove an entry, which also changes the modification time of
+# the directory containing it.
+MEMBERSHIP_EVENTS = (
+    inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+)
+
+parser = argparse.ArgumentParser(
+    description="Keep an OpenSearch index up to date with a file system tree."
+)
+parser.add_argument("index_name", type=str, help="The index the data is indexed to.")
+parser.add_argument("root_directory", type=str, help="The directory to watch.")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of threads scanning directories in parallel during rescans, default: 1.",
+)
+parser.add_argument(
+    "--debounce",
+    type=float,
+    default=2,
+    help="Seconds without new events before the collected changes are indexed, default: 2.",
+)
+parser.add_argument(
+    "--max-delay",
+    type=float,
+    default=30,
+    help="Index the collected changes at the latest this many seconds after the first "
+    "of them, even if events keep coming, default: 30.",
+)
+parser.add_argument(
+    "--rescan-interval",
+    type=float,
+    default=300,
+    help="Seconds between incremental rescans of the directories that can not be watched, default: 300.",
+)
+parser.add_argument(
+    "--no-watch",
+    action="store_true",
+    help="Do not use inotify, rescan the whole tree every --rescan-interval seconds instead, "
+    "e.g. for network shares changed by other machines.",
+)
+directory_scan.add_scan_arguments(parser)
+parser.add_argument(
+    "--no-rollups",
+    action="store_true",
+    help="Do not add the total size, number of files, newest modification time and MIME types "
+    "of their contents to directories.",
+)
+pipeline.add_bulk_arguments(parser)
+metrics.add_metrics_arguments(parser)
+
+
+def is_below(path, parent):
+    if parent == "":
+        return path != ""
+    return path.startswith(f"{parent}/")
+
+
+def outermost(paths):
+    """Returns the paths that are not below another one of the given paths."""
+
+    result = []
+    for path in sorted(paths):
+        if not any(is_below(path, parent) or path == parent for parent in result):
+            result.append(path)
+    return result
+
+
+def depth(path):
+    return path.count("/") if path else -1
+
+
+class DirectoryWatcher:
+    """Keeps the index and the scan state of a directory tree up to date.
+
+    All directories are watched with inotify. The changed paths reported by the
+    events are collected and indexed together, once no new events arrived for
+    `debounce` seconds or `max_delay` seconds after the first one. New directories
+    are scanned as a whole. Directories that can not be watched (e.g. once the limit
+    of watches is reached) and the whole tree, if inotify is not available or its
+    event queue overflowed, are rescanned incrementally instead.
+
+    Unless disabled, the rollups of the directories containing changes and of their
+    ancestors are updated as well. Their documents are held back until the end of
+    `flush`, so each directory is indexed once with its final totals.
+    """
+
+    def __init__(
+        self, root_path, state, index_pipeline, options, hasher, sniffer, scheduler=None
+    ):
+        self.root_path = root_path
+        self.state = state
+        self.index_pipeline = index_pipeline
+        self.options = options
+        self.hasher = hasher
+        self.sniffer = sniffer
+        self.scheduler = scheduler
+
+        self.path_by_watch = {}
+        self.watch_by_path = {}
+        self.unwatched = set()
+        self.warned_about_limit = False
+
+        self.rollups = not options["no_rollups"]
+        self.directory_documents = {}
+
+        self.changed_paths = set()
+        self.changed_subtrees = set()
+        self.full_rescan = False
+        self.first_event = None
+        self.last_event = None
+
+        self.inotify = None
+        if options["no_watch"]:
+            return
+        try:
+            self.inotify = inotify.Inotify()
+        except OSError as e:
+            logging.warning(
+                f"{e} The tree is rescanned every {options['rescan_interval']} seconds instead."
+            )
+
+    def absolute(self, relative_path):
+        return f"{self.root_path}/{relative_path}" if relative_path else self.root_path
+
+    def watch(self, relative_path):
+        if self.inotify is None:
+            self.unwatched.add(relative_path)
+            return
+
+        try:
+            wd = self.inotify.add_watch(self.absolute(relative_path), WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Removed since it was listed, the event of its parent follows.
+                return
+            if e.errno != errno.ENOSPC:
+                logging.warning(
+                    f"Unable to watch '{relative_path}' ({e.strerror}), it is rescanned instead."
+                )
+            elif not self.warned_about_limit:
+                logging.warning(
+                    "Reached the limit of inotify watches, the remaining directories are "
+                    "rescanned instead. Raise fs.inotify.max_user_watches to watch all of them."
+                )
+                self.warned_about_limit = True
+            self.unwatched.add(relative_path)
+            return
+
+        self.unwatched.discard(relative_path)
+        self.watch_by_path[relative_path] = wd
+        self.path_by_watch[wd] = relative_path
+
+    def unwatch_subtree(self, relative_path):
+        """Removes the watches of a directory that was moved away and of all directories below it."""
+
+        for path in list(self.watch_by_path):
+            if path == relative_path or is_below(path, relative_path):
+                wd = self.watch_by_path.pop(path)
+                del self.path_by_watch[wd]
+                self.inotify.remove_watch(wd)
+        self.unwatched = {
+            path
+            for path in self.unwatched
+            if not (path == relative_path or is_below(path, relative_path))
+        }
+
+    def handle_event(self, event):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            logging.warning(
+                "The inotify event queue overflowed, rescanning the whole tree."
+            )
+            self.full_rescan = True
+            return
+
+        directory = self.path_by_watch.get(event.wd)
+        if directory is None:
+            return
+
+        if event.mask & inotify.IN_IGNORED:
+            # The watch was removed, e.g. because its directory was deleted.
+            del self.path_by_watch[event.wd]
+            if self.watch_by_path.get(directory) == event.wd:
+                del self.watch_by_path[directory]
+            return
+
+        if not event.name:
+            if directory == "" and event.mask & (
+                inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF
+            ):
+                raise Exception(
+                    f"The watched directory '{self.root_path}' was removed."
+                )
+            return
+
+        relative_path = f"{directory}/{event.name}" if directory else event.name
+        self.changed_paths.add(relative_path)
+        if directory and event.mask & MEMBERSHIP_EVENTS:
+            self.changed_paths.add(directory)
+
+        if event.mask & inotify.IN_ISDIR:
+            if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.changed_subtrees.add(relative_path)
+            elif event.mask & inotify.IN_MOVED_FROM:
+                self.unwatch_subtree(relative_path)
+
+    def has_changes(self):
+        return self.full_rescan or self.changed_paths or self.changed_subtrees
+
+    def rescan(self, relative_path):
+        """Incrementally rescans a subtree and watches all of its directories.
+
+        The files of unchanged directories are checked as well, without events there
+        is nothing else to report files modified in place. Returns the number of
+        indexed documents and the paths of the entries that disappeared from the
+        subtree.
+        """
+
+        self.state.start_run()
+
+        unchanged = False
+        try:
+            stats = os.stat(self.absolute(relative_path))
+        except FileNotFoundError:
+            if relative_path == "":
+                raise
+            # Removed again, the event of its parent follows.
+            return (0, [])
+        if relative_path == "":
+            unchanged = directory_scan.is_unchanged_directory(
+                self.state.lookup(""), stats
+            )
+        # Recorded before `finish`, which removes the rollups of unknown directories.
+        self.state.record([scan_state.entry_from_stats(relative_path, True, stats)])
+
+        # Directories are watched before they are listed, so no change gets lost.
+        self.watch(relative_path)
+
+        directory_rollups = None
+        if self.rollups:
+            directory_rollups = directory_scan.DirectoryRollups(
+                self.root_path, self.state
+            )
+
+        indexed = 0
+        for result in directory_scan.walk_file_system(
+            self.root_path,
+            self.options["workers"],
+            [(self.absolute(relative_path), unchanged)],
+            state=self.state,
+            hasher=self.hasher,
+            sniffer=self.sniffer,
+            rollup=self.rollups,
+            scheduler=self.scheduler,
+            stat_files=True,
+        ):
+            for path, _ in result.subdirs:
+                self.watch(path[len(self.root_path) + 1 :])
+
+            documents = result.documents
+            if directory_rollups is not None:
+                documents = directory_rollups.add(result)
+            for document in documents:
+                if document["path"] == relative_path:
+                    # The subtree itself may also be updated as a changed path.
+                    indexed += self.write(document)
+                else:
+                    self.index_pipeline.write(document)
+                    indexed += 1
+
+            if result.unchanged is not None:
+                self.state.keep_children(result.unchanged)
+            self.state.record(result.entries)
+
+        return (indexed, list(self.state.finish(relative_path, commit=False)))
+
+    def update(self, relative_path):
+        """Indexes the current metadata of a single entry, or removes it and all entries below it.
+
+        Returns the number of indexed documents and the paths of the removed entries.
+        """
+
+        path = self.absolute(relative_path)
+        try:
+            stats = os.stat(path)
+        except FileNotFoundError:
+            return (0, self.state.remove_subtree(relative_path))
+        except OSError as e:
+            logging.error(f"Unable to stat '{relative_path}'.")
+            logging.error(e)
+            return (0, [])
+
+        is_dir = stat.S_ISDIR(stats.st_mode)
+        entry = scan_state.entry_from_stats(relative_path, is_dir, stats)
+        if self.state.lookup(relative_path) == entry[3:]:
+            return (0, [])
+
+        removed = []
+        document = directory_scan.create_entry_document(
+            os.path.basename(relative_path), relative_path, stats, is_dir
+        )
+        if not is_dir:
+            # A directory may have been replaced by a file.
+            removed = [
+                removed_path
+                for removed_path in self.state.remove_subtree(relative_path)
+                if removed_path != relative_path
+            ]
+            if "mime_type" not in document and self.sniffer is not None:
+                self.sniffer.sniff_documents([(document, path, stats)])
+            if self.hasher is not None:
+                self.hasher.hash_documents([(document, path, stats)])
+
+        self.state.record([entry])
+        return (self.write(document), removed)
+
+    def write(self, document):
+        """Indexes a document, those of directories are held back for their rollups.
+
+        Returns the number of documents indexed right away.
+        """
+
+        if self.rollups and document["type"] == "directory":
+            self.directory_documents[document["path"]] = document
+            return 0
+        self.index_pipeline.write(document)
+        return 1
+
+    def update_rollups(self, listed, subtree_parents):
+        """Updates the rollups of the given directories and their ancestors.
+
+        The files directly inside the `listed` directories are summed up again. The
+        total of a directory is the sum of its files and the stored totals of its
+        subdirectories, as in `directory_scan.DirectoryRollups`. Directories are
+        updated deepest first, so each total includes the updated ones below it, and
+        the parents of the directories whose total changed follow.
+        """
+
+        pending = set(listed) | set(subtree_parents)
+        while pending:
+            path = max(pending, key=depth)
+            pending.remove(path)
+            if path and not os.path.isdir(self.absolute(path)):
+                # Removed, its parent is updated as it contained a changed entry.
+                continue
+
+            stored, child_totals = self.state.get_current_rollups(path)
+            if path in listed or stored is None:
+                direct = directory_scan.scan_directory(
+                    self.absolute(path),
+                    self.root_path,
+                    sniffer=self.sniffer,
+                    rollup=True,
+                    scheduler=self.scheduler,
+                ).rollup
+            else:
+                direct = stored[0]
+
+            total = rollups.copy_rollup(direct)
+            for child_total in child_totals:
+                rollups.add_rollup(total, child_total)
+            if stored == (direct, total):
+                continue
+
+            self.state.set_rollup(path, direct, total)
+            if path:
+                pending.add(path.rpartition("/")[0])
+                if path not in self.directory_documents and (
+                    stored is None or stored[1] != total
+                ):
+                    document = directory_scan.create_directory_document(
+                        self.root_path, path
+                    )
+                    if document is not None:
+                        self.directory_documents[path] = document
+
+    def write_directory_documents(self):
+        """Indexes the held back directory documents with their current totals."""
+
+        for path, document in self.directory_documents.items():
+            stored, _ = self.state.get_current_rollups(path)
+            if stored is not None:
+                document.update(rollups.rollup_fields(stored[1]))
+            self.index_pipeline.write(document)
+
+        written = len(self.directory_documents)
+        self.directory_documents = {}
+        return written
+
+    def flush(self):
+        """Indexes the collected changes and deletes the documents of removed entries.
+
+        The scan state is only committed once the index contains all changes. If
+        documents failed, the state is rolled back and the changes stay collected,
+        they are retried after `debounce` seconds.
+        """
+
+        start = time.monotonic()
+
+        if self.full_rescan:
+            self.changed_subtrees = {""}
+            self.full_rescan = False
+
+        indexed = 0
+        removed = []
+        subtrees = outermost(self.changed_subtrees)
+        for relative_path in subtrees:
+            subtree_indexed, subtree_removed = self.rescan(relative_path)
+            indexed += subtree_indexed
+            removed += subtree_removed
+
+        updated = [
+            relative_path
+            for relative_path in sorted(self.changed_paths)
+            if not any(is_below(relative_path, subtree) for subtree in subtrees)
+        ]
+        for relative_path in updated:
+            path_indexed, path_removed = self.update(relative_path)
+            indexed += path_indexed
+            removed += path_removed
+
+        if self.rollups:
+            self.update_rollups(
+                {relative_path.rpartition("/")[0] for relative_path in updated},
+                {subtree.rpartition("/")[0] for subtree in subtrees if subtree},
+            )
+            indexed += self.write_directory_documents()
+
+        try:
+            # Deletions are sent once all documents before them were indexed.
+            self.index_pipeline.flush()
+            if removed:
+                self.index_pipeline.delete(removed)
+        except Exception as e:
+            self.state.rollback()
+            # Only documents rejected by OpenSearch are retried, not a failed pipeline.
+            if self.index_pipeline.error is not None:
+                raise
+            logging.error(
+                f"Unable to index the changes, retrying in {self.options['debounce']} seconds."
+            )
+            logging.error(e)
+            self.first_event = self.last_event = time.monotonic()
+            return
+        self.state.commit()
+
+        now = time.monotonic()
+        if self.first_event is not None:
+            metrics.observe("watch_delay_seconds", now - self.first_event)
+        metrics.observe("watch_flush_seconds", now - start)
+        metrics.increment("watch_indexed", indexed)
+        metrics.increment("watch_deleted", len(removed))
+        metrics.write_metrics()
+
+        if indexed or removed:
+            logging.info(
+                f"Indexed {indexed} and deleted {len(removed)} entries "
+                f"in {round(now - start, 2)} seconds."
+            )
+
+        self.changed_paths = set()
+        self.changed_subtrees = set()
+        self.first_event = None
+        self.last_event = None
+
+    def run(self):
+        logging.info(f"Scanning {self.root_path} for changes since the last run.")
+        self.changed_subtrees.add("")
+        self.flush()
+        logging.info(
+            f"Watching {len(self.watch_by_path)} directories, "
+            f"{len(self.unwatched)} are rescanned every {self.options['rescan_interval']} seconds."
+        )
+
+        next_rescan = time.monotonic() + self.options["rescan_interval"]
+        while True:
+            now = time.monotonic()
+            timeout = next_rescan - now
+            if self.first_event is not None:
+                timeout = min(
+                    timeout,
+                    self.last_event + self.options["debounce"] - now,
+                    self.first_event + self.options["max_delay"] - now,
+                )
+
+            if self.inotify is not None:
+                events = self.inotify.read_events(timeout)
+            else:
+                time.sleep(max(timeout, 0))
+                events = []
+
+            for event in events:
+                self.handle_event(event)
+            metrics.increment("watch_events", len(events))
+
+            now = time.monotonic()
+            if events and self.has_changes():
+                if self.first_event is None:
+                    self.first_event = now
+                self.last_event = now
+
+            if self.first_event is not None and (
+                now - self.last_event >= self.options["debounce"]
+                or now - self.first_event >= self.options["max_delay"]
+            ):
+                self.flush()
+
+            if now >= next_rescan:
+                if self.unwatched:
+                    self.changed_subtrees.update(outermost(self.unwatched))
+                    self.flush()
+                next_rescan = time.monotonic() + self.options["rescan_interval"]
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+if __name__ == "__main__":
+    options = vars(parser.parse_args())
+
+    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    root_dir = os.path.abspath(options["root_directory"])
+    input_dir_name = os.path.basename(root_dir).lower()
+
+    logging.basicConfig(
+        filename=f"{output_helper.get_logging_dir(input_dir_name)}/watch_{input_dir_name}_{now}.log",
+        filemode="w",
+        encoding="utf-8",
+        format="%(asctime)s|%(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    metrics.start("watch_directory", options)
+
+    # Stopping the service raises SystemExit, so the changes that were not completely
+    # indexed yet are rolled back and found again by the next run.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    state_directory = output_helper.get_state_dir(input_dir_name)
+    state = scan_state.ScanState(f"{state_directory}/watch_state.sqlite", root_dir)
+    if options["no_rollups"]:
+        # Rollups of an earlier run would be outdated once they are used again.
+        state.clear_rollups()
+        state.commit()
+    scheduler = directory_scan.create_scheduler(options)
+    hasher = directory_scan.create_hasher(options, state_directory, scheduler)
+    sniffer = directory_scan.create_sniffer(options, state_directory, scheduler)
+
+    pipeline.create_index(options["index_name"])
+    index_pipeline = pipeline.IndexPipeline(
+        options["index_name"], pipeline.create_bulk_settings(options)
+    )
+
+    watcher = DirectoryWatcher(
+        root_dir, state, index_pipeline, options, hasher, sniffer, scheduler
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Stopping.")
+        watcher.close()
+        state.rollback()
+        if hasher is not None:
+            hasher.close()
+        if sniffer is not None:
+            sniffer.close()
+        if scheduler is not None:
+            scheduler.close()
+        try:
+            index_pipeline.close()
+        except Exception as e:
+            # The failed documents belong to the rolled back changes.
+            logging.warning(e)
+        metrics.finish(options)